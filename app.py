@@ -1,16 +1,48 @@
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, Response, g
 import os
+import re
+import sys
 import json
+import hmac
 import shutil
-import zipfile
+import signal
 import tempfile
+import zipfile
+import logging
+import threading
 import time
 from werkzeug.utils import secure_filename
+# Configured before the services are imported, so their start-up messages go through it too
+from log_service import log_service
+log_service.configure()
+from metrics_service import metrics_service, MetricsMiddleware
 from terminal_service import terminal_service
 from gemini_service import gemini_service
+from telemetry_service import telemetry_service
+from completion_service import completion_service
+from summary_service import summary_service
+from project_registry import ProjectRegistry
+from file_tree_service import file_tree_service
+from upload_service import upload_service, UploadError
+from export_service import export_service
+from file_content_service import file_content_service
+from document_service import document_service, FlushError
+from search_service import search_service
+from quick_open_service import quick_open_service
+from file_ops_service import file_ops_service, BatchError
+from snapshot_service import snapshot_service, SnapshotError
+from history_service import history_service, HistoryError
+from workspace_service import workspace_service, QuotaError
+from shared_store import shared_store
+from execution_supervisor import SupervisorClient, SupervisorError
+from job_service import job_service, JobError, JobCancelled
+from profile_service import profile_service, ProfileError
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+# A fixed SECRET_KEY keeps sessions, and with them session workspaces, valid across restarts
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
 
 # Project directory - change this to your code directory
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -21,42 +53,258 @@ app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50 MB max upload
 
 # Config
 ALLOWED_EXTENSIONS = {'txt', 'py', 'js', 'html', 'css', 'json', 'md'}
+MULTI_EDIT_MAX_FILES = 20  # Most files a single multi-file AI edit may touch
+MULTI_EDIT_MAX_FILE_BYTES = 200000
 PROJECTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'projects.json')
+PROJECTS_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'projects.db')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+summary_service.set_summarizer(gemini_service.summarize_file)
+
 # Helper functions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_projects():
-    if os.path.exists(PROJECTS_FILE):
-        with open(PROJECTS_FILE, 'r') as f:
-            return json.load(f)
-    return []
-
-def save_projects(projects):
-    with open(PROJECTS_FILE, 'w') as f:
-        json.dump(projects, f)
-
-def get_file_structure(directory):
-    file_structure = []
-    for item in os.listdir(directory):
-        if item.startswith('.'):
-            continue
-        path = os.path.join(directory, item)
-        if os.path.isdir(path):
-            file_structure.append({
-                'name': item,
-                'type': 'directory',
-                'children': get_file_structure(path)
-            })
-        else:
-            file_structure.append({
-                'name': item,
-                'type': 'file'
-            })
-    return file_structure
+# Project registry, imported from projects.json the first time it is created
+project_registry = ProjectRegistry(PROJECTS_DB, legacy_json_path=PROJECTS_FILE)
+
+def prepare_workspace_eviction(root):
+    """Write pending saves before an idle workspace is packed into cold storage."""
+    document_service.flush(root)
+
+def release_workspace(root):
+    """Drop cached state about a workspace whose files were moved to cold storage."""
+    document_service.forget(root)
+    search_service.forget(root)
+    file_tree_service.forget(root)
+
+# Under serve.py this runs in several worker processes: programs run in the execution supervisor,
+# and state that every worker must see (document versions, upload progress, rate limits) is in the shared store
+try:
+    from config import MULTI_WORKER, SUPERVISOR_SOCKET
+except ImportError:
+    MULTI_WORKER, SUPERVISOR_SOCKET = False, None
+if MULTI_WORKER:
+    if not os.environ.get('SECRET_KEY'):
+        # A key of our own would make the other workers reject this one's session cookies
+        raise RuntimeError("SECRET_KEY must be set when running several worker processes")
+    workspace_service.use_shared_state(shared_store, SupervisorClient(SUPERVISOR_SOCKET))
+    document_service.use_shared_store(shared_store)
+    upload_service.use_shared_store(shared_store)
+    job_service.use_shared_store(shared_store)
+    metrics_service.use_shared_store(shared_store)
+    profile_service.use_shared_store(shared_store)
+
+# Without WORKSPACE_MODE every request uses the application's own directories, registry and terminal
+workspace_service.set_shared(PROJECT_ROOT, UPLOAD_FOLDER, project_registry, terminal_service)
+workspace_service.set_evict_hooks(prepare_workspace_eviction, release_workspace)
+
+# Request metrics, and gauges read from the services when /metrics is scraped
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics_service)
+metrics_service.gauge("terminal_processes_running", "Programs running in terminals",
+                      workspace_service.running_programs, merge="max" if MULTI_WORKER else "sum")
+metrics_service.gauge("jobs", "Background jobs by state",
+                      lambda: [({"state": state}, count) for state, count in job_service.stats().items()])
+metrics_service.gauge("ai_calls", "Model calls waiting for a concurrency slot and in progress",
+                      lambda: [({"state": state}, count) for state, count in gemini_service.calls.items()])
+metrics_service.gauge("log_records_dropped", "Log records dropped because the log writer fell behind",
+                      lambda: log_service.dropped)
+
+# Endpoints that work without a workspace in header mode: the page itself, and those for operators rather than tenants
+WORKSPACELESS_ENDPOINTS = ('index', 'static', 'metrics', 'start_profile', 'get_profile_session', 'get_profile',
+                           'stop_profile')
+
+@app.before_request
+def label_request_metrics():
+    """Label the request's metrics with its route pattern rather than its path."""
+    request.environ['metrics.route'] = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_profile():
+    """Profile the request if a profiling session is running and wants it."""
+    token = profile_service.request_started(request.environ['metrics.route'])
+    if token is not None:
+        g.profile_token = token
+
+@app.teardown_request
+def finish_request_profile(exc):
+    token = g.pop('profile_token', None)
+    if token is not None:
+        profile_service.request_finished(token)
+
+@app.before_request
+def resolve_workspace():
+    """Attach the caller's workspace to the request; in session mode a new session gets a new workspace."""
+    if workspace_service.mode == 'session':
+        if not workspace_service.valid_id(session.get('workspace')):
+            session['workspace'] = workspace_service.new_id()
+            session.permanent = True
+        workspace_id = session['workspace']
+    elif workspace_service.mode == 'header':
+        workspace_id = request.headers.get(workspace_service.header)
+        if not workspace_id:
+            g.workspace = None
+            if request.endpoint in WORKSPACELESS_ENDPOINTS:
+                return None
+            return jsonify({'error': f'{workspace_service.header} header is required'}), 401
+    else:
+        workspace_id = None
+    
+    try:
+        g.workspace = workspace_service.get(workspace_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+def workspace():
+    """The workspace of the current request."""
+    return g.workspace
+
+@app.errorhandler(QuotaError)
+def quota_exceeded(e):
+    response = jsonify({'error': str(e), 'quota_exceeded': True})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.errorhandler(JobError)
+def job_refused(e):
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.errorhandler(ProfileError)
+def profile_refused(e):
+    return jsonify({'error': str(e)}), e.status
+
+@app.errorhandler(FlushError)
+def flush_failed(e):
+    # Routes write pending autosaves before acting on files; don't act on stale content
+    root = workspace().root if g.get('workspace') else None
+    paths = [os.path.relpath(p, root) if root else os.path.basename(p) for p in e.paths]
+    return jsonify({'error': str(e), 'unsaved': paths}), 500
+
+@app.errorhandler(SupervisorError)
+def supervisor_unavailable(e):
+    return jsonify({'status': 'error', 'error': str(e)}), 503
+
+def resolve_path(path):
+    """The absolute path of a client path in the current workspace, or None if it points outside it."""
+    if not path:
+        return None
+    return workspace().resolve(path)
+
+def check_write_quota(abs_path, content=None, ops=None):
+    """Raise QuotaError if writing this content (or applying these edits) would exceed the workspace quota."""
+    try:
+        existing = os.path.getsize(abs_path)
+    except OSError:
+        existing = None
+    if content is not None:
+        extra = len(content.encode('utf-8')) - (existing or 0)
+    else:
+        extra = sum(len(str(op.get('text', ''))) for op in ops or [] if isinstance(op, dict))
+    workspace().check_quota(extra, 1 if existing is None else 0)
+
+def get_project_dir_for_path(abs_path):
+    """Return the project directory a file belongs to: its folder under the workspace's projects, or the workspace root."""
+    abs_path = os.path.abspath(abs_path)
+    projects_root = workspace().projects_root
+    if abs_path.startswith(projects_root + os.sep):
+        first = os.path.relpath(abs_path, projects_root).split(os.sep)[0]
+        return os.path.join(projects_root, first)
+    return workspace().root
+
+def after_file_write(abs_path, content=None):
+    """Keep derived per-file data in step after a file is written through one of our routes."""
+    project_dir = get_project_dir_for_path(abs_path)
+    rel_path = os.path.relpath(os.path.abspath(abs_path), project_dir)
+    summary_service.invalidate(project_dir, rel_path, content)
+    file_tree_service.notify_created(abs_path)
+
+def before_project_replace(project_path):
+    """Drop state about a project's files before a new upload or a snapshot replaces them.
+
+    Unwritten autosaves of the old files would otherwise be written over the new ones.
+    """
+    document_service.forget(project_path)
+    search_service.forget(project_path)
+
+def after_project_upload(project_path, registry=None):
+    """Refresh derived project data once an upload is in place, and register it in registry if given.
+
+    An upload replaces any project of the same name, so its registry entry is replaced too.
+    """
+    if registry is not None:
+        registry.put(os.path.basename(project_path), project_path)
+    file_tree_service.invalidate(project_path)
+    search_service.build_async(project_path)
+
+def snapshot_before_ai_change(project_dir, data):
+    """Snapshot an uploaded project before a change with `source: 'ai'` is applied to it, so it can be undone."""
+    if data.get('source') != 'ai' or os.path.dirname(os.path.abspath(project_dir)) != workspace().projects_root:
+        return None
+    # Pending autosaves belong to the state being snapshotted
+    document_service.flush(project_dir)
+    try:
+        return snapshot_service.create_snapshot(project_dir, label="Before AI change", source="ai")['id']
+    except SnapshotError as e:
+        logger.error("Error taking snapshot before AI change", extra={"project": project_dir, "error": str(e)})
+        return None
+
+def save_document(abs_path, data, default_content=None):
+    """Save a request's full `content`, or its edit `ops`, against the `version` it was based on."""
+    ops = data.get('ops')
+    base_version = data.get('version')
+    if base_version is not None:
+        try:
+            base_version = int(base_version)
+        except (TypeError, ValueError):
+            return {"status": "error", "message": "Invalid version"}
+    
+    content = data.get('content', default_content) if ops is None else None
+    snapshot_before_ai_change(get_project_dir_for_path(abs_path), data)
+    history_service.ensure_baseline(abs_path)
+    try:
+        old_size = os.path.getsize(abs_path)
+    except OSError:
+        old_size = None
+    # Saves are on disk when the response is sent; autosaves opt into write-behind with `defer: true`
+    defer = bool(data.get('defer'))
+    result = document_service.save(abs_path, content=content, ops=ops, base_version=base_version, defer=defer)
+    if result['status'] == 'success':
+        after_file_write(abs_path, result['content'])
+        history_service.record(abs_path, result['content'], source=data.get('source', 'save'))
+        workspace().record_usage(len(result['content'].encode('utf-8')) - (old_size or 0), 1 if old_size is None else 0)
+    return result
+
+def get_related_summaries(file_path, file_content, project_structure=None):
+    """Summaries of the files related to file_path, for use as AI context."""
+    abs_path = resolve_path(file_path)
+    if not abs_path:
+        return {}
+    if project_structure and project_structure.get('name'):
+        # The editor sends the project's name; older clients a path from the workspace root
+        project = workspace().registry.get(project_structure['name'])
+        project_dir = os.path.abspath(project['path']) if project else resolve_path(project_structure['name'])
+    else:
+        project_dir = get_project_dir_for_path(abs_path)
+    # Both come from the client: only summarize within one of this workspace's registered projects
+    projects_root = os.path.abspath(workspace().projects_root)
+    if not project_dir or os.path.dirname(project_dir) != projects_root:
+        return {}
+    registered = {os.path.abspath(p['path']) for p in workspace().registry.list()}
+    if project_dir not in registered or not os.path.isdir(project_dir):
+        return {}
+    if not abs_path.startswith(project_dir + os.sep):
+        return {}
+    
+    rel_path = os.path.relpath(abs_path, project_dir)
+    related = summary_service.find_related_files(project_dir, rel_path, file_content)
+    return summary_service.get_summaries(project_dir, related)
 
 @app.route('/')
 def index():
@@ -65,51 +313,133 @@ def index():
 @app.route('/files')
 def list_files():
     files = []
-    for root, dirs, filenames in os.walk(PROJECT_ROOT):
+    workspace_root = workspace().root
+    for root, dirs, filenames in os.walk(workspace_root):
         for filename in filenames:
             if filename.startswith('.') or filename == 'app.py' or 'venv' in root or 'uploaded_projects' in root:
                 continue
-            rel_path = os.path.relpath(os.path.join(root, filename), PROJECT_ROOT)
+            rel_path = os.path.relpath(os.path.join(root, filename), workspace_root)
             files.append(rel_path)
     return jsonify(files)
 
-@app.route('/file')
-def get_file():
-    file_path = request.args.get('path')
-    abs_path = os.path.join(PROJECT_ROOT, file_path)
+def serve_file_content(abs_path, extra=None):
+    """File content as JSON, honouring If-None-Match and the line or byte range query parameters.
     
-    if not os.path.exists(abs_path):
+    `start_line`/`line_count` select lines and `offset`/`length` select bytes.
+    Files too large to return whole come back one page at a time with
+    `has_more` and `next_line`/`next_offset`.
+    """
+    ranged = any(request.args.get(name) is not None for name in ('start_line', 'offset'))
+    pending = document_service.pending_content(abs_path)
+    if pending and ranged:
+        # Ranges are served from disk, so write the pending content first
+        document_service.flush(abs_path)
+    elif pending:
+        # Saved but not yet written: answer from memory
+        version, content, saved_at = pending
+        etag = f"pending-{version:x}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+        response = jsonify({**(extra or {}), "content": content, "etag": etag, "size": len(content.encode('utf-8')),
+                            "mtime": saved_at, "has_more": False, "version": version, "pending": True})
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    try:
+        etag = file_content_service.etag(os.stat(abs_path))
+    except OSError:
         return jsonify({"error": "File not found"}), 404
     
+    # The client already has this version: skip reading the file entirely
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    
     try:
-        with open(abs_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        return jsonify({
-            "path": file_path,
-            "content": content
-        })
-    except UnicodeDecodeError:
-        return jsonify({"error": "Binary file cannot be displayed"}), 400
+        result = file_content_service.read(
+            abs_path,
+            start_line=request.args.get('start_line', type=int),
+            line_count=request.args.get('line_count', type=int),
+            offset=request.args.get('offset', type=int),
+            length=request.args.get('length', type=int)
+        )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    
+    if result.pop('status') == 'binary':
+        return jsonify({"error": "Binary file cannot be displayed", "binary": True, "size": result['size']}), 400
+    
+    # Whole-file reads become the merge base for saves against this version
+    whole = 'start_line' not in result and 'offset' not in result
+    result['version'] = document_service.observe(abs_path, result['etag'], result['content'] if whole else None)
+    
+    response = jsonify({**(extra or {}), **result})
+    response.set_etag(result['etag'], weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/file')
+def get_file():
+    file_path = request.args.get('path')
+    abs_path = resolve_path(file_path)
+    
+    if not abs_path or not os.path.exists(abs_path) or os.path.isdir(abs_path):
+        return jsonify({"error": "File not found"}), 404
+    
+    return serve_file_content(abs_path, {"path": file_path})
 
 @app.route('/save', methods=['POST'])
 def save_file():
     data = request.get_json()
     file_path = data.get('path')
-    content = data.get('content')
     
-    abs_path = os.path.join(PROJECT_ROOT, file_path)
+    abs_path = resolve_path(file_path)
+    if not abs_path:
+        return jsonify({"success": False, "error": "Invalid path"}), 400
+    check_write_quota(abs_path, data.get('content'), data.get('ops'))
     
     # Create directories if they don't exist
     os.makedirs(os.path.dirname(abs_path), exist_ok=True)
     
     try:
-        with open(abs_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        return jsonify({"success": True})
+        result = save_document(abs_path, data)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    
+    if result['status'] == 'conflict':
+        return jsonify({"success": False, "conflict": True, "error": result['message'],
+                        "version": result['version'], "content": result['content']}), 409
+    if result['status'] != 'success':
+        return jsonify({"success": False, "error": result['message']}), 400
+    
+    response = {"success": True, "version": result['version'], "pending": result['pending']}
+    if result['merged']:
+        response.update({"merged": True, "content": result['content']})
+    return jsonify(response)
+
+@app.route('/api/files/flush', methods=['POST'])
+def flush_files():
+    """Write autosaved content that is still pending: one `path`, one `project`, or everything."""
+    data = request.get_json(silent=True) or {}
+    
+    if data.get('project'):
+        project = workspace().registry.get(data['project'])
+        if not project:
+            return jsonify({"error": "Project not found"}), 404
+        target = project['path']
+    elif data.get('path'):
+        target = resolve_path(data['path'])
+        if not target:
+            return jsonify({"error": "Invalid path"}), 400
+    else:
+        target = workspace().root if workspace().isolated else None
+    
+    try:
+        return jsonify({"success": True, "flushed": document_service.flush(target)})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -119,57 +449,194 @@ def upload_folder():
         return jsonify({"error": "No file part"}), 400
     
     file = request.files['file']
-    project_name = request.form.get('project_name', 'project')
+    project_name = secure_filename(request.form.get('project_name', 'project')) or 'project'
+    run_async = request.form.get('async', '').lower() in ('1', 'true', 'yes')
     
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
     
-    # Delete all existing projects (only keep the current one)
-    for item in os.listdir(UPLOAD_FOLDER):
-        item_path = os.path.join(UPLOAD_FOLDER, item)
-        if os.path.isdir(item_path):
-            shutil.rmtree(item_path)
-    
-    # Create a project folder
-    project_path = os.path.join(UPLOAD_FOLDER, project_name)
-    os.makedirs(project_path)
-    
     # Save the uploaded file
     temp_dir = tempfile.mkdtemp()
     zip_path = os.path.join(temp_dir, 'upload.zip')
     file.save(zip_path)
     
-    # Extract the zip file
+    return start_extraction(zip_path, temp_dir, project_name, run_async)
+
+def check_archive_quota(zip_path, project_name):
+    """Raise QuotaError if extracting an archive over the project of the same name would exceed the workspace quota."""
+    ws = workspace()
+    if not ws.isolated:
+        return
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(project_path)
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [m for m in archive.infolist() if not m.is_dir()]
+    except zipfile.BadZipFile:
+        return  # Rejected with a proper message by the extraction itself
+    replaced_bytes, replaced_files = ws.measure(os.path.join(ws.projects_root, project_name))
+    ws.check_quota(sum(m.file_size for m in members) - replaced_bytes, len(members) - replaced_files)
+
+def submit_job(kind, function, detached=False):
+    """Run function(job) as a background job of the current workspace and answer 202 with where to follow it.
+    
+    The function runs in an application context with the request's workspace, so
+    it can use the same helpers as the route that submitted it.
+    """
+    ws = workspace()
+    
+    def run(job):
+        with app.app_context():
+            g.workspace = ws
+            return function(job)
+    
+    job = job_service.submit(kind, run, owner=ws.id, detached=bool(detached))
+    return jsonify({
+        'job_id': job.id,
+        'state': job.state,
+        'status_url': f'/api/jobs/{job.id}',
+        'events_url': f'/api/jobs/{job.id}/events',
+    }), 202
+
+def follow_execution(terminal, start):
+    """A job function that starts a program with start() and reports its output until it exits.
+    
+    Cancelling the job kills the program. The result has the program's pid and exit code.
+    """
+    def run(job):
+        offset = terminal.read_output()['offset']
+        result = start()
+        if result.get('status') != 'started':
+            return result
+        job.report(pid=result['pid'])
+        while True:
+            if job.cancelled():
+                terminal.kill_process()
+                raise JobCancelled()
+            output = terminal.read_output(offset)
+            if output['output']:
+                job.report(output=output['output'])
+            offset = output['offset']
+            if not output['running']:
+                return {'status': 'exited', 'pid': result['pid'], 'exit_code': output['exit_code']}
+            time.sleep(0.1)
+    return run
+
+def start_extraction(zip_path, temp_dir, project_name, run_async):
+    """Extract an uploaded archive into the workspace's projects, in the background when run_async is set"""
+    ws = workspace()
+    try:
+        check_archive_quota(zip_path, project_name)
+    except QuotaError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    job = upload_service.create_job(project_name)
+    
+    def extract():
+        try:
+            # Runs without a request context when async, so the workspace's registry is bound here
+            return upload_service.extract(zip_path, ws.projects_root, project_name, job,
+                                          on_complete=lambda path: after_project_upload(path, ws.registry),
+                                          on_replace=before_project_replace)
+        finally:
+            # Clean up temp directory
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            ws.invalidate_usage()
+    
+    # Large archives can be extracted in the background while the client polls the status route
+    if run_async:
+        threading.Thread(target=extract, name=f"upload-{job.id}", daemon=True).start()
+        return jsonify({"success": True, "upload_id": job.id, "status_url": f"/upload/{job.id}/status"}), 202
+    
+    try:
+        project_path = extract()
         success = True
         message = "Project uploaded and extracted successfully"
-    except zipfile.BadZipFile:
-        success = False
-        message = "Invalid zip file"
-    except Exception as e:
+    except UploadError as e:
         success = False
         message = str(e)
-    finally:
-        # Clean up temp directory
-        shutil.rmtree(temp_dir)
     
     return jsonify({
         "success": success,
         "message": message,
-        "project_path": os.path.relpath(project_path, PROJECT_ROOT) if success else None
+        "upload_id": job.id,
+        "project_path": os.path.relpath(project_path, ws.root) if success else None
     })
 
+@app.route('/upload/chunked', methods=['POST'])
+def init_chunked_upload():
+    """Start a resumable upload from a manifest of chunk hashes and sizes"""
+    data = request.json or {}
+    project_name = secure_filename(data.get('project_name', 'project')) or 'project'
+    
+    try:
+        session = upload_service.init_chunked(project_name, data.get('chunks') or [], data.get('hash'))
+    except (UploadError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return jsonify(session)
+
+@app.route('/upload/chunked/<session_id>', methods=['GET'])
+def chunked_upload_status(session_id):
+    """List the chunks a session is still missing, so an interrupted upload can resume"""
+    try:
+        return jsonify(upload_service.chunked_status(session_id))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), 404
+
+@app.route('/upload/chunked/<session_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(session_id, index):
+    """Receive one chunk as the raw request body"""
+    try:
+        offset = int(request.args.get('offset', -1))
+    except ValueError:
+        return jsonify({"error": "Invalid offset"}), 400
+    
+    try:
+        result = upload_service.put_chunk(session_id, index, offset, request.get_data(), request.args.get('hash', ''))
+    except UploadError as e:
+        status = 404 if 'not found' in str(e) else 400
+        return jsonify({"error": str(e)}), status
+    
+    return jsonify(result)
+
+@app.route('/upload/chunked/<session_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(session_id):
+    """Assemble a completed session's chunks and extract them like a regular upload"""
+    data = request.json or {}
+    run_async = str(data.get('async', '')).lower() in ('1', 'true', 'yes')
+    
+    temp_dir = tempfile.mkdtemp()
+    zip_path = os.path.join(temp_dir, 'upload.zip')
+    try:
+        project_name = upload_service.assemble_chunked(session_id, zip_path)
+    except UploadError as e:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return jsonify({"error": str(e)}), 400
+    
+    return start_extraction(zip_path, temp_dir, project_name, run_async)
+
+@app.route('/upload/<upload_id>/status')
+def upload_status(upload_id):
+    """Progress of an upload: state, entries and bytes extracted so far."""
+    job = upload_service.get_job(upload_id)
+    if not job:
+        return jsonify({"error": "Upload not found"}), 404
+    
+    status = job.to_dict()
+    if status['project_path']:
+        status['project_path'] = os.path.relpath(status['project_path'], workspace().root)
+    return jsonify(status)
+
 @app.route('/projects')
 def list_projects():
     projects = []
-    for item in os.listdir(UPLOAD_FOLDER):
-        full_path = os.path.join(UPLOAD_FOLDER, item)
-        if os.path.isdir(full_path):
+    projects_root = workspace().projects_root
+    for item in os.listdir(projects_root):
+        full_path = os.path.join(projects_root, item)
+        # Hidden folders hold snapshots and uploads in progress
+        if os.path.isdir(full_path) and not item.startswith('.'):
             projects.append({
                 "name": item,
-                "path": os.path.relpath(full_path, PROJECT_ROOT)
+                "path": os.path.relpath(full_path, workspace().root)
             })
     
     return jsonify(projects)
@@ -180,25 +647,28 @@ def list_project_files():
     if not project_path:
         return jsonify({"error": "No project path provided"}), 400
     
-    full_path = os.path.join(PROJECT_ROOT, project_path)
+    full_path = resolve_path(project_path)
     
-    if not os.path.exists(full_path) or not os.path.isdir(full_path):
+    if not full_path or not os.path.exists(full_path) or not os.path.isdir(full_path):
         return jsonify({"error": "Project not found"}), 404
     
-    files = []
-    for root, dirs, filenames in os.walk(full_path):
-        for filename in filenames:
-            if filename.startswith('.'):
-                continue
-            rel_path = os.path.relpath(os.path.join(root, filename), PROJECT_ROOT)
-            files.append(rel_path)
+    prefix = os.path.relpath(full_path, workspace().root)
+    files = [os.path.join(prefix, rel_path) for rel_path in file_tree_service.list_files(full_path)]
     
     return jsonify(files)
 
 @app.route('/api/ai-assistant', methods=['POST'])
 def ai_assistant():
-    """AI assistant API endpoint using Gemini service"""
+    """AI assistant API endpoint using Gemini service; with `async: true` it returns a job to poll instead"""
     data = request.get_json()
+    if data.get('file_content') and data.get('file_path'):
+        workspace().take_rate('ai')
+    if data.get('async'):
+        return submit_job('ai-assistant', lambda job: run_ai_assistant(data), detached=data.get('detach', False))
+    return jsonify(run_ai_assistant(data))
+
+def run_ai_assistant(data):
+    """Answer an AI assistant request; returns the response body."""
     prompt = data.get('prompt', '')
     file_content = data.get('file_content', '')
     file_path = data.get('file_path', '')
@@ -217,6 +687,11 @@ def ai_assistant():
                 if not prompt.lower().startswith('explain') and not prompt.lower().startswith('what does') and not prompt.lower().startswith('how does'):
                     prompt = f"Explain this code: {prompt}"
             
+            # Explanations don't need the rest of the project
+            related_summaries = None
+            if not explanation_mode:
+                related_summaries = get_related_summaries(file_path, file_content, project_structure)
+            
             # The GeminiService knows how to handle selections already
             result = gemini_service.get_code_suggestions(
                 file_content, 
@@ -225,7 +700,8 @@ def ai_assistant():
                 project_structure,
                 selected_text=selected_text,
                 selected_range=selected_range,
-                explanation_mode=explanation_mode
+                explanation_mode=explanation_mode,
+                related_summaries=related_summaries
             )
             
             if result['status'] == 'success':
@@ -233,10 +709,11 @@ def ai_assistant():
                 if explanation_mode and selected_text:
                     # If it's an explanation request, we don't need code suggestions
                     # We just want the explanation response
-                    return jsonify({
+                    return {
                         "response": result.get('explanation', "Here's my explanation of the selected code."),
-                        "has_code_suggestion": False
-                    })
+                        "has_code_suggestion": False,
+                        "usage": result.get('usage')
+                    }
                 
                 # Force selection mode if selected_only is true and we have selected text
                 if selected_only and selected_text:
@@ -245,7 +722,7 @@ def ai_assistant():
                         result['suggestion_for_selection'] = result['suggestion']
                     
                     # Return the suggestion specifically for the selected text
-                    return jsonify({
+                    return {
                         "response": result.get('explanation', "Here's my suggested edit for the selected code."),
                         "has_code_suggestion": True,
                         "suggestion": result['suggestion'],
@@ -253,16 +730,17 @@ def ai_assistant():
                         "selection_only": True,
                         "selection_replacement": result['suggestion_for_selection'],
                         "selected_range": selected_range,
+                        "usage": result.get('usage'),
                         "stats": {
                             "additions": result.get('additions', 0),
                             "deletions": result.get('deletions', 0),
                             "file_name": os.path.basename(file_path)
                         }
-                    })
+                    }
                 # If selected text is being edited, we only want to modify that part
                 elif selected_text and 'suggestion_for_selection' in result:
                     # Return the suggestion specifically for the selected text
-                    return jsonify({
+                    return {
                         "response": result.get('explanation', "Here's my suggested edit for the selected code."),
                         "has_code_suggestion": True,
                         "suggestion": result['suggestion'],
@@ -270,12 +748,13 @@ def ai_assistant():
                         "selection_only": True,
                         "selection_replacement": result['suggestion_for_selection'],
                         "selected_range": selected_range,
+                        "usage": result.get('usage'),
                         "stats": {
                             "additions": result.get('additions', 0),
                             "deletions": result.get('deletions', 0),
                             "file_name": os.path.basename(file_path)
                         }
-                    })
+                    }
                 
                 # Count lines changed for full file edits
                 diff_lines = result['diff'].strip().split('\n')
@@ -288,37 +767,135 @@ def ai_assistant():
                 # Get explanation from Gemini
                 explanation = result.get('explanation', f"Made {additions} additions and {deletions} deletions to {file_name}.")
                 
-                return jsonify({
+                return {
                     "response": explanation,
                     "has_code_suggestion": True,
                     "suggestion": result['suggestion'],
                     "diff": result['diff'],
+                    "usage": result.get('usage'),
                     "stats": {
                         "additions": additions,
                         "deletions": deletions,
                         "file_name": file_name
                     }
-                })
+                }
             else:
                 error_message = result.get('error', 'Unknown error')
-                print(f"Gemini API error: {error_message}")
-                return jsonify({
+                logger.warning("Model error in AI assistant", extra={"path": file_path, "error": error_message})
+                return {
                     "response": f"I encountered an error while analyzing your code: {error_message}",
                     "has_code_suggestion": False
-                })
+                }
         except Exception as e:
             error_message = str(e)
-            print(f"Exception in AI assistant: {error_message}")
-            return jsonify({
+            logger.exception("Error in AI assistant", extra={"path": file_path})
+            return {
                 "response": f"Sorry, I encountered an error: {error_message}",
                 "has_code_suggestion": False
-            })
+            }
     else:
         # For general questions without code context, provide a simpler response
-        return jsonify({
+        return {
             "response": "I can help you with your code. To get specific suggestions, please ask about the currently open file.",
             "has_code_suggestion": False
-        })
+        }
+
+def pick_target_files(project_dir, prompt, max_files):
+    """Pick the files a multi-file request is about: those mentioning identifiers named in the prompt.
+    
+    Identifiers are anything in backticks plus words that look like code names
+    (snake_case, camelCase, dotted.names).
+    """
+    identifiers = set(re.findall(r"`([^`\s]+)`", prompt))
+    identifiers.update(word for word in re.findall(r"\b[A-Za-z_][\w.]*\b", prompt)
+                       if len(word) > 2 and ('_' in word or '.' in word or re.search(r"[a-z][A-Z]", word)))
+    if not identifiers:
+        return []
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(i) for i in sorted(identifiers, key=len, reverse=True)) + r")\b")
+    
+    targets = []
+    for root, dirs, filenames in os.walk(project_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                if os.path.getsize(path) > MULTI_EDIT_MAX_FILE_BYTES:
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    if pattern.search(f.read()):
+                        targets.append(path)
+            except (OSError, UnicodeDecodeError):
+                continue
+            if len(targets) >= max_files:
+                return targets
+    return targets
+
+@app.route('/api/ai-assistant/multi-file', methods=['POST'])
+def ai_assistant_multi_file():
+    """Generate one changeset that edits several files of a project concurrently"""
+    data = request.get_json()
+    prompt = data.get('prompt', '')
+    project_path = data.get('project_path') or (data.get('project_structure') or {}).get('name')
+    file_paths = data.get('file_paths')
+    
+    if not prompt or not project_path:
+        return jsonify({"status": "error", "error": "Prompt and project path are required"}), 400
+    
+    workspace().take_rate('ai')
+    workspace_root = workspace().root
+    project_dir = resolve_path(project_path)
+    if not project_dir or not os.path.isdir(project_dir):
+        return jsonify({"status": "error", "error": "Project not found"}), 404
+    
+    # Use the files the client chose, or find the ones the prompt refers to
+    if file_paths:
+        abs_paths = [os.path.abspath(os.path.join(workspace_root, p)) for p in file_paths[:MULTI_EDIT_MAX_FILES]]
+    else:
+        abs_paths = pick_target_files(project_dir, prompt, MULTI_EDIT_MAX_FILES)
+        if not abs_paths:
+            return jsonify({"status": "error",
+                            "error": "Could not tell which files to change; name the identifiers in backticks or pass file_paths"}), 400
+    
+    files = {}
+    for abs_path in abs_paths:
+        if not abs_path.startswith(project_dir + os.sep) or not os.path.isfile(abs_path):
+            return jsonify({"status": "error", "error": f"File not found: {os.path.relpath(abs_path, workspace_root)}"}), 404
+        try:
+            with open(abs_path, 'r', encoding='utf-8') as f:
+                files[os.path.relpath(abs_path, workspace_root)] = f.read()
+        except UnicodeDecodeError:
+            return jsonify({"status": "error", "error": f"Binary file cannot be edited: {os.path.relpath(abs_path, workspace_root)}"}), 400
+    
+    result = gemini_service.get_multi_file_suggestions(prompt, files, project_name=project_path)
+    if result['status'] != 'success':
+        return jsonify(result), 502
+    return jsonify(result)
+
+@app.route('/api/inline-completion', methods=['POST'])
+def inline_completion():
+    """Short ghost-text completion at the cursor, separate from the full edit flow"""
+    data = request.get_json()
+    file_path = data.get('file_path', '')
+    prefix = data.get('prefix', '')
+    suffix = data.get('suffix', '')
+    cursor_offset = data.get('cursor_offset')
+    session_id = data.get('session_id') or request.remote_addr
+    
+    if not file_path:
+        return jsonify({"status": "error", "error": "No file path provided"}), 400
+    
+    workspace().take_rate('completion')
+    result = completion_service.get_completion(
+        session_id,
+        file_path,
+        prefix,
+        suffix,
+        cursor_offset=cursor_offset,
+        project_name=data.get('project_name')
+    )
+    return jsonify(result)
 
 @app.route('/execute-command', methods=['POST'])
 def execute_command_placeholder():
@@ -337,7 +914,7 @@ def execute_command_placeholder():
 
 @app.route('/api/projects', methods=['GET'])
 def api_projects():
-    return jsonify(get_projects())
+    return jsonify(workspace().registry.list())
 
 @app.route('/api/projects', methods=['POST'])
 def create_project():
@@ -347,50 +924,202 @@ def create_project():
     if not project_name:
         return jsonify({'error': 'Project name is required'}), 400
     
-    project_dir = os.path.join(UPLOAD_FOLDER, secure_filename(project_name))
+    project_dir = os.path.join(workspace().projects_root, secure_filename(project_name))
     
     if os.path.exists(project_dir):
         return jsonify({'error': 'Project already exists'}), 400
     
-    os.makedirs(project_dir)
+    # Registering first makes concurrent creates of the same name race on the database, not the disk
+    if not workspace().registry.add(project_name, project_dir):
+        return jsonify({'error': 'Project already exists'}), 400
     
-    projects = get_projects()
-    projects.append({'name': project_name, 'path': project_dir})
-    save_projects(projects)
+    try:
+        os.makedirs(project_dir)
+    except OSError as e:
+        workspace().registry.remove(project_name)
+        return jsonify({'error': f'Failed to create project: {str(e)}'}), 500
     
     return jsonify({'message': 'Project created successfully', 'project': {'name': project_name, 'path': project_dir}})
 
 @app.route('/api/projects/<project_name>', methods=['DELETE'])
 def delete_project(project_name):
-    projects = get_projects()
-    for i, project in enumerate(projects):
-        if project['name'] == project_name:
-            import shutil
-            try:
-                shutil.rmtree(project['path'])
-                projects.pop(i)
-                save_projects(projects)
-                return jsonify({'message': 'Project deleted successfully'})
-            except Exception as e:
-                return jsonify({'error': f'Failed to delete project: {str(e)}'}), 500
+    project = workspace().registry.get(project_name)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
     
-    return jsonify({'error': 'Project not found'}), 404
+    try:
+        document_service.forget(project['path'])
+        search_service.forget(project['path'])
+        shutil.rmtree(project['path'])
+        snapshot_service.delete_all(project['path'])
+        history_service.forget(project['path'])
+        workspace().invalidate_usage()
+        workspace().registry.remove(project_name)
+        file_tree_service.invalidate(project['path'])
+        return jsonify({'message': 'Project deleted successfully'})
+    except Exception as e:
+        return jsonify({'error': f'Failed to delete project: {str(e)}'}), 500
 
 @app.route('/api/projects/<project_name>/files', methods=['GET'])
 def get_project_files(project_name):
-    projects = get_projects()
-    project = next((p for p in projects if p['name'] == project_name), None)
+    project = workspace().registry.get(project_name)
     
     if not project:
         return jsonify({'error': 'Project not found'}), 404
     
-    file_structure = get_file_structure(project['path'])
+    file_structure = file_tree_service.get_structure(project['path'])
     return jsonify(file_structure)
 
+@app.route('/api/projects/<project_name>/tree', methods=['GET'])
+def get_project_tree_level(project_name):
+    """One directory level of a project, paginated, for lazily expanding very large trees."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    rel_dir = request.args.get('path', '').strip('/')
+    full_path = os.path.abspath(os.path.join(project['path'], rel_dir))
+    project_root = os.path.abspath(project['path'])
+    if full_path != project_root and not full_path.startswith(project_root + os.sep):
+        return jsonify({'error': 'Invalid path'}), 400
+    if not os.path.isdir(full_path):
+        return jsonify({'error': 'Directory not found'}), 404
+    
+    limit = max(1, min(request.args.get('limit', 200, type=int), 1000))
+    cursor = request.args.get('cursor')
+    return jsonify(file_tree_service.list_directory(project['path'], rel_dir, cursor, limit))
+
+@app.route('/api/projects/<project_name>/changes', methods=['GET'])
+def get_project_changes(project_name):
+    """File tree changes after a version, so clients don't refetch the whole tree.
+    
+    Waits up to `timeout` seconds (max 30) for a change when there is none yet.
+    """
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    since = request.args.get('since', 0, type=int)
+    timeout = min(request.args.get('timeout', 0, type=float), 30)
+    return jsonify(file_tree_service.get_changes(project['path'], since, timeout))
+
+@app.route('/api/projects/<project_name>/export', methods=['GET'])
+def export_project(project_name):
+    """Download a project as a zip, streamed while it is generated. `?store=1` skips compression."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    document_service.flush(project['path'])
+    store_only = request.args.get('store', '').lower() in ('1', 'true', 'yes')
+    archive_name = secure_filename(project_name) or 'project'
+    stream = export_service.stream_zip(project['path'], root_name=archive_name, store_only=store_only)
+    
+    return Response(stream, mimetype='application/zip', direct_passthrough=True, headers={
+        'Content-Disposition': f'attachment; filename="{archive_name}.zip"',
+        'Cache-Control': 'no-store'
+    })
+
+@app.route('/api/projects/<project_name>/quick-open', methods=['GET'])
+def quick_open(project_name):
+    """Fuzzy-match `q` against every file path in a project and return the top `limit`."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify(quick_open_service.find(project['path'], query, limit))
+
+@app.route('/api/projects/<project_name>/search', methods=['GET'])
+def search_project(project_name):
+    """Search a project's files, streaming hits as NDJSON while they are found.
+    
+    Query parameters: `q`, `regex=1`, `case=0` for a case-insensitive search, `max` results.
+    """
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    query = request.args.get('q', '')
+    if not query:
+        return jsonify({'error': 'Query is required'}), 400
+    regex = request.args.get('regex', '').lower() in ('1', 'true', 'yes')
+    case_sensitive = request.args.get('case', '1').lower() not in ('0', 'false', 'no')
+    max_results = request.args.get('max', type=int)
+    
+    try:
+        search_service.compile(query, regex, case_sensitive)
+    except re.error as e:
+        return jsonify({'error': f'Invalid regex: {str(e)}'}), 400
+    
+    # Search what the editor has saved, including autosaves not yet written
+    document_service.flush(project['path'])
+    
+    def generate():
+        for hit in search_service.search(project['path'], query, regex, case_sensitive, max_results):
+            yield json.dumps(hit) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-store'})
+
+@app.route('/api/projects/<project_name>/replace', methods=['POST'])
+def replace_in_project(project_name):
+    """Preview a project-wide replace, or apply it to every file at once with `apply: true`.
+    
+    Pass the `etag`s from the preview as `expected` so the replace aborts if a file changed since.
+    """
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    data = request.json or {}
+    query = data.get('query', '')
+    if not query:
+        return jsonify({'error': 'Query is required'}), 400
+    
+    document_service.flush(project['path'])
+    if data.get('apply') and isinstance(data.get('expected'), dict):
+        project_dir = os.path.abspath(project['path'])
+        for rel_path in data['expected']:
+            # Keys come from the client: only files inside this project get a baseline
+            abs_path = resolve_path(os.path.join(project_dir, os.path.normpath(str(rel_path))))
+            if abs_path and abs_path.startswith(project_dir + os.sep) and os.path.isfile(abs_path):
+                history_service.ensure_baseline(abs_path)
+    try:
+        result = search_service.replace(
+            project['path'], query, data.get('replacement', ''),
+            regex=bool(data.get('regex')),
+            case_sensitive=data.get('case_sensitive', True),
+            paths=data.get('paths'),
+            apply=bool(data.get('apply')),
+            expected=data.get('expected')
+        )
+    except re.error as e:
+        return jsonify({'error': f'Invalid regex: {str(e)}'}), 400
+    except OSError as e:
+        return jsonify({'error': f'Failed to replace: {str(e)}'}), 500
+    
+    if result['status'] == 'conflict':
+        return jsonify({'error': result['message'], 'path': result['path']}), 409
+    if result['status'] != 'success':
+        return jsonify({'error': result['message']}), 400
+    
+    for abs_path, content in result.pop('contents', {}).items():
+        after_file_write(abs_path, content)
+        history_service.record(abs_path, content, source='replace')
+    workspace().invalidate_usage()
+    del result['status']
+    return jsonify(result)
+
 @app.route('/api/projects/<project_name>/files', methods=['POST'])
 def create_file(project_name):
-    projects = get_projects()
-    project = next((p for p in projects if p['name'] == project_name), None)
+    project = workspace().registry.get(project_name)
     
     if not project:
         return jsonify({'error': 'Project not found'}), 404
@@ -403,10 +1132,13 @@ def create_file(project_name):
     if not file_name:
         return jsonify({'error': 'File name is required'}), 400
     
-    full_path = os.path.join(project['path'], file_path, file_name)
+    full_path = resolve_path(os.path.join(project['path'], file_path, file_name))
     
+    if not full_path:
+        return jsonify({'error': 'Invalid path'}), 400
     if os.path.exists(full_path):
         return jsonify({'error': 'File already exists'}), 400
+    workspace().check_quota(0, 1)
     
     try:
         if file_type == 'directory':
@@ -414,67 +1146,200 @@ def create_file(project_name):
         else:
             with open(full_path, 'w') as f:
                 f.write('')
+        file_tree_service.notify_created(full_path)
         
         return jsonify({'message': f'{file_type.capitalize()} created successfully'})
     except Exception as e:
         return jsonify({'error': f'Failed to create {file_type}: {str(e)}'}), 500
 
+@app.route('/api/projects/<project_name>/batch', methods=['POST'])
+def batch_file_operations(project_name):
+    """Apply an ordered list of create/write/mkdir/move/delete operations as one transaction.
+    
+    The batch is validated up front and rolled back entirely if any operation
+    fails. `source` (e.g. 'ai' for an applied AI changeset) is echoed back.
+    """
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    data = request.json or {}
+    source = data.get('source', 'user')
+    
+    # Pending autosaves would otherwise be written over the batch's changes later
+    document_service.flush(project['path'])
+    try:
+        operations = file_ops_service.validate(project['path'], data.get('operations'))
+        workspace().check_quota(sum(len(op['content'].encode('utf-8')) for op in operations if 'content' in op),
+                                sum(1 for op in operations if op['op'] == 'create'))
+        snapshot_id = snapshot_before_ai_change(project['path'], data)
+        contents = {os.path.join(project['path'], op['path']): op['content']
+                    for op in operations if op['op'] in ('create', 'write')}
+        for abs_path in contents:
+            history_service.ensure_baseline(abs_path)
+        result = file_ops_service.apply(project['path'], operations)
+    except BatchError as e:
+        return jsonify({'error': str(e), 'index': e.index}), 400
+    workspace().invalidate_usage()
+    
+    for abs_path in result['removed']:
+        document_service.forget(abs_path)
+        file_tree_service.notify_deleted(abs_path)
+    for abs_path in result['written']:
+        if os.path.isfile(abs_path):
+            after_file_write(abs_path)
+            if abs_path in contents:
+                history_service.record(abs_path, contents[abs_path], source=source)
+        else:
+            file_tree_service.notify_created(abs_path)
+    
+    response = {'message': f"Applied {result['applied']} operations", 'applied': result['applied'], 'source': source}
+    if snapshot_id:
+        response['snapshot'] = snapshot_id
+    return jsonify(response)
+
+@app.route('/api/projects/<project_name>/duplicate', methods=['POST'])
+def duplicate_project(project_name):
+    """Copy a project under a new name, sharing unchanged file data with the original."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    new_name = (request.json or {}).get('name')
+    if not new_name or not secure_filename(new_name):
+        return jsonify({'error': 'New project name is required'}), 400
+    
+    workspace().check_quota(1)
+    new_dir = os.path.join(workspace().projects_root, secure_filename(new_name))
+    if os.path.exists(new_dir) or not workspace().registry.add(new_name, new_dir):
+        return jsonify({'error': 'Project already exists'}), 400
+    
+    document_service.flush(project['path'])
+    try:
+        result = snapshot_service.duplicate(project['path'], new_dir)
+    except SnapshotError as e:
+        workspace().registry.remove(new_name)
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'message': 'Project duplicated successfully', 'project': {'name': new_name, 'path': new_dir},
+                    'method': result['method'], 'files': result['files'], 'elapsed_ms': result['elapsed_ms']})
+
+@app.route('/api/projects/<project_name>/snapshots', methods=['GET'])
+def list_snapshots(project_name):
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    return jsonify(snapshot_service.list_snapshots(project['path']))
+
+@app.route('/api/projects/<project_name>/snapshots', methods=['POST'])
+def create_snapshot(project_name):
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    data = request.get_json(silent=True) or {}
+    workspace().check_quota(1)
+    document_service.flush(project['path'])
+    try:
+        snapshot = snapshot_service.create_snapshot(project['path'], label=data.get('label', ''))
+    except SnapshotError as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(snapshot)
+
+@app.route('/api/projects/<project_name>/snapshots/<snapshot_id>/restore', methods=['POST'])
+def restore_snapshot(project_name, snapshot_id):
+    """Put a project back to a snapshot. The state it replaces is snapshotted first."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    document_service.flush(project['path'])
+    try:
+        backup = snapshot_service.restore(project['path'], snapshot_id)
+    except SnapshotError as e:
+        return jsonify({'error': str(e)}), 404 if str(e) in ('Snapshot not found', 'Invalid snapshot id') else 500
+    
+    # Every file may have changed; drop what was derived from the old tree
+    before_project_replace(project['path'])
+    after_project_upload(project['path'])
+    return jsonify({'message': 'Snapshot restored', 'snapshot': snapshot_id, 'backup': backup['id']})
+
+@app.route('/api/projects/<project_name>/snapshots/<snapshot_id>', methods=['DELETE'])
+def delete_snapshot(project_name, snapshot_id):
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    try:
+        deleted = snapshot_service.delete_snapshot(project['path'], snapshot_id)
+    except SnapshotError as e:
+        return jsonify({'error': str(e)}), 400
+    if not deleted:
+        return jsonify({'error': 'Snapshot not found'}), 404
+    return jsonify({'message': 'Snapshot deleted'})
+
 @app.route('/api/projects/<project_name>/files/<path:file_path>', methods=['GET'])
 def get_file_content(project_name, file_path):
-    projects = get_projects()
-    project = next((p for p in projects if p['name'] == project_name), None)
+    project = workspace().registry.get(project_name)
     
     if not project:
         return jsonify({'error': 'Project not found'}), 404
     
-    full_path = os.path.join(project['path'], file_path)
+    full_path = resolve_path(os.path.join(project['path'], file_path))
     
-    if not os.path.exists(full_path) or os.path.isdir(full_path):
+    if not full_path or not os.path.exists(full_path) or os.path.isdir(full_path):
         return jsonify({'error': 'File not found'}), 404
     
-    try:
-        with open(full_path, 'r') as f:
-            content = f.read()
-        
-        return jsonify({'content': content})
-    except Exception as e:
-        return jsonify({'error': f'Failed to read file: {str(e)}'}), 500
+    return serve_file_content(full_path)
 
 @app.route('/api/projects/<project_name>/files/<path:file_path>', methods=['PUT'])
 def update_file_content(project_name, file_path):
-    projects = get_projects()
-    project = next((p for p in projects if p['name'] == project_name), None)
+    project = workspace().registry.get(project_name)
     
     if not project:
         return jsonify({'error': 'Project not found'}), 404
     
-    full_path = os.path.join(project['path'], file_path)
+    full_path = resolve_path(os.path.join(project['path'], file_path))
     
-    if not os.path.exists(full_path) or os.path.isdir(full_path):
+    if not full_path or not os.path.exists(full_path) or os.path.isdir(full_path):
         return jsonify({'error': 'File not found'}), 404
     
     data = request.json
-    content = data.get('content', '')
+    check_write_quota(full_path, data.get('content', '') if data.get('ops') is None else None, data.get('ops'))
     
     try:
-        with open(full_path, 'w') as f:
-            f.write(content)
-        
-        return jsonify({'message': 'File updated successfully'})
+        result = save_document(full_path, data, default_content='')
     except Exception as e:
         return jsonify({'error': f'Failed to update file: {str(e)}'}), 500
+    
+    if result['status'] == 'conflict':
+        return jsonify({'error': result['message'], 'conflict': True,
+                        'version': result['version'], 'content': result['content']}), 409
+    if result['status'] != 'success':
+        return jsonify({'error': result['message']}), 400
+    
+    response = {'message': 'File updated successfully', 'version': result['version'], 'pending': result['pending']}
+    if result['merged']:
+        response.update({'merged': True, 'content': result['content']})
+    return jsonify(response)
 
 @app.route('/api/projects/<project_name>/files/<path:file_path>', methods=['DELETE'])
 def delete_file(project_name, file_path):
-    projects = get_projects()
-    project = next((p for p in projects if p['name'] == project_name), None)
+    project = workspace().registry.get(project_name)
     
     if not project:
         return jsonify({'error': 'Project not found'}), 404
     
-    full_path = os.path.join(project['path'], file_path)
+    full_path = resolve_path(os.path.join(project['path'], file_path))
     
-    if not os.path.exists(full_path):
+    if not full_path or not os.path.exists(full_path):
         return jsonify({'error': 'File not found'}), 404
     
     try:
@@ -483,23 +1348,111 @@ def delete_file(project_name, file_path):
             shutil.rmtree(full_path)
         else:
             os.remove(full_path)
+        document_service.forget(full_path)
+        file_tree_service.notify_deleted(full_path)
+        workspace().invalidate_usage()
         
         return jsonify({'message': 'File deleted successfully'})
     except Exception as e:
         return jsonify({'error': f'Failed to delete file: {str(e)}'}), 500
 
+@app.route('/api/projects/<project_name>/history/<path:file_path>', methods=['GET'])
+def get_file_history(project_name, file_path):
+    """A file's saved revisions, newest first (`limit`, `before` to page), or one revision's content with `revision`."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    full_path = resolve_path(os.path.join(project['path'], file_path))
+    if not full_path:
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    try:
+        if request.args.get('revision'):
+            revision = int(request.args['revision'])
+            try:
+                data = history_service.content(full_path, revision)
+            except HistoryError as e:
+                return jsonify({'error': str(e)}), 404
+            try:
+                return jsonify({'revision': revision, 'content': data.decode('utf-8')})
+            except UnicodeDecodeError:
+                return jsonify({'error': 'Revision is binary', 'revision': revision, 'size': len(data)}), 400
+        
+        before = request.args.get('before')
+        revisions = history_service.history(full_path, limit=min(int(request.args.get('limit', 100)), 1000),
+                                            before=int(before) if before else None)
+    except ValueError:
+        return jsonify({'error': 'Invalid revision, limit or before'}), 400
+    return jsonify({'path': file_path, 'revisions': revisions})
+
+@app.route('/api/projects/<project_name>/diff/<path:file_path>', methods=['GET'])
+def diff_file_revisions(project_name, file_path):
+    """Unified diff between revisions `from` and `to`; without `to`, against the file's current content."""
+    project = workspace().registry.get(project_name)
+    
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    
+    full_path = resolve_path(os.path.join(project['path'], file_path))
+    if not full_path:
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    try:
+        from_revision = int(request.args['from'])
+        to_revision = int(request.args['to']) if request.args.get('to') else None
+        context = int(request.args.get('context', 3))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Revision numbers `from` (and optionally `to`) are required'}), 400
+    
+    current = None
+    if to_revision is None:
+        pending = document_service.pending_content(full_path)
+        if pending:
+            current = pending[1].encode('utf-8')
+        elif os.path.isfile(full_path):
+            with open(full_path, 'rb') as f:
+                current = f.read()
+    
+    try:
+        return jsonify(history_service.diff(full_path, from_revision, to_revision, current=current, context=context))
+    except HistoryError as e:
+        return jsonify({'error': str(e)}), 404
+
 # Terminal Routes
+def execution_target():
+    """The terminal, working directory and any error for an execution request; `terminal` picks one of the workspace's terminals.
+    
+    Raises QuotaError if the workspace already runs as many programs as it may.
+    """
+    data = request.json or {}
+    ws = workspace()
+    working_dir = data.get('working_dir')
+    if ws.isolated:
+        # Programs run inside the workspace, never elsewhere on the server
+        working_dir = ws.resolve(working_dir or '.')
+        if working_dir is None:
+            return None, None, "Working directory is outside the workspace"
+    return ws.terminal(str(data.get('terminal', 'default')), starting=True), working_dir, None
+
 @app.route('/api/execute-code', methods=['POST'])
 def execute_code():
     """Execute Python code and return the result."""
+    code = request.json.get('code')
+    if not code:
+        return jsonify({"status": "error", "error": "No code provided"})
+    
+    terminal, working_dir, error = execution_target()
+    if error:
+        return jsonify({"status": "error", "error": error}), 400
     try:
-        code = request.json.get('code')
-        working_dir = request.json.get('working_dir')
-        
-        if not code:
-            return jsonify({"status": "error", "error": "No code provided"})
-        
-        result = terminal_service.execute_code(code, cwd=working_dir)
+        # Code and commands may read any project file, so nothing may be left pending
+        document_service.flush(workspace().root)
+        if request.json.get('async'):
+            run = follow_execution(terminal, lambda: terminal.execute_code(code, cwd=working_dir))
+            return submit_job('execute-code', run, detached=request.json.get('detach', False))
+        result = terminal.execute_code(code, cwd=working_dir)
         return jsonify(result)
     except Exception as e:
         return jsonify({"status": "error", "error": str(e)})
@@ -507,43 +1460,51 @@ def execute_code():
 @app.route('/api/execute-file', methods=['POST'])
 def execute_file():
     """Execute a Python file directly from its file path."""
+    file_path = request.json.get('file_path')
+    if not file_path:
+        return jsonify({"status": "error", "error": "No file path provided"})
+    
+    # Relative paths are relative to the workspace; absolute ones must be inside it
+    abs_file_path = resolve_path(file_path)
+    if not abs_file_path:
+        return jsonify({"status": "error", "error": "File is outside the workspace"}), 400
+    
+    terminal, working_dir, error = execution_target()
+    if error:
+        return jsonify({"status": "error", "error": error}), 400
     try:
-        file_path = request.json.get('file_path')
-        working_dir = request.json.get('working_dir')
+        logger.debug("Executing file", extra={"path": file_path, "abs_path": abs_file_path, "cwd": working_dir,
+                                              "exists": os.path.exists(abs_file_path)})
         
-        if not file_path:
-            return jsonify({"status": "error", "error": "No file path provided"})
-        
-        # Ensure the file path is absolute by joining with PROJECT_ROOT if needed
-        if not os.path.isabs(file_path):
-            abs_file_path = os.path.join(PROJECT_ROOT, file_path)
-        else:
-            abs_file_path = file_path
-            
-        # Log file path information for debugging
-        print(f"File execution request - Path: {file_path}")
-        print(f"Absolute path: {abs_file_path}")
-        print(f"Working dir: {working_dir}")
-        print(f"File exists: {os.path.exists(abs_file_path)}")
+        # Write any autosaved content still pending before running the file
+        document_service.flush(abs_file_path)
         
         # Use the absolute file path for execution
-        result = terminal_service.execute_file(abs_file_path, cwd=working_dir)
+        if request.json.get('async'):
+            run = follow_execution(terminal, lambda: terminal.execute_file(abs_file_path, cwd=working_dir))
+            return submit_job('execute-file', run, detached=request.json.get('detach', False))
+        result = terminal.execute_file(abs_file_path, cwd=working_dir)
         return jsonify(result)
     except Exception as e:
-        print(f"Error in execute_file: {str(e)}")
+        logger.exception("Error executing file", extra={"path": file_path})
         return jsonify({"status": "error", "error": str(e)})
 
 @app.route('/api/execute-command', methods=['POST'])
 def execute_command():
     """Execute a terminal command and return the result."""
+    command = request.json.get('command')
+    if not command:
+        return jsonify({"status": "error", "error": "No command provided"})
+    
+    terminal, working_dir, error = execution_target()
+    if error:
+        return jsonify({"status": "error", "error": error}), 400
     try:
-        command = request.json.get('command')
-        working_dir = request.json.get('working_dir')
-        
-        if not command:
-            return jsonify({"status": "error", "error": "No command provided"})
-        
-        result = terminal_service.execute_command(command, cwd=working_dir)
+        document_service.flush(workspace().root)
+        if request.json.get('async'):
+            run = follow_execution(terminal, lambda: terminal.execute_command(command, cwd=working_dir))
+            return submit_job('execute-command', run, detached=request.json.get('detach', False))
+        result = terminal.execute_command(command, cwd=working_dir)
         return jsonify(result)
     except Exception as e:
         return jsonify({"status": "error", "error": str(e)})
@@ -552,7 +1513,7 @@ def execute_command():
 def get_terminal_buffer():
     """Get the current terminal output."""
     try:
-        buffer = terminal_service.get_buffer()
+        buffer = workspace().terminal(request.args.get('terminal', 'default')).get_buffer()
         return jsonify({"status": "success", "buffer": buffer})
     except Exception as e:
         return jsonify({"status": "error", "error": str(e)})
@@ -561,7 +1522,8 @@ def get_terminal_buffer():
 def clear_terminal_buffer():
     """Clear the terminal buffer."""
     try:
-        result = terminal_service.clear_buffer()
+        terminal_id = (request.get_json(silent=True) or {}).get('terminal', 'default')
+        result = workspace().terminal(str(terminal_id)).clear_buffer()
         return jsonify(result)
     except Exception as e:
         return jsonify({"status": "error", "error": str(e)})
@@ -577,11 +1539,160 @@ def get_code_suggestion():
     if not file_content or not user_prompt:
         return jsonify({'error': 'File content and prompt are required'}), 400
     
+    workspace().take_rate('ai')
+    if data.get('async'):
+        return submit_job('code-suggestion',
+                          lambda job: gemini_service.get_code_suggestions(file_content, file_path, user_prompt),
+                          detached=data.get('detach', False))
     try:
         result = gemini_service.get_code_suggestions(file_content, file_path, user_prompt)
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Job Routes
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """The workspace's jobs handled by this server process, newest first."""
+    return jsonify({'jobs': job_service.list(workspace().id)})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """A job's state, and its result once finished. `?wait=<s>` waits up to that long for it to finish."""
+    wait = min(request.args.get('wait', 0, type=float), 60)
+    if wait > 0:
+        state = job_service.wait(job_id, workspace().id, after=sys.maxsize, timeout=wait)
+        if state is not None:
+            del state['events']
+    else:
+        state = job_service.get(job_id, workspace().id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(state)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Progress events after `?after=<seq>` as NDJSON, followed by the finished job (type `done`)."""
+    after = request.args.get('after', 0, type=int)
+    owner = workspace().id
+    if job_service.get(job_id, owner) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        seq = after
+        while True:
+            state = job_service.wait(job_id, owner, after=seq, timeout=15)
+            if state is None:
+                return
+            events = state.pop('events')
+            for event in events:
+                seq = event['seq']
+                yield json.dumps(dict(event, type='progress')) + '\n'
+            if state['state'] in ('done', 'error', 'cancelled'):
+                yield json.dumps(dict(state, type='done')) + '\n'
+                return
+            if not events:
+                # Keeps proxies from closing an idle stream, and shows the job is still alive
+                yield json.dumps({'type': 'heartbeat', 'state': state['state']}) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-store'})
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job: a queued one never runs, a running one stops at its next check (programs are killed)."""
+    state = job_service.cancel(job_id, workspace().id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(state)
+
+# Metrics
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request, job, terminal, AI and cache metrics in Prometheus text format, for every worker process."""
+    if not metrics_service.enabled:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics_service.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Admin Routes
+try:
+    from config import ADMIN_TOKEN
+except ImportError:
+    ADMIN_TOKEN = None
+
+def admin_denied():
+    """An error response unless the request carries ADMIN_TOKEN; admin routes are off without one."""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN to enable them'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'error': 'A valid X-Admin-Token header is required'}), 403
+    return None
+
+@app.route('/api/admin/profile', methods=['POST'])
+def start_profile():
+    """Profile the next `requests` requests, or the next `seconds`, optionally only those to `route`."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    data = request.json or {}
+    interval_ms = data.get('interval_ms')
+    session = profile_service.start(mode=data.get('mode', 'sample'), requests=data.get('requests'),
+                                    seconds=data.get('seconds'), route=data.get('route'),
+                                    interval=interval_ms / 1000 if isinstance(interval_ms, (int, float)) else None)
+    return jsonify(session), 201
+
+@app.route('/api/admin/profile', methods=['GET'])
+def get_profile_session():
+    """The running profiling session, if any."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({'session': profile_service.current()})
+
+@app.route('/api/admin/profile/<session_id>', methods=['GET'])
+def get_profile(session_id):
+    """A session's top functions and collapsed stacks, so far if it is still running.
+
+    `?route=` keeps only requests to that route pattern, `?limit=` and `?sort=self|total` shape the
+    function list, and `?format=collapsed` returns just the stacks as "stack count" lines for flame graph tools.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    result = profile_service.result(session_id, route=request.args.get('route'),
+                                    limit=request.args.get('limit', 30, type=int),
+                                    sort=request.args.get('sort', 'self'))
+    if result is None:
+        return jsonify({'error': 'Profiling session not found'}), 404
+    if request.args.get('format') == 'collapsed':
+        lines = [f"{stack} {count}" for stack, count in result['stacks']]
+        return Response("\n".join(lines) + "\n", mimetype='text/plain')
+    return jsonify(result)
+
+@app.route('/api/admin/profile/<session_id>', methods=['DELETE'])
+def stop_profile(session_id):
+    """End a profiling session early; its result stays available."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    session = profile_service.stop(session_id)
+    if session is None:
+        return jsonify({'error': 'Profiling session not found'}), 404
+    return jsonify(session)
+
+# Telemetry Routes
+@app.route('/api/telemetry/ai', methods=['GET'])
+def get_ai_telemetry():
+    """Token and latency aggregates for AI requests, optionally filtered by project and mode."""
+    if workspace_service.enabled:
+        # Aggregates cover every workspace's projects, so tenants don't get to see them
+        denied = admin_denied()
+        if denied:
+            return denied
+    project = request.args.get('project')
+    mode = request.args.get('mode')
+    return jsonify(telemetry_service.get_aggregates(project=project, mode=mode))
+
 if __name__ == '__main__':
+    # Exit through sys.exit on SIGTERM so pending autosaves are written by the atexit flush
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True, port=5000) 
\ No newline at end of file
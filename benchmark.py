@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Load-test the AI assistant endpoint.
+
+Drives /api/ai-assistant at a fixed concurrency and reports latency
+percentiles, throughput and tokens per request. Run it against a live server
+with --url, or in-process with --in-process, which is usually combined with
+the offline model backends:
+
+    MODEL_BACKEND=stub python benchmark.py --in-process --project uploaded_projects/Game
+    MODEL_BACKEND=replay REPLAY_CORPUS_PATH=benchmarks/corpus.jsonl python benchmark.py --url http://localhost:5000
+
+Payloads come either from a JSON-lines file of request bodies (--payloads) or
+are synthesized from the files of a project directory (--project), cycling
+through explanation, selection and whole-file requests.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+MODES = ["explanation", "selection", "whole_file"]
+
+
+def load_payloads(path):
+    """Read request bodies from a JSON-lines file."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthesize_payloads(project_dir, extensions=(".py", ".js", ".html", ".css", ".md")):
+    """Build one explanation, selection and whole-file request for every source file in a project."""
+    payloads = []
+    for root, dirs, filenames in os.walk(project_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in sorted(filenames):
+            if filename.startswith('.') or not filename.endswith(extensions):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    content = f.read()
+            except (UnicodeDecodeError, OSError):
+                continue
+            if not content.strip():
+                continue
+
+            lines = content.splitlines()
+            selection = "\n".join(lines[: min(len(lines), 15)])
+            rel_path = os.path.relpath(path, project_dir)
+            payloads.append({"prompt": "Explain this code", "file_content": content, "file_path": rel_path,
+                             "selected_text": selection, "explanation_mode": True})
+            payloads.append({"prompt": "Add comments to this code", "file_content": content, "file_path": rel_path,
+                             "selected_text": selection, "selected_only": True,
+                             "selected_range": {"startRow": 0, "startCol": 0, "endRow": min(len(lines), 15) - 1, "endCol": 0}})
+            payloads.append({"prompt": "Add docstrings where they are missing", "file_content": content,
+                             "file_path": rel_path})
+    return payloads
+
+
+def payload_mode(payload):
+    if payload.get("explanation_mode") and payload.get("selected_text"):
+        return "explanation"
+    if payload.get("selected_text"):
+        return "selection"
+    return "whole_file"
+
+
+def make_http_sender(base_url):
+    url = base_url.rstrip("/") + "/api/ai-assistant"
+
+    def send(payload):
+        request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=300) as response:
+            return response.status, json.loads(response.read().decode("utf-8"))
+
+    return send
+
+
+def make_in_process_sender():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app
+
+    local = threading.local()
+
+    def send(payload):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        response = client.post("/api/ai-assistant", json=payload)
+        return response.status_code, response.get_json()
+
+    return send
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run(send, payloads, concurrency, total_requests):
+    """Send total_requests requests, cycling through payloads, with at most concurrency in flight."""
+    results = []
+    results_lock = threading.Lock()
+
+    def one(index):
+        payload = payloads[index % len(payloads)]
+        start = time.perf_counter()
+        try:
+            status, body = send(payload)
+            ok = status == 200 and body is not None and not body.get("response", "").startswith(("Sorry", "I encountered"))
+        except Exception as e:
+            status, body, ok = None, {"error": str(e)}, False
+        elapsed = time.perf_counter() - start
+        usage = (body or {}).get("usage") or {}
+        with results_lock:
+            results.append({"mode": payload_mode(payload), "latency": elapsed, "ok": ok,
+                            "prompt_tokens": usage.get("prompt_tokens", 0),
+                            "output_tokens": usage.get("output_tokens", 0)})
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total_requests)))
+    wall_time = time.perf_counter() - started
+    return results, wall_time
+
+
+def summarize(results, wall_time):
+    def stats(rows):
+        latencies = sorted(r["latency"] * 1000 for r in rows)
+        count = len(rows) or 1
+        return {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if not r["ok"]),
+            "p50_ms": round(percentile(latencies, 0.50), 1),
+            "p95_ms": round(percentile(latencies, 0.95), 1),
+            "p99_ms": round(percentile(latencies, 0.99), 1),
+            "prompt_tokens_per_request": round(sum(r["prompt_tokens"] for r in rows) / count, 1),
+            "output_tokens_per_request": round(sum(r["output_tokens"] for r in rows) / count, 1),
+        }
+
+    summary = stats(results)
+    summary["wall_time_s"] = round(wall_time, 2)
+    summary["throughput_rps"] = round(len(results) / wall_time, 2) if wall_time > 0 else 0.0
+    summary["by_mode"] = {mode: stats([r for r in results if r["mode"] == mode])
+                          for mode in MODES if any(r["mode"] == mode for r in results)}
+    return summary
+
+
+def print_summary(summary):
+    print(f"Requests: {summary['requests']}  errors: {summary['errors']}  "
+          f"wall time: {summary['wall_time_s']}s  throughput: {summary['throughput_rps']} req/s")
+    header = f"{'mode':<12}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'in tok':>10}{'out tok':>10}"
+    print(header)
+    print("-" * len(header))
+    rows = [("all", summary)] + list(summary["by_mode"].items())
+    for name, row in rows:
+        print(f"{name:<12}{row['requests']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}"
+              f"{row['prompt_tokens_per_request']:>10}{row['output_tokens_per_request']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /api/ai-assistant")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running server, e.g. http://localhost:5000")
+    target.add_argument("--in-process", action="store_true", help="Drive the Flask app in this process")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--payloads", help="JSON-lines file of /api/ai-assistant request bodies")
+    source.add_argument("--project", help="Project directory to synthesize requests from")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--requests", type=int, default=100, help="Total number of requests to send")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads) if args.payloads else synthesize_payloads(args.project)
+    if not payloads:
+        parser.error("No payloads to send")
+
+    send = make_in_process_sender() if args.in_process else make_http_sender(args.url)
+    results, wall_time = run(send, payloads, args.concurrency, args.requests)
+    summary = summarize(results, wall_time)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
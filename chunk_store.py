@@ -0,0 +1,95 @@
+import os
+import time
+import hashlib
+import threading
+from typing import Iterable, Optional
+
+
+class ChunkStore:
+    """Content-addressed store of immutable byte blobs, one file per SHA-256 digest.
+
+    Objects live at <root>/<first two hex digits>/<digest>. Writes go to a
+    temporary file that is renamed into place, so concurrent writers of the
+    same content are harmless and readers never see partial objects.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            raise ValueError(f"Invalid digest: {digest}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        try:
+            return os.path.exists(self.path(digest))
+        except ValueError:
+            return False
+
+    def put(self, data: bytes, expected_digest: Optional[str] = None) -> str:
+        """Store data and return its digest.
+
+        Raises:
+            ValueError: If expected_digest is given and does not match the data.
+        """
+        digest = self.digest(data)
+        if expected_digest is not None and digest != expected_digest.lower():
+            raise ValueError("Chunk hash does not match its content")
+        path = self.path(digest)
+        if os.path.exists(path):
+            self.touch(digest)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def touch(self, digest: str):
+        """Mark an object as recently used so pruning keeps it."""
+        try:
+            os.utime(self.path(digest))
+        except OSError:
+            pass
+
+    def write_concatenated(self, digests: Iterable[str], destination) -> int:
+        """Write the given objects, in order, to an open binary file. Returns the bytes written."""
+        total = 0
+        for digest in digests:
+            with open(self.path(digest), "rb") as source:
+                while True:
+                    block = source.read(1024 * 1024)
+                    if not block:
+                        break
+                    destination.write(block)
+                    total += len(block)
+        return total
+
+    def prune(self, max_age: float) -> int:
+        """Delete objects not written or touched for max_age seconds. Returns how many were removed."""
+        cutoff = time.time() - max_age
+        removed = 0
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
@@ -0,0 +1,253 @@
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Any
+
+from gemini_service import gemini_service
+from telemetry_service import telemetry_service
+from metrics_service import metrics_service
+
+
+class _TrieNode:
+    __slots__ = ("edges", "value")
+
+    def __init__(self):
+        self.edges = {}  # First character -> (edge label, child node)
+        self.value = None
+
+
+class PrefixTrie:
+    """Radix trie mapping prefix text to the completion predicted after it.
+
+    The useful query is not an exact lookup but "which stored prefixes lie on
+    the path of this longer prefix": if the user has typed the first characters
+    of a stored completion, the rest of that completion is still a valid answer.
+    """
+
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def insert(self, key: str, value: Any):
+        node = self.root
+        while key:
+            edge = node.edges.get(key[0])
+            if edge is None:
+                child = _TrieNode()
+                node.edges[key[0]] = (key, child)
+                node = child
+                key = ""
+                break
+
+            label, child = edge
+            common = 0
+            limit = min(len(label), len(key))
+            while common < limit and label[common] == key[common]:
+                common += 1
+
+            if common < len(label):
+                # Split the edge at the divergence point
+                middle = _TrieNode()
+                middle.edges[label[common]] = (label[common:], child)
+                node.edges[key[0]] = (label[:common], middle)
+                child = middle
+
+            node = child
+            key = key[common:]
+        node.value = value
+
+    def matches_along(self, text: str):
+        """Yield (depth, value) for every stored key that is a prefix of text, deepest first."""
+        found = []
+        node, depth = self.root, 0
+        if node.value is not None:
+            found.append((0, node.value))
+        while depth < len(text):
+            edge = node.edges.get(text[depth])
+            if edge is None:
+                break
+            label, child = edge
+            if not text.startswith(label, depth):
+                break
+            depth += len(label)
+            node = child
+            if node.value is not None:
+                found.append((depth, node.value))
+        return reversed(found)
+
+
+class CompletionService:
+    def __init__(self):
+        """Initialize the inline completion service."""
+        try:
+            from config import (COMPLETION_DEBOUNCE_MS, COMPLETION_PREFIX_CHARS, COMPLETION_SUFFIX_CHARS,
+                                COMPLETION_ANCHOR_BLOCK, COMPLETION_CACHE_ENTRIES, COMPLETION_WORKERS,
+                                COMPLETION_TIMEOUT_SECONDS)
+        except ImportError:
+            COMPLETION_DEBOUNCE_MS, COMPLETION_PREFIX_CHARS, COMPLETION_SUFFIX_CHARS = 75, 2000, 500
+            COMPLETION_ANCHOR_BLOCK, COMPLETION_CACHE_ENTRIES, COMPLETION_WORKERS = 256, 500, 4
+            COMPLETION_TIMEOUT_SECONDS = 10
+
+        self.debounce = COMPLETION_DEBOUNCE_MS / 1000
+        self.prefix_chars = COMPLETION_PREFIX_CHARS
+        self.suffix_chars = COMPLETION_SUFFIX_CHARS
+        self.anchor_block = COMPLETION_ANCHOR_BLOCK
+        self.max_entries = COMPLETION_CACHE_ENTRIES
+        self.timeout = COMPLETION_TIMEOUT_SECONDS
+
+        self.executor = ThreadPoolExecutor(max_workers=COMPLETION_WORKERS, thread_name_prefix="completion")
+        self.lock = threading.Lock()
+        self.tries = {}  # Cache scope -> PrefixTrie
+        self.entries = OrderedDict()  # (scope, key) -> entry, in least recently used order
+        self.sessions = {}  # Session id -> (generation, superseded event) of its latest request still running
+        self.generations = itertools.count(1)
+
+    def _cache_scope(self, file_path: str, suffix: str, window_start: int):
+        """Completions are only reusable for the same file, text after the cursor and prefix anchor."""
+        suffix_hash = hashlib.sha1(suffix.encode("utf-8")).hexdigest()[:16]
+        return (file_path, suffix_hash, window_start)
+
+    def _window(self, prefix: str, suffix: str, cursor_offset: Optional[int]):
+        """Bound the prefix and suffix, anchoring the prefix start to a block boundary.
+
+        Anchoring keeps the start of the window fixed while the user types, so the
+        new prefix extends the old one and walks through its trie node.
+        """
+        suffix = suffix[:self.suffix_chars]
+        if cursor_offset is None:
+            cursor_offset = len(prefix)
+        earliest = max(0, cursor_offset - self.prefix_chars)
+        window_start = -(-earliest // self.anchor_block) * self.anchor_block if earliest else 0
+        window_start = min(window_start, cursor_offset)
+        keep = cursor_offset - window_start
+        prefix = prefix[-keep:] if keep else ""
+        return prefix, suffix, window_start
+
+    def _lookup(self, scope, prefix: str):
+        with self.lock:
+            trie = self.tries.get(scope)
+            if trie is None:
+                return None
+            for depth, entry in trie.matches_along(prefix):
+                typed = prefix[depth:]
+                if entry["completion"].startswith(typed) and len(entry["completion"]) > len(typed):
+                    self.entries.move_to_end((scope, prefix[:depth]))
+                    return entry, entry["completion"][len(typed):]
+        return None
+
+    def _store(self, scope, prefix: str, completion: str, model: str):
+        if not completion:
+            return
+        with self.lock:
+            entry = {"completion": completion, "model": model}
+            self.entries[(scope, prefix)] = entry
+            self.entries.move_to_end((scope, prefix))
+            self.tries.setdefault(scope, PrefixTrie()).insert(prefix, entry)
+
+            if len(self.entries) > self.max_entries:
+                # Drop the oldest quarter and rebuild the affected tries
+                for _ in range(len(self.entries) - self.max_entries * 3 // 4):
+                    self.entries.popitem(last=False)
+                self.tries = {}
+                for (entry_scope, entry_prefix), kept in self.entries.items():
+                    self.tries.setdefault(entry_scope, PrefixTrie()).insert(entry_prefix, kept)
+
+    def _supersede(self, session_id: str):
+        """Register a new request for a session and wake the one before it so it can bail out.
+
+        Returns the new request's generation number and the event that wakes it.
+        """
+        with self.lock:
+            _, event = self.sessions.get(session_id, (0, None))
+            if event is not None:
+                event.set()
+            # Numbered across sessions, so a session's entry can be dropped and restarted safely
+            current = (next(self.generations), threading.Event())
+            self.sessions[session_id] = current
+            return current
+
+    def _release(self, session_id: str, generation: int):
+        """Forget a session once its latest request is done, so idle sessions don't accumulate."""
+        with self.lock:
+            if self.sessions.get(session_id, (None,))[0] == generation:
+                del self.sessions[session_id]
+
+    def get_completion(self, session_id: str, file_path: str, prefix: str, suffix: str,
+                       cursor_offset: Optional[int] = None, project_name: Optional[str] = None) -> Dict[str, Any]:
+        """Get a short inline completion at the cursor.
+
+        Args:
+            session_id: Identifies the editor session; a newer request cancels older ones.
+            file_path: The path of the file being edited.
+            prefix: Text before the cursor. Send at least COMPLETION_PREFIX_CHARS so the
+                window can be anchored; at most that many are used.
+            suffix: Text after the cursor, at most COMPLETION_SUFFIX_CHARS are used.
+            cursor_offset: Absolute character offset of the cursor in the file.
+            project_name: Optional project name, for telemetry.
+
+        Returns:
+            A dictionary containing:
+            - status: "success", "cancelled" or "error"
+            - completion: The text to show after the cursor (if successful)
+            - cached: Whether the completion came from the prefix cache (if successful)
+            - error: Error message (if error)
+        """
+        prefix, suffix, window_start = self._window(prefix, suffix, cursor_offset)
+        scope = self._cache_scope(file_path, suffix, window_start)
+        generation, wake = self._supersede(session_id)
+
+        try:
+            # Typing through a cached completion needs no debounce and no upstream call
+            cached = self._lookup(scope, prefix)
+            metrics_service.cache_lookup("completion", cached is not None)
+            if cached is not None:
+                entry, completion = cached
+                trace = telemetry_service.start_request(project_name, "inline", file_path)
+                trace.add_call(entry["model"], 0.0, 0.0, 0, 0, cache="hit")
+                trace.finish()
+                return {"status": "success", "completion": completion, "cached": True}
+
+            # Debounce: wait briefly and give up if another keystroke arrives
+            if wake.wait(self.debounce):
+                return {"status": "cancelled"}
+
+            future = self.executor.submit(gemini_service.get_inline_completion, prefix, suffix, file_path,
+                                          project_name)
+
+            def remember(done):
+                try:
+                    result = done.result()
+                except Exception:
+                    result = {}
+                if result.get("status") == "success":
+                    # Cache even results nobody waits for any more; the user may type into them
+                    self._store(scope, prefix, result["completion"], result.get("model", ""))
+                wake.set()
+
+            future.add_done_callback(remember)
+
+            # Wake up when either the completion arrives or a newer request supersedes this one
+            finished = wake.wait(self.timeout)
+            with self.lock:
+                superseded = self.sessions.get(session_id, (None,))[0] != generation
+            if superseded:
+                # Still queued behind other calls: don't make (and pay for) a call nobody will read
+                future.cancel()
+                return {"status": "cancelled"}
+            if not finished:
+                future.cancel()
+                return {"status": "error", "error": "Timed out waiting for a completion"}
+
+            try:
+                result = future.result()
+            except Exception as e:
+                return {"status": "error", "error": f"Error generating completion: {str(e)}"}
+            if result.get("status") != "success":
+                return result
+            return {"status": "success", "completion": result["completion"], "cached": False}
+        finally:
+            self._release(session_id, generation)
+
+# Create a singleton instance
+completion_service = CompletionService()
@@ -4,11 +4,284 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+# Directory of the application, for caches and logs
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Google Gemini API key
 GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY")
 
 # Configure the model to use
 GEMINI_MODEL = "gemini-2.0-flash"
 
+# Fastest model, used for cheap requests such as short explanations
+GEMINI_FAST_MODEL = "gemini-2.0-flash-lite"
+
+# Rough characters-per-token ratio used to estimate prompt size before a call
+CHARS_PER_TOKEN = 4
+
+# Lines of surrounding context kept around a selection by the "compact" prompt variant
+COMPACT_CONTEXT_LINES = 40
+
+# Model routing rules, per request mode ("explanation", "selection", "whole_file", "inline", "summary").
+# Rules are checked in order and the first one whose max_input_tokens is not
+# exceeded by the estimated input size wins. A rule without max_input_tokens
+# matches everything, so keep one as the last entry of each list. For
+# selections, "full" sends the whole file and "compact" only the
+# COMPACT_CONTEXT_LINES around the selection: small files are cheap to send
+# whole, large ones are where the window saves the most.
+MODEL_ROUTES = {
+    "explanation": [
+        {"max_input_tokens": 4000, "model": GEMINI_FAST_MODEL, "max_output_tokens": 512, "prompt_variant": "full"},
+        {"model": GEMINI_MODEL, "max_output_tokens": 1024, "prompt_variant": "compact"},
+    ],
+    "selection": [
+        {"max_input_tokens": 2000, "model": GEMINI_FAST_MODEL, "max_output_tokens": 2048, "prompt_variant": "full"},
+        {"max_input_tokens": 16000, "model": GEMINI_MODEL, "max_output_tokens": 4096, "prompt_variant": "compact"},
+        {"model": GEMINI_MODEL, "max_output_tokens": 8192, "prompt_variant": "compact"},
+    ],
+    "whole_file": [
+        {"model": GEMINI_MODEL, "max_output_tokens": 8192, "prompt_variant": "full"},
+    ],
+    "inline": [
+        {"model": GEMINI_FAST_MODEL, "max_output_tokens": 64, "prompt_variant": "compact"},
+    ],
+    "summary": [
+        {"model": GEMINI_FAST_MODEL, "max_output_tokens": 256, "prompt_variant": "compact"},
+    ],
+}
+
 # Terminal settings
-MAX_TERMINAL_OUTPUT = 10000  # Maximum number of characters to store in terminal history 
\ No newline at end of file
+MAX_TERMINAL_OUTPUT = 10000  # Maximum number of characters to store in terminal history 
+
+# Model backend: "gemini" calls the real API, "stub" and "replay" run offline
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini")
+
+# Stub backend: log-normal time to first token and token rate, seeded for determinism
+STUB_LATENCY_MS = {"median": 300, "sigma": 0.5}
+STUB_TOKENS_PER_SECOND = {"median": 150, "sigma": 0.3}
+STUB_SEED = 0
+
+# Replay backend: corpus recorded with RECORD_CORPUS_PATH, what to do on a miss
+# ("cycle" or "error") and a multiplier on the recorded latencies (0 = no sleep)
+REPLAY_CORPUS_PATH = os.getenv("REPLAY_CORPUS_PATH", os.path.join(BASE_DIR, "benchmarks", "corpus.jsonl"))
+REPLAY_ON_MISS = "cycle"
+REPLAY_SPEED = 1.0
+
+# Set to a file path to record every real model call for later replay
+RECORD_CORPUS_PATH = os.getenv("RECORD_CORPUS_PATH")
+
+# Maximum number of model calls in flight at once, shared by all AI requests
+AI_MAX_CONCURRENCY = 8
+
+# AI telemetry: rotating JSON-lines log of every model call, and how many recent
+# calls each aggregate keeps for latency percentiles
+TELEMETRY_LOG_PATH = os.path.join(BASE_DIR, "logs", "ai_telemetry.jsonl")
+TELEMETRY_LOG_MAX_BYTES = 10 * 1024 * 1024
+TELEMETRY_LOG_BACKUPS = 5
+TELEMETRY_WINDOW = 1000
+
+# Inline (ghost-text) completion: server-side debounce, bounded prefix/suffix
+# windows, block size the prefix window start is anchored to so successive
+# keystrokes share cache keys, prefix cache size, upstream worker threads and
+# how long a request waits for the model before giving up
+COMPLETION_DEBOUNCE_MS = 75
+COMPLETION_PREFIX_CHARS = 2000
+COMPLETION_SUFFIX_CHARS = 500
+COMPLETION_ANCHOR_BLOCK = 256
+COMPLETION_CACHE_ENTRIES = 500
+COMPLETION_WORKERS = 4
+COMPLETION_MAX_LINES = 4
+COMPLETION_TIMEOUT_SECONDS = 10
+
+# Per-file summaries used as compact AI context: where they are stored, the
+# largest file that gets summarized, how many related files are attached to a
+# prompt, and the pause between background summaries (seconds)
+SUMMARY_CACHE_DIR = os.path.join(BASE_DIR, ".cache", "summaries")
+SUMMARY_MAX_FILE_BYTES = 200000
+SUMMARY_MAX_RELATED = 8
+SUMMARY_IDLE_DELAY = 0.5
+
+# In-memory project file trees: how many projects to keep, how many changes
+# each keeps for clients polling /changes, and whether to watch with inotify
+FILE_TREE_MAX_PROJECTS = 16
+FILE_TREE_HISTORY = 1000
+FILE_TREE_USE_INOTIFY = True
+FILE_TREE_MAX_LISTINGS = 2000  # Directory listings cached for the lazy tree API
+
+# Paths never walked or listed, in .gitignore syntax; each project's root
+# .gitignore is applied on top of these
+IGNORE_DEFAULTS = [
+    "node_modules/",
+    "__pycache__/",
+    "*.pyc",
+    "venv/",
+    ".venv/",
+    "dist/",
+    "build/",
+    ".DS_Store",
+]
+
+# Zip uploads: limits checked against the archive's central directory before
+# anything is extracted, extraction threads, and how long finished upload
+# progress stays queryable (seconds)
+UPLOAD_MAX_ENTRIES = 100000
+UPLOAD_MAX_UNCOMPRESSED_BYTES = 2 * 1024 * 1024 * 1024
+UPLOAD_MAX_COMPRESSION_RATIO = 200
+UPLOAD_EXTRACT_WORKERS = 8
+UPLOAD_JOB_TTL = 3600
+
+# Chunked uploads: where content-addressed chunks and session manifests live,
+# the largest chunk accepted, how long unused chunks are kept (so re-uploads
+# of a mostly unchanged project only send what changed) and how long an
+# unfinished session can be resumed (seconds)
+CHUNK_STORE_DIR = os.path.join(BASE_DIR, ".cache", "chunks")
+CHUNK_MAX_BYTES = 16 * 1024 * 1024
+CHUNK_RETENTION = 7 * 24 * 3600
+CHUNK_SESSION_TTL = 24 * 3600
+
+# Project export: block size read from files and handed to the response, and
+# extensions that are already compressed and always stored as-is
+EXPORT_BLOCK_BYTES = 256 * 1024
+EXPORT_STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z",
+    ".mp3", ".mp4", ".webm", ".woff", ".woff2", ".pdf", ".jar", ".whl",
+}
+
+# File content API: files up to FILE_CONTENT_MAX_BYTES are returned whole,
+# larger ones a page at a time; how much of a file is sniffed for binary
+# content, and how many large files keep a cached line index
+FILE_CONTENT_MAX_BYTES = 1024 * 1024
+FILE_CONTENT_PAGE_LINES = 2000
+FILE_CONTENT_PAGE_BYTES = 1024 * 1024
+FILE_CONTENT_SNIFF_BYTES = 8192
+FILE_CONTENT_INDEX_CACHE = 64
+
+# Versioned saves: how many recent versions of each file are kept as merge
+# bases for saves from stale tabs, the largest file kept in memory for that,
+# and how many files are tracked at once
+DOCUMENT_HISTORY_VERSIONS = 20
+DOCUMENT_MAX_CACHED_BYTES = 2 * 1024 * 1024
+DOCUMENT_CACHE_FILES = 200
+
+# Write-behind autosave: an autosaved file is written once it has been quiet
+# for AUTOSAVE_DEBOUNCE_MS, and at most AUTOSAVE_MAX_DELAY_MS after its first
+# unwritten save. Until then the content lives only in server memory, so this
+# is the window of typing a crash can lose; 0 writes every save synchronously.
+# AUTOSAVE_FSYNC flushes each write to disk before it counts as written.
+AUTOSAVE_DEBOUNCE_MS = 500
+AUTOSAVE_MAX_DELAY_MS = 5000
+AUTOSAVE_FSYNC = True
+
+# Project search: files larger than this are not indexed or searched, how
+# many project indexes stay in memory, and the most hits a search returns
+SEARCH_MAX_FILE_BYTES = 1024 * 1024
+SEARCH_MAX_PROJECTS = 8
+SEARCH_MAX_RESULTS = 2000
+
+# Quick open: how many project path indexes stay in memory and the most
+# results one query may ask for
+QUICK_OPEN_MAX_PROJECTS = 8
+QUICK_OPEN_MAX_RESULTS = 100
+
+# Batch file operations: the most operations one request may carry, and
+# whether the files and directories it changed are flushed to disk before it is acknowledged
+BATCH_MAX_OPERATIONS = 1000
+BATCH_FSYNC = True
+
+# Project snapshots and duplicates: how files are cloned ("auto" uses
+# reflinks where the filesystem supports them and copies elsewhere; "copy"
+# always copies; "hardlink" links files, which is fast on any filesystem but
+# lets programs that rewrite a file in place change its snapshots too), and
+# how many automatic snapshots (before AI changes and restores) are kept per project
+SNAPSHOT_CLONE_METHOD = "auto"
+SNAPSHOT_MAX_AUTO = 50
+
+# File history: where revisions are stored, how many deltas may follow a
+# full copy before the next one is stored whole, how long consecutive saves
+# from the same source are folded into one revision (seconds), the largest
+# file history is kept for, and the largest file stored as deltas
+HISTORY_DIR = os.path.join(BASE_DIR, ".cache", "history")
+HISTORY_KEYFRAME_INTERVAL = 50
+HISTORY_COALESCE_SECONDS = 30
+HISTORY_MAX_FILE_BYTES = 16 * 1024 * 1024
+HISTORY_DELTA_MAX_BYTES = 2 * 1024 * 1024
+
+# Workspaces: "off" serves every request from the application directory as
+# before; "session" gives each browser session its own workspace; "header"
+# takes the workspace id from WORKSPACE_HEADER, which an authenticating proxy
+# in front of the app must set. Workspaces live in WORKSPACES_DIR and idle
+# ones are packed into WORKSPACE_COLD_DIR.
+WORKSPACE_MODE = os.getenv("WORKSPACE_MODE", "off")
+WORKSPACE_HEADER = "X-Workspace-Id"
+WORKSPACES_DIR = os.path.join(BASE_DIR, "workspaces")
+WORKSPACE_COLD_DIR = os.path.join(BASE_DIR, "workspaces_cold")
+
+# Per-workspace quotas: disk (hard-linked snapshot files count once), files,
+# programs running at once, and AI requests and inline completions a minute.
+# Disk use is re-measured at most every WORKSPACE_USAGE_TTL seconds.
+WORKSPACE_MAX_BYTES = 1024 * 1024 * 1024
+WORKSPACE_MAX_FILES = 100000
+WORKSPACE_MAX_EXECUTIONS = 2
+WORKSPACE_AI_REQUESTS_PER_MINUTE = 20
+WORKSPACE_COMPLETIONS_PER_MINUTE = 120
+WORKSPACE_USAGE_TTL = 60
+
+# Workspaces unused this long (seconds) are moved to cold storage, checked
+# every WORKSPACE_SWEEP_SECONDS; 0 keeps every workspace on disk
+WORKSPACE_IDLE_SECONDS = 7 * 24 * 3600
+WORKSPACE_SWEEP_SECONDS = 3600
+
+# Production serving (serve.py): address, worker processes (0 means one per
+# CPU core), threads per worker and request timeout in seconds. serve.py sets
+# MULTI_WORKER for the workers, which then keep shared state in
+# SHARED_STATE_DIR and run programs through the execution supervisor
+# listening on SUPERVISOR_SOCKET.
+SERVE_BIND = os.getenv("SERVE_BIND", "127.0.0.1:5000")
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0"))
+SERVE_THREADS = 8
+SERVE_TIMEOUT = 120
+MULTI_WORKER = os.getenv("MULTI_WORKER") == "1"
+SHARED_STATE_DIR = os.path.join(BASE_DIR, ".cache", "shared")
+SUPERVISOR_SOCKET = os.getenv("SUPERVISOR_SOCKET", os.path.join(BASE_DIR, ".cache", "supervisor.sock"))
+
+# Background jobs (requests sent with "async": true): worker threads per
+# process, most jobs waiting for one (more are refused with 503), how long
+# finished results are kept (seconds), how long an unfinished job may go
+# without being polled before it is cancelled as abandoned (seconds), and
+# progress events kept per job
+JOB_WORKERS = 4
+JOB_MAX_BACKLOG = 64
+JOB_RESULT_TTL = 600
+JOB_ABANDON_SECONDS = 60
+JOB_MAX_EVENTS = 500
+
+# Logging: level, "json" for one JSON object per line or "text" for readable
+# lines, and an optional file (rotated at LOG_MAX_BYTES, keeping LOG_BACKUPS
+# old files) written alongside stderr. Records are written by a background
+# thread; past LOG_QUEUE_SIZE waiting records, new ones are dropped and counted.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_PATH = os.getenv("LOG_PATH") or None
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 10000
+
+# Metrics served at /metrics in Prometheus text format. With MULTI_WORKER,
+# each worker publishes its metrics every METRICS_PUBLISH_SECONDS and
+# /metrics adds up every worker's. Requests slower than
+# LOG_SLOW_REQUEST_SECONDS are logged; 0 turns that off.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PUBLISH_SECONDS = 5
+LOG_SLOW_REQUEST_SECONDS = 2.0
+
+# On-demand profiling through /api/admin/profile. Admin endpoints need
+# ADMIN_TOKEN in the X-Admin-Token header and are off without it. A session
+# lasts at most PROFILE_MAX_SECONDS or PROFILE_MAX_REQUESTS requests, the
+# sampler records every thread's stack every PROFILE_SAMPLE_INTERVAL seconds
+# up to PROFILE_MAX_DEPTH frames, and results are kept PROFILE_RESULT_TTL seconds.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or None
+PROFILE_MAX_SECONDS = 300
+PROFILE_MAX_REQUESTS = 1000
+PROFILE_SAMPLE_INTERVAL = 0.01
+PROFILE_MAX_DEPTH = 64
+PROFILE_RESULT_TTL = 3600
@@ -0,0 +1,462 @@
+import os
+import time
+import atexit
+import difflib
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Any, Tuple
+
+from file_utils import atomic_write
+from file_content_service import FileContentService
+
+logger = logging.getLogger(__name__)
+
+
+class EditError(ValueError):
+    """Raised when edit operations are malformed or do not fit the text they apply to."""
+    pass
+
+
+class FlushError(OSError):
+    """Raised by flush when pending content could not be written; paths lists the files still unwritten."""
+
+    def __init__(self, paths: List[str]):
+        super().__init__(f"Could not write {len(paths)} file(s) with unsaved changes")
+        self.paths = paths
+
+
+def apply_edits(text: str, ops: List[Dict[str, Any]]) -> str:
+    """Apply edit operations to text.
+
+    Each operation is {"start", "end", "text"}: replace the characters in
+    [start, end) of the original text with the new text. Offsets all refer to
+    the original, so operations must not overlap.
+
+    Raises:
+        EditError: If an operation is out of range or overlaps another.
+    """
+    try:
+        edits = sorted(((int(op["start"]), int(op["end"]), str(op.get("text", ""))) for op in ops),
+                       key=lambda edit: (edit[0], edit[1]))
+    except (KeyError, TypeError, ValueError):
+        raise EditError("Each edit needs integer start and end offsets")
+
+    parts = []
+    position = 0
+    for start, end, replacement in edits:
+        if start < position or end < start or end > len(text):
+            raise EditError(f"Edit [{start}, {end}) is out of range or overlaps another edit")
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def _hunks(base: List[str], other: List[str]) -> List[Tuple[int, int, List[str]]]:
+    """Changes from base to other as (base start, base end, replacement lines)."""
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    return [(i1, i2, other[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def merge3(base: str, ours: str, theirs: str) -> Optional[str]:
+    """Line-based three-way merge. Returns None when both sides changed the same lines differently."""
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+
+    base_lines = base.splitlines(keepends=True)
+    changes = sorted([(h, 0) for h in _hunks(base_lines, ours.splitlines(keepends=True))] +
+                     [(h, 1) for h in _hunks(base_lines, theirs.splitlines(keepends=True))],
+                     key=lambda change: (change[0][0], change[0][1]))
+
+    merged = []
+    position = 0
+    i = 0
+    while i < len(changes):
+        (start, end, _), _ = changes[i]
+        group = [changes[i]]
+        group_end = end
+        i += 1
+        # Changes from the two sides that overlap or even touch are merged only if identical
+        while i < len(changes) and changes[i][0][0] <= group_end:
+            group.append(changes[i])
+            group_end = max(group_end, changes[i][0][1])
+            i += 1
+
+        sides = {s for _, s in group}
+        if len(sides) > 1:
+            # Both sides made the identical change: take it once
+            ours_group = [h for h, s in group if s == 0]
+            theirs_group = [h for h, s in group if s == 1]
+            if ours_group != theirs_group:
+                return None
+            group = [(h, 0) for h in ours_group]
+
+        merged.extend(base_lines[position:start])
+        cursor = start
+        for (hunk_start, hunk_end, hunk_lines), _ in group:
+            merged.extend(base_lines[cursor:hunk_start])
+            merged.extend(hunk_lines)
+            cursor = hunk_end
+        position = cursor
+
+    merged.extend(base_lines[position:])
+    return "".join(merged)
+
+
+class _Document:
+    """What the service knows about one file: its current version and recent contents."""
+
+    def __init__(self, version: int):
+        self.version = version
+        self.etag = None
+        self.seen = False
+        self.content = None
+        self.history = deque()  # (version, content), oldest first
+        self.pending = False  # content is newer than the file on disk
+        self.saved_at = 0.0
+        self.lock = threading.Lock()
+
+
+class DocumentService:
+    """Versioned saves with edit operations and three-way merging.
+
+    Every file the editor opens gets a version number, bumped on each save.
+    Clients save either full content or a list of edit operations against the
+    version they last saw, so an autosave of a large file costs only the size
+    of the edit. A save against an older version is merged with what was saved
+    since, line by line; if both touched the same lines it is rejected as a
+    conflict instead of silently overwriting the other tab. Writes are atomic.
+
+    Saves of existing files can be write-behind: the new content is kept in
+    memory, acknowledged at once, and written when the file has been quiet for
+    AUTOSAVE_DEBOUNCE_MS, or at the latest AUTOSAVE_MAX_DELAY_MS after the
+    first unwritten save, so a burst of autosaves becomes one write. Pending
+    content is also written on an explicit flush, before the file is executed,
+    and at interpreter exit. Until then it exists only in this process: a crash
+    loses at most that window of typing, and changes made to the file outside
+    the editor in that window are overwritten. Set AUTOSAVE_DEBOUNCE_MS to 0
+    to write every save synchronously.
+
+    Versions live in memory. They start from the current time in milliseconds
+    the first time a file is seen, so numbers handed out before a restart are
+    never reused for different content afterwards; saves against them are
+    reported as conflicts and the client reloads.
+
+    With several worker processes (use_shared_store), versions and the merge
+    history are kept in the shared store instead, each save holds the file's
+    cross-process lock, and write-behind is off, since content pending in one
+    worker would be invisible to the others.
+    """
+
+    def __init__(self):
+        """Initialize the document service."""
+        try:
+            from config import (DOCUMENT_HISTORY_VERSIONS, DOCUMENT_MAX_CACHED_BYTES, DOCUMENT_CACHE_FILES,
+                                AUTOSAVE_DEBOUNCE_MS, AUTOSAVE_MAX_DELAY_MS, AUTOSAVE_FSYNC)
+        except ImportError:
+            DOCUMENT_HISTORY_VERSIONS, DOCUMENT_MAX_CACHED_BYTES, DOCUMENT_CACHE_FILES = 20, 2 * 1024 * 1024, 200
+            AUTOSAVE_DEBOUNCE_MS, AUTOSAVE_MAX_DELAY_MS, AUTOSAVE_FSYNC = 500, 5000, True
+
+        self.history_versions = DOCUMENT_HISTORY_VERSIONS
+        self.max_cached_bytes = DOCUMENT_MAX_CACHED_BYTES
+        self.cache_files = DOCUMENT_CACHE_FILES
+        self.documents = OrderedDict()  # abs path -> _Document
+        self.lock = threading.Lock()
+
+        # Write-behind: abs path -> (first unwritten save, latest save), drained by one flusher thread
+        self.debounce = AUTOSAVE_DEBOUNCE_MS / 1000.0
+        self.max_delay = AUTOSAVE_MAX_DELAY_MS / 1000.0
+        self.fsync = AUTOSAVE_FSYNC
+        self.dirty = {}
+        self.dirty_condition = threading.Condition()
+        self.flusher = None
+        self.store = None
+        atexit.register(self.flush)
+
+    def use_shared_store(self, store):
+        """Share versions and merge history with other worker processes through store, and write every save at once."""
+        self.flush()
+        self.store = store
+        self.debounce = 0
+
+    @staticmethod
+    def _etag(abs_path: str) -> Optional[str]:
+        try:
+            return FileContentService.etag(os.stat(abs_path))
+        except FileNotFoundError:
+            return None
+
+    def _document(self, abs_path: str) -> _Document:
+        with self.lock:
+            document = self.documents.get(abs_path)
+            if document is None:
+                document = self.documents[abs_path] = _Document(time.time_ns() // 1000000)
+            self.documents.move_to_end(abs_path)
+            if len(self.documents) > self.cache_files:
+                # Never evict a document whose content has not been written yet
+                for path in [p for p, d in self.documents.items() if not d.pending][:len(self.documents) - self.cache_files]:
+                    del self.documents[path]
+            return document
+
+    def _remember(self, document: _Document, content: Optional[str]):
+        """Keep content as the current version and in the merge history, if it is small enough. Call with document.lock."""
+        if content is not None and len(content) > self.max_cached_bytes:
+            content = None
+        document.content = content
+        if content is not None:
+            document.history.append((document.version, content))
+            while len(document.history) > self.history_versions:
+                document.history.popleft()
+
+    @contextmanager
+    def _locked(self, abs_path: str, document: _Document):
+        """Hold a document's lock, and with a shared store its cross-process lock, with its state loaded from the store."""
+        with document.lock:
+            if self.store is None:
+                yield
+                return
+            with self.store.locked(f"document:{abs_path}"):
+                state = self.store.get("documents", abs_path)
+                before = None
+                if state is not None:
+                    before = (state["version"], state["etag"], state["content"])
+                    if (document.version, document.etag) != (state["version"], state["etag"]) or not document.seen:
+                        # Another worker saved since: adopt its version, and its content if it kept one
+                        document.version, document.etag, document.seen = state["version"], state["etag"], True
+                        document.history.clear()
+                        document.content = None
+                        if state["content"]:
+                            self._remember(document, self.store.get("document-versions", f"{abs_path}@{document.version}"))
+                yield
+                after = (document.version, document.etag, document.content is not None)
+                if after != before:
+                    self.store.set("documents", abs_path, {"version": after[0], "etag": after[1], "content": after[2]})
+                    if document.content is not None and (before is None or after[0] != before[0]):
+                        self.store.set("document-versions", f"{abs_path}@{after[0]}", document.content, ttl=86400)
+                        self.store.delete("document-versions", f"{abs_path}@{after[0] - self.history_versions}")
+
+    def _base(self, abs_path: str, document: _Document, version: int) -> Optional[str]:
+        """The content of an earlier version, if it is still kept. Call with document.lock."""
+        base = next((c for v, c in document.history if v == version), None)
+        if base is None and self.store is not None and document.version - self.history_versions < version:
+            base = self.store.get("document-versions", f"{abs_path}@{version}")
+        return base
+
+    def _sync(self, document: _Document, etag: Optional[str], content: Optional[str] = None):
+        """Start a new version if the file changed outside our saves. Call with document.lock."""
+        if document.pending:
+            return  # Our unwritten content is newer than whatever is on disk
+        if not document.seen or document.etag != etag:
+            if document.seen:
+                document.version += 1
+            document.seen = True
+            document.etag = etag
+            document.content = None
+            self._remember(document, content)
+        elif content is not None and document.content is None:
+            self._remember(document, content)
+
+    def observe(self, abs_path: str, etag: str, content: Optional[str] = None) -> int:
+        """Return the version of a file as just read, recording its content as a merge base when given."""
+        abs_path = os.path.abspath(abs_path)
+        document = self._document(abs_path)
+        with self._locked(abs_path, document):
+            self._sync(document, etag, content)
+            return document.version
+
+    def save(self, abs_path: str, content: Optional[str] = None, ops: Optional[List[Dict[str, Any]]] = None,
+             base_version: Optional[int] = None, defer: bool = False) -> Dict[str, Any]:
+        """Save full content or edit operations against base_version.
+
+        Args:
+            abs_path: File to write.
+            content: New full content. Used when ops is not given.
+            ops: Edit operations ({"start", "end", "text"}) against base_version's content.
+            base_version: Version the client's change is based on. Without it, full content overwrites.
+            defer: Acknowledge now and write behind, if write-behind is enabled and the file exists.
+
+        Returns:
+            A dictionary with status "success", the new version, the content written
+            and whether it was merged (the client must then adopt that content)
+            or is still pending, status "conflict" with the current version and content, or status "error".
+        """
+        abs_path = os.path.abspath(abs_path)
+        if ops is None and content is None:
+            return {"status": "error", "message": "Either content or ops is required"}
+        if ops is not None and base_version is None:
+            return {"status": "error", "message": "Edit operations need the version they apply to"}
+
+        document = self._document(abs_path)
+        with self._locked(abs_path, document):
+            etag = self._etag(abs_path)
+            self._sync(document, etag)
+            if document.content is not None:
+                current = document.content
+            elif etag is None:
+                current = ""
+            else:
+                current = None
+
+            def read_current():
+                with open(abs_path, "r", encoding="utf-8") as f:
+                    return f.read()
+
+            # The content the client's change was made against
+            base = None
+            if base_version is not None:
+                if base_version == document.version:
+                    if current is None:
+                        current = read_current()
+                    base = current
+                else:
+                    base = self._base(abs_path, document, base_version)
+                    if base is None:
+                        if current is None:
+                            current = read_current()
+                        return {"status": "conflict", "version": document.version, "content": current,
+                                "message": "The file changed and the version the edit was based on is unknown"}
+
+            try:
+                ours = apply_edits(base, ops) if ops is not None else content
+            except EditError as e:
+                return {"status": "error", "message": str(e)}
+
+            merged = False
+            if base_version is not None and base_version != document.version:
+                if current is None:
+                    current = read_current()
+                new_content = merge3(base, ours, current)
+                if new_content is None:
+                    return {"status": "conflict", "version": document.version, "content": current,
+                            "message": "The file was changed by another save on the same lines"}
+                merged = new_content != ours
+            else:
+                new_content = ours
+
+            document.version += 1
+            pending = (defer and self.debounce > 0 and etag is not None
+                       and len(new_content) <= self.max_cached_bytes)
+            if pending:
+                self._remember(document, new_content)
+                document.pending = True
+                document.saved_at = time.time()
+            else:
+                atomic_write(abs_path, new_content, fsync=self.fsync)
+                document.pending = False
+                document.etag = self._etag(abs_path)
+                self._remember(document, new_content)
+
+        if pending:
+            self._mark_dirty(abs_path)
+        return {"status": "success", "version": document.version, "merged": merged, "content": new_content,
+                "pending": pending}
+
+    # Write-behind
+
+    def _mark_dirty(self, abs_path: str):
+        with self.dirty_condition:
+            now = time.time()
+            first = self.dirty.get(abs_path, (now, now))[0]
+            self.dirty[abs_path] = (first, now)
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, name="autosave-flusher", daemon=True)
+                self.flusher.start()
+            self.dirty_condition.notify()
+
+    def _flush_loop(self):
+        while True:
+            with self.dirty_condition:
+                while True:
+                    now = time.time()
+                    deadlines = {path: min(latest + self.debounce, first + self.max_delay)
+                                 for path, (first, latest) in self.dirty.items()}
+                    due = [path for path, deadline in deadlines.items() if deadline <= now]
+                    if due:
+                        break
+                    self.dirty_condition.wait(min(deadlines.values()) - now if deadlines else None)
+                for path in due:
+                    del self.dirty[path]
+
+            for path in due:
+                self._try_flush(path)
+
+    def _try_flush(self, path: str) -> Optional[bool]:
+        """Write one file's pending content; None if writing failed and it was queued to be retried."""
+        try:
+            return self._flush_document(path)
+        except OSError as e:
+            logger.error("Error writing document", extra={"path": path, "error": str(e)})
+            with self.dirty_condition:
+                # Retry later, keeping the content in memory
+                self.dirty.setdefault(path, (time.time(), time.time()))
+                self.dirty_condition.notify()
+            return None
+
+    def _flush_document(self, abs_path: str) -> bool:
+        with self.lock:
+            document = self.documents.get(abs_path)
+        if document is None:
+            return False
+        with document.lock:
+            if not document.pending:
+                return False
+            if self._etag(abs_path) != document.etag:
+                logger.warning("Overwriting outside changes with the editor's pending content", extra={"path": abs_path})
+            atomic_write(abs_path, document.content, fsync=self.fsync)
+            document.etag = self._etag(abs_path)
+            document.pending = False
+            return True
+
+    def flush(self, abs_path: Optional[str] = None) -> int:
+        """Write pending content now: for one file, every file under a directory, or everything.
+
+        Returns:
+            The number of files written.
+
+        Raises:
+            FlushError: If some files could not be written. Every other file is still
+                written, and the failed ones stay pending for the background writer to retry.
+        """
+        prefix = os.path.abspath(abs_path) if abs_path else None
+        with self.dirty_condition:
+            paths = [p for p in self.dirty if prefix is None or p == prefix or p.startswith(prefix + os.sep)]
+            for path in paths:
+                del self.dirty[path]
+        results = {path: self._try_flush(path) for path in paths}
+        failed = [path for path, written in results.items() if written is None]
+        if failed:
+            raise FlushError(failed)
+        return sum(1 for written in results.values() if written)
+
+    def pending_content(self, abs_path: str) -> Optional[Tuple[int, str, float]]:
+        """(version, content, saved at) of a file's unwritten content, or None if it is written."""
+        with self.lock:
+            document = self.documents.get(os.path.abspath(abs_path))
+        if document is None:
+            return None
+        with document.lock:
+            if not document.pending:
+                return None
+            return document.version, document.content, document.saved_at
+
+    def forget(self, abs_path: str):
+        """Drop what is known about a deleted file or directory, including content not yet written."""
+        prefix = os.path.abspath(abs_path)
+        with self.dirty_condition:
+            for path in [p for p in self.dirty if p == prefix or p.startswith(prefix + os.sep)]:
+                del self.dirty[path]
+        with self.lock:
+            paths = [p for p in self.documents if p == prefix or p.startswith(prefix + os.sep)]
+            documents = [self.documents.pop(p) for p in paths]
+        for document in documents:
+            with document.lock:
+                document.pending = False
+
+
+# Create a singleton instance
+document_service = DocumentService()
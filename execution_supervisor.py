@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import signal
+import threading
+import socketserver
+from typing import Any, Dict, Optional, Tuple
+
+from terminal_service import TerminalService
+
+logger = logging.getLogger(__name__)
+
+
+class SupervisorError(Exception):
+    """Raised when the execution supervisor cannot be reached or rejects a request."""
+    pass
+
+
+class ExecutionSupervisor:
+    """The one process that runs programs for every worker.
+
+    With several worker processes each would otherwise have its own terminals:
+    a program started through one worker would be invisible to the others, its
+    output would be readable only through the worker that started it, and the
+    per-workspace execution limit could not be enforced. Instead the
+    supervisor owns every terminal, keyed by workspace and terminal id, and
+    workers send it requests over a Unix socket as JSON lines. The socket is
+    created readable only by the server's user.
+    """
+
+    OPERATIONS = ("execute_code", "execute_file", "execute_command", "get_buffer", "read_output", "clear_buffer",
+                  "kill_process", "is_running", "running", "ping")
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.terminals: Dict[Tuple[str, str], TerminalService] = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _terminal(self, workspace_id: str, terminal_id: str) -> TerminalService:
+        with self.lock:
+            terminal = self.terminals.get((workspace_id, terminal_id))
+            if terminal is None:
+                terminal = self.terminals[(workspace_id, terminal_id)] = TerminalService()
+            return terminal
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Answer one request: {"op", "workspace", "terminal", ...arguments}."""
+        op = request.get("op")
+        if op not in self.OPERATIONS:
+            return {"status": "error", "error": f"Unknown operation: {op}"}
+        if op == "ping":
+            return {"status": "ok", "pid": os.getpid()}
+        workspace_id = str(request.get("workspace") or "")
+        if op == "running":
+            exclude = request.get("exclude")
+            with self.lock:
+                terminals = [t for (w, key), t in self.terminals.items()
+                             if request.get("all") or (w == workspace_id and key != exclude)]
+            return {"status": "ok", "running": sum(1 for t in terminals if t.is_running())}
+
+        terminal = self._terminal(workspace_id, str(request.get("terminal") or "default"))
+        if op == "execute_code":
+            return terminal.execute_code(request.get("code", ""), cwd=request.get("cwd"))
+        if op == "execute_file":
+            return terminal.execute_file(request.get("file_path", ""), cwd=request.get("cwd"))
+        if op == "execute_command":
+            return terminal.execute_command(request.get("command", ""), cwd=request.get("cwd"))
+        if op == "get_buffer":
+            return {"status": "ok", "buffer": terminal.get_buffer()}
+        if op == "read_output":
+            return dict(terminal.read_output(request.get("offset")), status="ok")
+        if op == "clear_buffer":
+            return terminal.clear_buffer()
+        if op == "kill_process":
+            return terminal.kill_process()
+        return {"status": "ok", "running": terminal.is_running()}
+
+    def serve_forever(self):
+        supervisor = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = supervisor.handle(json.loads(line))
+                    except Exception as e:
+                        response = {"status": "error", "error": str(e)}
+                    self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        directory = os.path.dirname(self.socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        previous_umask = os.umask(0o177)
+        try:
+            self.server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(previous_umask)
+        logger.info("Execution supervisor listening", extra={"socket": self.socket_path})
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.shutdown_terminals()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown_terminals(self):
+        with self.lock:
+            terminals = list(self.terminals.values())
+        for terminal in terminals:
+            if terminal.is_running():
+                terminal.kill_process()
+
+
+class SupervisorClient:
+    """A worker's connection to the execution supervisor, one socket per thread."""
+
+    def __init__(self, socket_path: str, timeout: float = 30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or getattr(self.local, "pid", None) != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as e:
+                sock.close()
+                raise SupervisorError(f"Execution supervisor is not reachable at {self.socket_path}: {str(e)}")
+            connection = self.local.connection = (sock, sock.makefile("rb"))
+            self.local.pid = os.getpid()
+        return connection
+
+    def call(self, op: str, **arguments) -> Dict[str, Any]:
+        """Send one request and wait for its answer.
+
+        Reconnects once if the request could not be sent, e.g. because the
+        supervisor was restarted. Once it is sent the request is never
+        repeated, since running a program twice is worse than an error.
+        """
+        payload = json.dumps(dict(arguments, op=op)).encode("utf-8") + b"\n"
+        for attempt in range(2):
+            sock, reader = self._connection()
+            try:
+                sock.sendall(payload)
+            except OSError as e:
+                error = str(e)
+                self.local.connection = None
+                sock.close()
+                continue
+            try:
+                line = reader.readline()
+                if line:
+                    return json.loads(line)
+                error = "connection closed"
+            except OSError as e:
+                error = str(e)
+            self.local.connection = None
+            sock.close()
+            break
+        raise SupervisorError(f"Execution supervisor request failed: {error}")
+
+    def running(self, workspace_id: Optional[str], exclude: Optional[str] = None) -> int:
+        """Programs running in a workspace's terminals, leaving out the terminal named by exclude."""
+        return self.call("running", workspace=workspace_id or "", exclude=exclude)["running"]
+
+    def running_total(self) -> int:
+        """Programs running in every workspace's terminals."""
+        return self.call("running", all=True)["running"]
+
+
+class RemoteTerminal:
+    """A terminal owned by the execution supervisor, with TerminalService's interface."""
+
+    def __init__(self, client: SupervisorClient, workspace_id: Optional[str], terminal_id: str = "default"):
+        self.client = client
+        self.workspace_id = workspace_id or ""
+        self.terminal_id = terminal_id
+
+    def _call(self, op: str, **arguments) -> Dict[str, Any]:
+        return self.client.call(op, workspace=self.workspace_id, terminal=self.terminal_id, **arguments)
+
+    def execute_code(self, code, cwd=None):
+        return self._call("execute_code", code=code, cwd=cwd)
+
+    def execute_file(self, file_path, cwd=None):
+        return self._call("execute_file", file_path=file_path, cwd=cwd)
+
+    def execute_command(self, command, cwd=None):
+        return self._call("execute_command", command=command, cwd=cwd)
+
+    def get_buffer(self):
+        return self._call("get_buffer")["buffer"]
+
+    def read_output(self, offset=None):
+        return self._call("read_output", offset=offset)
+
+    def clear_buffer(self):
+        return self._call("clear_buffer")
+
+    def kill_process(self):
+        return self._call("kill_process")
+
+    def is_running(self):
+        return self._call("is_running")["running"]
+
+
+def wait_for_supervisor(socket_path: str, timeout: float = 10) -> bool:
+    """Wait until a supervisor answers on socket_path."""
+    client = SupervisorClient(socket_path, timeout=1)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            client.call("ping")
+            return True
+        except SupervisorError:
+            time.sleep(0.1)
+    return False
+
+
+if __name__ == '__main__':
+    try:
+        from config import SUPERVISOR_SOCKET
+    except ImportError:
+        SUPERVISOR_SOCKET = os.path.join(".cache", "supervisor.sock")
+    from log_service import log_service
+    log_service.configure()
+    # Under serve.py, take part in profiling sessions, so the terminal threads' stacks are sampled too
+    if os.environ.get("MULTI_WORKER") == "1":
+        from shared_store import shared_store
+        from profile_service import profile_service
+        profile_service.use_shared_store(shared_store)
+
+    supervisor = ExecutionSupervisor(sys.argv[1] if len(sys.argv) > 1 else SUPERVISOR_SOCKET)
+    # Stop serving on SIGTERM so running programs are killed and the socket removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=supervisor.server.shutdown).start())
+    try:
+        supervisor.serve_forever()
+    except KeyboardInterrupt:
+        pass
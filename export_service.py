@@ -0,0 +1,135 @@
+import os
+import time
+import zipfile
+from typing import Iterator, Tuple
+
+from ignore_rules import get_ignore_rules
+
+
+class _StreamSink:
+    """Write-only, unseekable file object that collects what zipfile writes until it is drained.
+
+    Because it has no tell() or seek(), zipfile writes each entry with a data
+    descriptor after its contents instead of seeking back to patch the header.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        if data:
+            self.parts.append(bytes(data))
+            self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+class ExportService:
+    """Streams a project as a zip archive while it is generated.
+
+    Nothing is built on disk or in memory first: files are read in blocks and
+    each compressed block is handed to the response as soon as enough output
+    has accumulated, so memory stays flat whatever the project size. Ignored
+    paths are left out using the same rules as the file tree.
+    """
+
+    def __init__(self):
+        """Initialize the export service."""
+        try:
+            from config import EXPORT_BLOCK_BYTES, EXPORT_STORED_EXTENSIONS
+        except ImportError:
+            EXPORT_BLOCK_BYTES = 256 * 1024
+            EXPORT_STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".zip", ".gz", ".mp3", ".mp4"}
+
+        self.block_bytes = EXPORT_BLOCK_BYTES
+        self.stored_extensions = {ext.lower() for ext in EXPORT_STORED_EXTENSIONS}
+
+    def iter_files(self, project_dir: str) -> Iterator[Tuple[str, str]]:
+        """Yield (absolute path, archive path) for every exported file, in a stable order.
+
+        Hidden directories (.git, staging directories) and ignored paths are
+        skipped without being entered; hidden files such as .gitignore are kept.
+        """
+        rules = get_ignore_rules(project_dir)
+        stack = [(project_dir, "")]
+        while stack:
+            current, current_rel = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    is_file = entry.is_file(follow_symlinks=False)
+                except OSError:
+                    continue
+                rel_path = f"{current_rel}/{entry.name}" if current_rel else entry.name
+                if is_dir:
+                    if not entry.name.startswith(".") and not rules.is_ignored(rel_path, True):
+                        subdirs.append((entry.path, rel_path))
+                elif is_file and not rules.is_ignored(rel_path, False):
+                    yield entry.path, rel_path
+            stack.extend(reversed(subdirs))
+
+    def stream_zip(self, project_dir: str, root_name: str = "", store_only: bool = False) -> Iterator[bytes]:
+        """Generate a zip of a project block by block.
+
+        Args:
+            project_dir: Directory to export.
+            root_name: Optional top-level folder name for every entry.
+            store_only: Store files uncompressed, so export is bound by I/O rather than CPU.
+                Files with already-compressed extensions are always stored.
+
+        Yields:
+            Consecutive pieces of the archive.
+        """
+        sink = _StreamSink()
+        prefix = f"{root_name}/" if root_name else ""
+
+        with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+            for abs_path, rel_path in self.iter_files(project_dir):
+                try:
+                    source = open(abs_path, "rb")
+                except OSError:
+                    continue  # Removed or unreadable since the walk
+                with source:
+                    st = os.fstat(source.fileno())
+                    info = zipfile.ZipInfo(prefix + rel_path, date_time=time.localtime(max(st.st_mtime, 315619200))[:6])
+                    info.external_attr = (st.st_mode & 0xFFFF) << 16
+                    info.file_size = st.st_size
+                    if store_only or os.path.splitext(rel_path)[1].lower() in self.stored_extensions:
+                        info.compress_type = zipfile.ZIP_STORED
+                    else:
+                        info.compress_type = zipfile.ZIP_DEFLATED
+
+                    # Entries can't be patched afterwards on a stream, so decide on zip64 with headroom for growth
+                    force_zip64 = st.st_size > zipfile.ZIP64_LIMIT // 2
+                    with archive.open(info, "w", force_zip64=force_zip64) as dest:
+                        while True:
+                            block = source.read(self.block_bytes)
+                            if not block:
+                                break
+                            dest.write(block)
+                            if sink.size >= self.block_bytes:
+                                yield sink.drain()
+                if sink.size >= self.block_bytes:
+                    yield sink.drain()
+
+        # Central directory, with zip64 records when the archive needs them
+        yield sink.drain()
+
+
+# Create a singleton instance
+export_service = ExportService()
@@ -0,0 +1,205 @@
+import os
+import mmap
+import bisect
+import codecs
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any
+
+from metrics_service import metrics_service
+
+
+class _LineIndex:
+    """Sparse line index of a file: the number of newlines before the start of each fixed-size block.
+
+    Finding line N means a bisect over the blocks and a short scan inside one
+    block, so scrolling through a huge log never rescans it from the top, and
+    the index stays a few kilobytes even for gigabyte files.
+    """
+
+    def __init__(self, data, size: int, block_size: int):
+        self.block_size = block_size
+        self.size = size
+        self.block_starts: List[int] = []
+        newlines = 0
+        for offset in range(0, size, block_size):
+            self.block_starts.append(newlines)
+            newlines += data[offset:offset + block_size].count(b"\n")
+        self.newlines = newlines
+        ends_with_newline = size > 0 and data[size - 1:size] == b"\n"
+        self.total_lines = newlines + (1 if size and not ends_with_newline else 0)
+
+    def offset_of_line(self, data, line: int) -> int:
+        """Byte offset where a 0-based line starts (the file size past the last line)."""
+        if line <= 0:
+            return 0
+        if line > self.newlines:
+            return self.size
+        block = bisect.bisect_left(self.block_starts, line) - 1
+        position = block * self.block_size
+        for _ in range(line - self.block_starts[block]):
+            position = data.find(b"\n", position, self.size) + 1
+        return position
+
+
+class FileContentService:
+    """Reads file content for the editor with validators, ranges and paging.
+
+    Small text files are read whole. Larger ones are memory-mapped and served a
+    page of lines or bytes at a time through a cached sparse line index. Every
+    result carries an ETag built from the file's mtime, size and inode, so a
+    client re-opening a tab it already has gets a 304 without the file being
+    read at all. Binary files are detected from their first few kilobytes.
+    """
+
+    def __init__(self):
+        """Initialize the file content service."""
+        try:
+            from config import (FILE_CONTENT_MAX_BYTES, FILE_CONTENT_PAGE_LINES, FILE_CONTENT_PAGE_BYTES,
+                                FILE_CONTENT_SNIFF_BYTES, FILE_CONTENT_INDEX_CACHE)
+        except ImportError:
+            FILE_CONTENT_MAX_BYTES, FILE_CONTENT_PAGE_LINES, FILE_CONTENT_PAGE_BYTES = 1024 * 1024, 2000, 1024 * 1024
+            FILE_CONTENT_SNIFF_BYTES, FILE_CONTENT_INDEX_CACHE = 8192, 64
+
+        self.max_whole_bytes = FILE_CONTENT_MAX_BYTES
+        self.page_lines = FILE_CONTENT_PAGE_LINES
+        self.page_bytes = FILE_CONTENT_PAGE_BYTES
+        self.sniff_bytes = FILE_CONTENT_SNIFF_BYTES
+        self.index_cache_size = FILE_CONTENT_INDEX_CACHE
+        self.index_block = 64 * 1024
+        self.indexes = OrderedDict()  # abs path -> (etag, _LineIndex)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def etag(st: os.stat_result) -> str:
+        """Validator for one version of a file, from its inode, size and mtime."""
+        return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+    def is_binary(self, head: bytes) -> bool:
+        """Sniff a file's first bytes: NUL bytes or invalid UTF-8 mean binary."""
+        if b"\x00" in head:
+            return True
+        try:
+            # Incremental, so a multi-byte character cut off at the end of the sample is not an error
+            codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        except UnicodeDecodeError:
+            return True
+        return False
+
+    def _line_index(self, abs_path: str, etag: str, data, size: int) -> _LineIndex:
+        with self.lock:
+            cached = self.indexes.get(abs_path)
+            hit = bool(cached and cached[0] == etag)
+            metrics_service.cache_lookup("line_index", hit)
+            if hit:
+                self.indexes.move_to_end(abs_path)
+                return cached[1]
+
+        index = _LineIndex(data, size, self.index_block)
+        with self.lock:
+            self.indexes[abs_path] = (etag, index)
+            self.indexes.move_to_end(abs_path)
+            while len(self.indexes) > self.index_cache_size:
+                self.indexes.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _align(data, position: int, size: int) -> int:
+        """Move a byte offset forward past UTF-8 continuation bytes, so ranges never split a character."""
+        for _ in range(3):
+            if position >= size or data[position] & 0xC0 != 0x80:
+                break
+            position += 1
+        return position
+
+    def read(self, abs_path: str, start_line: Optional[int] = None, line_count: Optional[int] = None,
+             offset: Optional[int] = None, length: Optional[int] = None) -> Dict[str, Any]:
+        """Read a file whole, or a range of it.
+
+        Args:
+            abs_path: File to read.
+            start_line: First line (0-based) of a line range.
+            line_count: Number of lines to return, capped at the page size.
+            offset: First byte of a byte range. Ignored when start_line is given.
+            length: Number of bytes to return, capped at the page size.
+
+        Returns:
+            A dictionary with status "success" and the content, etag, size and
+            range returned (with has_more and where the next page starts), or
+            status "binary" for files that cannot be shown as text.
+
+        Raises:
+            OSError: If the file cannot be opened.
+        """
+        with open(abs_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = self.etag(st)
+            result = {"status": "success", "etag": etag, "size": size, "mtime": st.st_mtime}
+
+            head = f.read(min(self.sniff_bytes, size))
+            if self.is_binary(head):
+                return {"status": "binary", "etag": etag, "size": size, "mtime": st.st_mtime}
+
+            ranged = start_line is not None or offset is not None
+            if not ranged and size <= self.max_whole_bytes:
+                raw = head + f.read()
+                try:
+                    result["content"] = raw.decode("utf-8")
+                except UnicodeDecodeError:
+                    return {"status": "binary", "etag": etag, "size": size, "mtime": st.st_mtime}
+                result["has_more"] = False
+                return result
+
+            if size == 0:
+                result.update({"content": "", "start_line": 0, "end_line": 0, "total_lines": 0, "has_more": False})
+                return result
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if offset is not None and start_line is None:
+                    start = self._align(data, max(0, min(offset, size)), size)
+                    want = min(length if length and length > 0 else self.page_bytes, self.page_bytes)
+                    end = self._align(data, min(start + want, size), size)
+                    result.update({
+                        "content": data[start:end].decode("utf-8", errors="replace"),
+                        "offset": start,
+                        "end_offset": end,
+                        "has_more": end < size,
+                        "next_offset": end if end < size else None,
+                    })
+                    return result
+
+                # Line ranges, and the first page of files too big to return whole
+                index = self._line_index(abs_path, etag, data, size)
+                first = max(0, start_line or 0)
+                count = min(line_count if line_count and line_count > 0 else self.page_lines, self.page_lines)
+                last = min(first + count, index.total_lines)
+                start = index.offset_of_line(data, first)
+                end = index.offset_of_line(data, last)
+                partial = False
+                if end - start > self.page_bytes:
+                    # Very long lines: stop at the last whole line that fits, or cut a single line by bytes
+                    cut = data.rfind(b"\n", start, start + self.page_bytes) + 1
+                    if cut > start:
+                        end = cut
+                        last = first + data[start:end].count(b"\n")
+                    else:
+                        end = self._align(data, start + self.page_bytes, size)
+                        last = first
+                        partial = True
+
+                result.update({
+                    "content": data[start:end].decode("utf-8", errors="replace"),
+                    "start_line": first,
+                    "end_line": last,
+                    "total_lines": index.total_lines,
+                    "has_more": end < size,
+                    # A line cut short continues from next_offset as a byte range
+                    "next_line": last if end < size and not partial else None,
+                    "next_offset": end if partial else None,
+                })
+                return result
+
+
+# Create a singleton instance
+file_content_service = FileContentService()
@@ -0,0 +1,317 @@
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import posixpath
+from typing import Dict, List, Optional, Any, Tuple
+
+from file_utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ("create", "write", "mkdir", "move", "delete")
+
+
+class BatchError(Exception):
+    """Raised when a batch is rejected; index is the position of the offending operation."""
+
+    def __init__(self, message: str, index: Optional[int] = None):
+        super().__init__(message)
+        self.index = index
+
+
+class _Plan:
+    """What the project will look like part-way through a batch, for validating operations in order.
+
+    Entries touched by the batch are tracked explicitly; everything else is
+    looked up on disk, through the origin of any directory moved by the batch.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.entries: Dict[str, Optional[Tuple[str, Optional[str]]]] = {}  # path -> (kind, disk origin) or None
+
+    def lookup(self, path: str) -> Optional[Tuple[str, Optional[str]]]:
+        if path in self.entries:
+            return self.entries[path]
+        if path == "":
+            return ("dir", self.root)
+        parent = self.lookup(posixpath.dirname(path))
+        if parent is None or parent[0] != "dir" or parent[1] is None:
+            return None
+        real = os.path.join(parent[1], posixpath.basename(path))
+        if os.path.isdir(real):
+            return ("dir", real)
+        if os.path.lexists(real):
+            return ("file", real)
+        return None
+
+    def ensure_parents(self, path: str, index: int):
+        parent = posixpath.dirname(path)
+        missing = []
+        while parent:
+            entry = self.lookup(parent)
+            if entry is not None:
+                if entry[0] != "dir":
+                    raise BatchError(f"{parent} is a file, not a directory", index)
+                break
+            missing.append(parent)
+            parent = posixpath.dirname(parent)
+        for directory in missing:
+            self.entries[directory] = ("dir", None)
+
+    def move(self, source: str, target: str):
+        self.entries[target] = self.lookup(source)
+        prefix = source + "/"
+        for path in [p for p in self.entries if p.startswith(prefix)]:
+            self.entries[target + path[len(source):]] = self.entries.pop(path)
+        self.entries[source] = None
+
+
+def _fsync(path: str):
+    """Flush a file's data, or a directory's entries, to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileOpsService:
+    """Applies an ordered batch of file operations to a project as one transaction.
+
+    The whole batch is validated before anything is touched: paths, operation
+    types, and that each operation makes sense given the ones before it.
+    Operations are then applied in order with an undo journal. Deleted and
+    overwritten files are moved or hard-linked into a hidden trash directory
+    rather than destroyed, so if any operation fails every earlier one is
+    undone and the project is left exactly as it was.
+    """
+
+    def __init__(self):
+        """Initialize the file operations service."""
+        try:
+            from config import BATCH_MAX_OPERATIONS, BATCH_FSYNC
+        except ImportError:
+            BATCH_MAX_OPERATIONS, BATCH_FSYNC = 1000, True
+
+        self.max_operations = BATCH_MAX_OPERATIONS
+        self.fsync = BATCH_FSYNC
+
+    @staticmethod
+    def normalize_path(path: Any, index: int) -> str:
+        """A project-relative path in forward-slash form, rejecting anything that escapes the project."""
+        if not isinstance(path, str) or not path.strip() or "\0" in path:
+            raise BatchError("A non-empty path is required", index)
+        normalized = posixpath.normpath(path.replace("\\", "/").lstrip("/"))
+        if normalized in (".", "") or normalized == ".." or normalized.startswith("../"):
+            raise BatchError(f"Invalid path: {path}", index)
+        if any(part.startswith(".batch-") for part in normalized.split("/")):
+            raise BatchError(f"Reserved path: {path}", index)
+        return normalized
+
+    def validate(self, root: str, operations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Check a batch against the project and return it normalized.
+
+        Raises:
+            BatchError: For the first operation that is malformed or cannot apply.
+        """
+        if not isinstance(operations, list) or not operations:
+            raise BatchError("A non-empty list of operations is required")
+        if len(operations) > self.max_operations:
+            raise BatchError(f"A batch may have at most {self.max_operations} operations")
+
+        plan = _Plan(root)
+        normalized = []
+        for index, operation in enumerate(operations):
+            if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+                raise BatchError(f"Unknown operation; expected one of {', '.join(OPERATIONS)}", index)
+            kind = operation["op"]
+
+            if kind == "move":
+                source = self.normalize_path(operation.get("from"), index)
+                target = self.normalize_path(operation.get("to"), index)
+                entry = plan.lookup(source)
+                if entry is None:
+                    raise BatchError(f"{source} does not exist", index)
+                if target == source or target.startswith(source + "/"):
+                    raise BatchError(f"Cannot move {source} into itself", index)
+                overwrite = bool(operation.get("overwrite"))
+                existing = plan.lookup(target)
+                if existing is not None and (not overwrite or existing[0] == "dir"):
+                    raise BatchError(f"{target} already exists", index)
+                plan.ensure_parents(target, index)
+                plan.move(source, target)
+                normalized.append({"op": kind, "from": source, "to": target, "overwrite": overwrite})
+                continue
+
+            path = self.normalize_path(operation.get("path"), index)
+            entry = plan.lookup(path)
+            if kind in ("create", "write"):
+                content = operation.get("content", "")
+                if not isinstance(content, str):
+                    raise BatchError("content must be a string", index)
+                if entry is not None and entry[0] == "dir":
+                    raise BatchError(f"{path} is a directory", index)
+                if kind == "create" and entry is not None:
+                    raise BatchError(f"{path} already exists", index)
+                base_hash = operation.get("base_hash")
+                if base_hash:
+                    # Written against a known version, e.g. an AI suggestion: refuse if the file moved on
+                    if entry is None or entry[1] is None or self._hash(entry[1]) != base_hash:
+                        raise BatchError(f"{path} changed since this edit was made", index)
+                plan.ensure_parents(path, index)
+                plan.entries[path] = ("file", None)
+                normalized.append({"op": kind, "path": path, "content": content})
+            elif kind == "mkdir":
+                if entry is not None and entry[0] != "dir":
+                    raise BatchError(f"{path} is a file", index)
+                plan.ensure_parents(path, index)
+                if entry is None:
+                    plan.entries[path] = ("dir", None)
+                normalized.append({"op": kind, "path": path})
+            elif kind == "delete":
+                if entry is None:
+                    raise BatchError(f"{path} does not exist", index)
+                plan.entries[path] = None
+                for child in [p for p in plan.entries if p.startswith(path + "/")]:
+                    plan.entries[child] = None
+                normalized.append({"op": kind, "path": path})
+        return normalized
+
+    @staticmethod
+    def _hash(abs_path: str) -> Optional[str]:
+        try:
+            with open(abs_path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def apply(self, root: str, operations: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Validate and apply a batch, all or nothing.
+
+        Args:
+            root: Project root.
+            operations: Ordered operations, each one of
+                {"op": "create" | "write", "path", "content", "base_hash"?},
+                {"op": "mkdir", "path"}, {"op": "move", "from", "to", "overwrite"?},
+                {"op": "delete", "path"}. Paths are relative to the project root.
+
+        Returns:
+            A dictionary with status "success", the number of operations applied and
+            the paths written, created and removed (absolute), for updating derived state.
+
+        Raises:
+            BatchError: If the batch is invalid or an operation fails; nothing is changed then.
+        """
+        root = os.path.abspath(root)
+        operations = self.validate(root, operations)
+
+        trash = os.path.join(root, f".batch-{uuid.uuid4().hex}")
+        journal = []  # undo steps, applied in reverse on failure
+        counter = [0]
+
+        def trash_path():
+            os.makedirs(trash, exist_ok=True)
+            counter[0] += 1
+            return os.path.join(trash, str(counter[0]))
+
+        def make_parents(abs_path):
+            missing = []
+            parent = os.path.dirname(abs_path)
+            while not os.path.isdir(parent):
+                missing.append(parent)
+                parent = os.path.dirname(parent)
+            for directory in reversed(missing):
+                os.mkdir(directory)
+                journal.append(("rmdir", directory))
+
+        def set_aside(abs_path):
+            """Move an existing entry into the trash, to be restored on rollback."""
+            aside = trash_path()
+            os.rename(abs_path, aside)
+            journal.append(("restore", aside, abs_path))
+
+        written, removed = [], []
+        index = 0
+        try:
+            for index, operation in enumerate(operations):
+                kind = operation["op"]
+                if kind == "move":
+                    source = os.path.join(root, operation["from"])
+                    target = os.path.join(root, operation["to"])
+                    make_parents(target)
+                    if os.path.lexists(target):
+                        set_aside(target)
+                    os.rename(source, target)
+                    journal.append(("rename", target, source))
+                    removed.append(source)
+                    written.append(target)
+                    continue
+
+                abs_path = os.path.join(root, operation["path"])
+                if kind in ("create", "write"):
+                    make_parents(abs_path)
+                    if os.path.lexists(abs_path):
+                        # Keep the original content reachable through a hard link (or copy) until commit
+                        backup = trash_path()
+                        try:
+                            os.link(abs_path, backup)
+                        except OSError:
+                            shutil.copy2(abs_path, backup)
+                        journal.append(("restore", backup, abs_path))
+                    else:
+                        journal.append(("remove", abs_path))
+                    atomic_write(abs_path, operation["content"], fsync=False)
+                    written.append(abs_path)
+                elif kind == "mkdir":
+                    make_parents(abs_path)
+                    if not os.path.isdir(abs_path):
+                        os.mkdir(abs_path)
+                        journal.append(("rmdir", abs_path))
+                        written.append(abs_path)
+                elif kind == "delete":
+                    set_aside(abs_path)
+                    removed.append(abs_path)
+
+            if self.fsync:
+                # Only what this batch touched: the files written, and every directory with a changed entry
+                created = [step[1] for step in journal if step[0] == "rmdir"]
+                for path in dict.fromkeys(written):
+                    if os.path.isfile(path):
+                        _fsync(path)
+                for directory in dict.fromkeys(os.path.dirname(p) for p in written + removed + created):
+                    _fsync(directory)
+        except Exception as e:
+            self._rollback(journal)
+            shutil.rmtree(trash, ignore_errors=True)
+            raise BatchError(f"Operation {index} ({operations[index]['op']}) failed: {str(e)}; "
+                             "all changes were rolled back", index)
+
+        shutil.rmtree(trash, ignore_errors=True)
+        return {
+            "status": "success",
+            "applied": len(operations),
+            "written": [p for p in dict.fromkeys(written) if os.path.lexists(p)],
+            "removed": list(dict.fromkeys(removed)),
+        }
+
+    @staticmethod
+    def _rollback(journal: List[Tuple]):
+        for step in reversed(journal):
+            try:
+                if step[0] == "restore":
+                    os.replace(step[1], step[2])
+                elif step[0] == "rename":
+                    os.rename(step[1], step[2])
+                elif step[0] == "remove":
+                    os.remove(step[1])
+                elif step[0] == "rmdir":
+                    os.rmdir(step[1])
+            except OSError as e:
+                logger.error("Error rolling back batch step", extra={"step": step, "error": str(e)})
+
+
+# Create a singleton instance
+file_ops_service = FileOpsService()
@@ -0,0 +1,625 @@
+import os
+import sys
+import bisect
+import time
+import errno
+import struct
+import logging
+import ctypes
+import ctypes.util
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Any
+
+from ignore_rules import IgnoreRules, get_ignore_rules, to_rule_path
+from metrics_service import metrics_service
+
+logger = logging.getLogger(__name__)
+
+# inotify event flags, from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_CLOSE_WRITE = 0x00000008
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes. Raises OSError where inotify is unavailable."""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Block until events are available and return them as (wd, mask, cookie, name) tuples."""
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+
+class ProjectTree:
+    """In-memory directory tree of one project. Directories are dicts of child name to node; files are None."""
+
+    def __init__(self, root: str, history: int):
+        self.root = root
+        self.nodes = {}
+        # Versions start from the clock so that numbers from another process's tree (another worker,
+        # or before a restart) are never mistaken for this one's; the client is told to reset instead
+        self.version = time.time_ns() // 1000000
+        self.changes = deque(maxlen=history)  # (version, event) pairs
+        self.watched = False
+        self.rules = None  # IgnoreRules applied to this tree
+        self.structure_cache = None  # (version, structure)
+        self.files_cache = None  # (version, sorted file list)
+        self.invalidations = 0  # rebuilds asked for; served as is until the rebuild replaces it
+        self.rebuilding = False
+
+    def find(self, rel_dir: str, create: bool = False) -> Optional[Dict]:
+        """Return the dict for a directory, relative to the root ('' is the root)."""
+        node = self.nodes
+        if rel_dir in ("", "."):
+            return node
+        for part in rel_dir.split(os.sep):
+            child = node.get(part)
+            if child is None:
+                if not create or part in node:
+                    return None
+                child = node[part] = {}
+            node = child
+        return node
+
+
+def is_hidden(name: str) -> bool:
+    return name.startswith('.')
+
+
+def scan_directory(path: str, rules: Optional[IgnoreRules] = None, rel_dir: str = "") -> Dict:
+    """Build a tree for a directory with os.scandir, skipping hidden and ignored entries.
+
+    Ignored directories are never entered, so excluded subtrees cost nothing.
+    """
+    tree = {}
+    stack = [(path, rel_dir, tree)]
+    while stack:
+        current, current_rel, node = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if is_hidden(entry.name):
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    rel_path = f"{current_rel}/{entry.name}" if current_rel else entry.name
+                    if rules is not None and rules.is_ignored(rel_path, is_dir):
+                        continue
+                    if is_dir:
+                        child = node[entry.name] = {}
+                        stack.append((entry.path, rel_path, child))
+                    else:
+                        node[entry.name] = None
+        except OSError:
+            continue
+    return tree
+
+
+class FileTreeService:
+    """Per-project file trees kept in memory and current through inotify or our own write routes.
+
+    Trees are built once with os.scandir. On Linux an inotify watcher keeps them
+    in step with the disk; elsewhere, or if inotify can't be set up, the write
+    routes report their changes through notify_created/notify_deleted. Every
+    change is appended to a per-project change log that clients poll with a
+    version number instead of refetching the whole tree. Each worker process
+    keeps its own trees; a version from another process gets a reset.
+    """
+
+    def __init__(self):
+        """Initialize the file tree service."""
+        try:
+            from config import FILE_TREE_MAX_PROJECTS, FILE_TREE_HISTORY, FILE_TREE_USE_INOTIFY, FILE_TREE_MAX_LISTINGS
+        except ImportError:
+            FILE_TREE_MAX_PROJECTS, FILE_TREE_HISTORY, FILE_TREE_USE_INOTIFY = 16, 1000, True
+            FILE_TREE_MAX_LISTINGS = 2000
+
+        self.max_projects = FILE_TREE_MAX_PROJECTS
+        self.history = FILE_TREE_HISTORY
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.trees = OrderedDict()  # Absolute root -> ProjectTree, least recently used first
+        self.building = {}  # Absolute root -> event set once its first build finishes
+        self.watches = {}  # Watch descriptor -> (tree, directory relative to its root)
+        self.watch_ids = {}  # (root, relative directory) -> watch descriptor
+        self.listings = OrderedDict()  # (directory, rules fingerprint) -> (mtime, sorted listing), for the lazy tree API
+        self.max_listings = FILE_TREE_MAX_LISTINGS
+
+        self.inotify = None
+        if FILE_TREE_USE_INOTIFY:
+            try:
+                self.inotify = Inotify()
+                threading.Thread(target=self._watch_loop, name="file-tree-watcher", daemon=True).start()
+            except OSError as e:
+                logger.warning("inotify unavailable, file trees will follow write routes only", extra={"error": str(e)})
+                self.inotify = None
+
+    # Building and watching
+
+    def _get_tree(self, root: str) -> ProjectTree:
+        """Return the tree for a project, building it on first use.
+
+        Call without the lock held: the first build scans the whole project, which
+        runs without the lock, so saves and other projects' requests carry on.
+        Concurrent first requests for one project wait for the same build.
+        """
+        root = os.path.abspath(root)
+        first = True
+        while True:
+            with self.lock:
+                tree = self.trees.get(root)
+                if first:
+                    metrics_service.cache_lookup("file_tree", tree is not None)
+                    first = False
+                if tree is not None:
+                    self.trees.move_to_end(root)
+                    return tree
+                building = self.building.get(root)
+                if building is None:
+                    building = self.building[root] = threading.Event()
+                    break
+            building.wait()
+
+        try:
+            rules = get_ignore_rules(root)
+            nodes = scan_directory(root, rules)
+            with self.lock:
+                tree = ProjectTree(root, self.history)
+                tree.rules, tree.nodes = rules, nodes
+                self._watch_tree(tree)
+                self.trees[root] = tree
+
+                while len(self.trees) > self.max_projects:
+                    _, evicted = self.trees.popitem(last=False)
+                    self._unwatch_tree(evicted)
+                return tree
+        finally:
+            with self.lock:
+                del self.building[root]
+            building.set()
+
+    def _watch_tree(self, tree: ProjectTree):
+        if self.inotify is None:
+            return
+        try:
+            self._watch_subtree(tree, "", tree.nodes)
+            tree.watched = True
+        except OSError as e:
+            # Usually max_user_watches; fall back to write-route updates for this tree
+            logger.warning("Cannot watch project, falling back to write-route updates", extra={"root": tree.root, "error": str(e)})
+            self._unwatch_tree(tree)
+
+    def _watch_subtree(self, tree: ProjectTree, rel_dir: str, node: Dict):
+        stack = [(rel_dir, node)]
+        while stack:
+            current, current_node = stack.pop()
+            try:
+                wd = self.inotify.add_watch(os.path.join(tree.root, current) if current else tree.root)
+            except (FileNotFoundError, NotADirectoryError):
+                # Removed since it was scanned: skip it rather than stop watching the whole tree
+                continue
+            self.watches[wd] = (tree, current)
+            self.watch_ids[(tree.root, current)] = wd
+            for name, child in current_node.items():
+                if child is not None:
+                    stack.append((os.path.join(current, name) if current else name, child))
+
+    def _unwatch_tree(self, tree: ProjectTree):
+        for key in [k for k in self.watch_ids if k[0] == tree.root]:
+            wd = self.watch_ids.pop(key)
+            self.watches.pop(wd, None)
+            if self.inotify is not None:
+                self.inotify.rm_watch(wd)
+        tree.watched = False
+
+    def _watch_loop(self):
+        while True:
+            try:
+                events = self.inotify.read_events()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                logger.error("File tree watcher stopped", extra={"error": str(e)})
+                return
+            stale = set()
+            with self.lock:
+                for wd, mask, cookie, name in events:
+                    stale.update(self._handle_event(wd, mask, name))
+            # Rebuilds rescan the disk, so they run apart, without the lock and without holding up events
+            for root in stale:
+                threading.Thread(target=self.invalidate, args=(root,), name="file-tree-rebuild", daemon=True).start()
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> List[str]:
+        """Apply one inotify event. Call with the lock held.
+
+        Returns:
+            The roots of trees the event can't be applied to, which must be rebuilt.
+        """
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped; rebuild every tree from disk
+            return list(self.trees)
+        if mask & IN_IGNORED:
+            watched = self.watches.pop(wd, None)
+            if watched:
+                self.watch_ids.pop((watched[0].root, watched[1]), None)
+            return []
+
+        watched = self.watches.get(wd)
+        if watched is None or not name:
+            return []
+        tree, rel_dir = watched
+        if name == ".gitignore" and not rel_dir:
+            # The ignore rules changed; rebuild rather than patch
+            return [tree.root]
+        if is_hidden(name):
+            return []
+        rel_path = os.path.join(rel_dir, name) if rel_dir else name
+
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self._apply_created(tree, rel_path, bool(mask & IN_ISDIR))
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self._apply_deleted(tree, rel_path)
+        elif mask & IN_CLOSE_WRITE:
+            self._record(tree, {"type": "modified", "path": rel_path, "kind": "file"})
+        return []
+
+    # Applying changes
+
+    def _record(self, tree: ProjectTree, event: Dict[str, Any]):
+        tree.version += 1
+        tree.changes.append((tree.version, event))
+        self.changed.notify_all()
+
+    def _apply_created(self, tree: ProjectTree, rel_path: str, is_dir: bool):
+        parent = tree.find(os.path.dirname(rel_path), create=True)
+        if parent is None:
+            return
+        name = os.path.basename(rel_path)
+        if name in parent and (parent[name] is not None) == is_dir:
+            if not is_dir:
+                # An existing file replaced by a rename, as atomic writes do
+                self._record(tree, {"type": "modified", "path": rel_path, "kind": "file"})
+            return
+        rule_path = to_rule_path(rel_path)
+        if tree.rules is not None and tree.rules.is_ignored(rule_path, is_dir):
+            return
+
+        if is_dir:
+            # The directory may already have content, e.g. when it was moved in
+            parent[name] = scan_directory(os.path.join(tree.root, rel_path), tree.rules, rule_path)
+            if tree.watched:
+                try:
+                    self._watch_subtree(tree, rel_path, parent[name])
+                except OSError as e:
+                    logger.warning("Cannot watch directory", extra={"root": tree.root, "path": rel_path, "error": str(e)})
+        else:
+            parent[name] = None
+        self._record(tree, {"type": "created", "path": rel_path, "kind": "directory" if is_dir else "file"})
+
+    def _apply_deleted(self, tree: ProjectTree, rel_path: str):
+        parent = tree.find(os.path.dirname(rel_path))
+        name = os.path.basename(rel_path)
+        if parent is None or name not in parent:
+            return
+        node = parent.pop(name)
+        if node is not None:
+            # Forget watches below a removed directory; moved-away directories keep theirs otherwise
+            prefix = rel_path + os.sep
+            for key in [k for k in self.watch_ids if k[0] == tree.root and (k[1] == rel_path or k[1].startswith(prefix))]:
+                wd = self.watch_ids.pop(key)
+                self.watches.pop(wd, None)
+                if self.inotify is not None:
+                    self.inotify.rm_watch(wd)
+        self._record(tree, {"type": "deleted", "path": rel_path, "kind": "directory" if node is not None else "file"})
+
+    def _tree_for_path(self, abs_path: str):
+        """Find the loaded tree containing a path and the path relative to its root. Call with the lock held."""
+        abs_path = os.path.abspath(abs_path)
+        for root, tree in self.trees.items():
+            if abs_path.startswith(root + os.sep):
+                return tree, os.path.relpath(abs_path, root)
+        return None, None
+
+    # Write-route notifications, used when a tree is not watched
+
+    def notify_created(self, abs_path: str):
+        """Report a file or directory created or written by one of our routes."""
+        with self.lock:
+            tree, rel_path = self._tree_for_path(abs_path)
+            if tree is None or tree.watched:
+                return
+            if rel_path != ".gitignore":
+                if any(is_hidden(p) for p in rel_path.split(os.sep)):
+                    return
+                parent = tree.find(os.path.dirname(rel_path))
+                if parent is not None and os.path.basename(rel_path) in parent and not os.path.isdir(abs_path):
+                    self._record(tree, {"type": "modified", "path": rel_path, "kind": "file"})
+                else:
+                    self._apply_created(tree, rel_path, os.path.isdir(abs_path))
+                return
+        # The ignore rules changed; rebuild, outside the lock
+        self.invalidate(tree.root)
+
+    def notify_deleted(self, abs_path: str):
+        """Report a file or directory deleted by one of our routes."""
+        with self.lock:
+            tree, rel_path = self._tree_for_path(abs_path)
+            if tree is None or tree.watched:
+                return
+            self._apply_deleted(tree, rel_path)
+
+    def get_version(self, root: str) -> int:
+        """Current change-log version of a project's tree."""
+        tree = self._get_tree(root)
+        with self.lock:
+            return tree.version
+
+    def invalidate(self, root: str):
+        """Rebuild a project's tree from disk, or forget it if the project is gone. Clients are told to refetch.
+
+        The tree is marked stale and rescanned without holding the lock, so
+        requests for other projects, and reads of this one's current tree,
+        carry on meanwhile. Changes applied to the old tree during the scan are
+        replayed onto the rebuilt one; invalidations during it make it scan again.
+        """
+        root = os.path.abspath(root)
+        with self.lock:
+            tree = self.trees.get(root)
+            if tree is None:
+                return
+            tree.invalidations += 1
+            if tree.rebuilding:
+                return
+            tree.rebuilding = True
+
+        try:
+            while True:
+                with self.lock:
+                    requested, since = tree.invalidations, tree.version
+                rules = get_ignore_rules(root)
+                nodes = scan_directory(root, rules) if os.path.isdir(root) else None
+                with self.lock:
+                    if self.trees.get(root) is not tree:
+                        # Forgotten or evicted meanwhile
+                        return
+                    if tree.invalidations != requested:
+                        continue
+                    if tree.version > since and (not tree.changes or tree.changes[0][0] > since + 1):
+                        # More changed during the scan than the change log holds
+                        continue
+                    if nodes is None:
+                        self._unwatch_tree(tree)
+                        self.trees.pop(root)
+                        return
+                    rebuilt = ProjectTree(root, self.history)
+                    rebuilt.rules, rebuilt.nodes = rules, nodes
+                    # Keep the version sequence going so clients notice the reset
+                    rebuilt.version = tree.version
+                    # Watching a directory again gives back its descriptor, so events queued during the scan
+                    # land on the rebuilt tree; then drop the watches of directories it no longer has
+                    self._watch_tree(rebuilt)
+                    for key in [k for k in self.watch_ids if k[0] == root]:
+                        if self.watches.get(self.watch_ids[key], (None,))[0] is not rebuilt:
+                            wd = self.watch_ids.pop(key)
+                            self.watches.pop(wd, None)
+                            self.inotify.rm_watch(wd)
+                    self.trees[root] = rebuilt
+                    self._record(rebuilt, {"type": "reset", "path": "", "kind": "directory"})
+                    # The scan may have missed what changed while it ran; replaying what it did see changes nothing
+                    for version, event in tree.changes:
+                        if version <= since:
+                            continue
+                        if event["type"] == "created":
+                            self._apply_created(rebuilt, event["path"], event["kind"] == "directory")
+                        elif event["type"] == "deleted":
+                            self._apply_deleted(rebuilt, event["path"])
+                    return
+        finally:
+            with self.lock:
+                tree.rebuilding = False
+
+    def forget(self, path: str):
+        """Drop the trees of every project at or under path without rebuilding them, e.g. once they are removed."""
+        prefix = os.path.abspath(path)
+        with self.lock:
+            for root in [r for r in self.trees if r == prefix or r.startswith(prefix + os.sep)]:
+                self._unwatch_tree(self.trees.pop(root))
+
+    # Queries
+
+    def get_structure(self, root: str) -> List[Dict]:
+        """Return the nested structure served by /api/projects/<name>/files."""
+        tree = self._get_tree(root)
+        with self.lock:
+            if tree.structure_cache and tree.structure_cache[0] == tree.version:
+                return tree.structure_cache[1]
+
+            def build(node):
+                return [
+                    {'name': name, 'type': 'directory', 'children': build(child)} if child is not None
+                    else {'name': name, 'type': 'file'}
+                    for name, child in sorted(node.items())
+                ]
+
+            structure = build(tree.nodes)
+            tree.structure_cache = (tree.version, structure)
+            return structure
+
+    def list_files(self, root: str) -> List[str]:
+        """Return every file path in a project, relative to its root."""
+        tree = self._get_tree(root)
+        with self.lock:
+            if tree.files_cache and tree.files_cache[0] == tree.version:
+                return tree.files_cache[1]
+
+            files = []
+            stack = [("", tree.nodes)]
+            while stack:
+                prefix, node = stack.pop()
+                for name, child in node.items():
+                    path = os.path.join(prefix, name) if prefix else name
+                    if child is None:
+                        files.append(path)
+                    else:
+                        stack.append((path, child))
+            files.sort()
+            tree.files_cache = (tree.version, files)
+            return files
+
+    def list_directory(self, root: str, rel_dir: str = "", cursor: Optional[str] = None,
+                       limit: int = 200) -> Dict[str, Any]:
+        """Return one level of a directory, a page at a time, without walking anything below it.
+
+        Entries are sorted directories first, then by name. The sorted listing of
+        each directory is cached against its mtime, so paging through a huge
+        directory reads it from disk once.
+
+        Args:
+            root: The project root.
+            rel_dir: Directory to list, relative to root ('' for the root).
+            cursor: The next_cursor of the previous page, or None for the first page.
+            limit: Maximum number of entries to return.
+
+        Returns:
+            A dictionary with path, entries (name, type, has_children, child_count),
+            total and next_cursor (None on the last page).
+        """
+        root = os.path.abspath(root)
+        rules = get_ignore_rules(root)
+        rule_dir = to_rule_path(rel_dir.strip("/"))
+        listing = self._read_listing(os.path.join(root, rel_dir), rule_dir, rules)
+
+        start = 0
+        if cursor:
+            # Cursors are the sort key of the last entry returned, so pages stay stable while entries change
+            kind, _, name = cursor.partition(":")
+            start = bisect.bisect_right(listing, (kind != "d", name))
+
+        page = listing[start:start + limit]
+        entries = []
+        for is_file, name in page:
+            if not is_file:
+                child_rel = f"{rule_dir}/{name}" if rule_dir else name
+                children = self._read_listing(os.path.join(root, rel_dir, name), child_rel, rules)
+                entries.append({"name": name, "type": "directory",
+                                "has_children": bool(children), "child_count": len(children)})
+            else:
+                entries.append({"name": name, "type": "file", "has_children": False, "child_count": 0})
+
+        more = start + limit < len(listing)
+        return {
+            "path": rule_dir,
+            "entries": entries,
+            "total": len(listing),
+            "next_cursor": f"{'f' if page[-1][0] else 'd'}:{page[-1][1]}" if more and page else None,
+        }
+
+    def _read_listing(self, path: str, rule_dir: str, rules: IgnoreRules) -> List:
+        """(is file, name) pairs for one directory, directories first, cached against the directory's mtime."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        key = (path, rules.fingerprint)
+        with self.lock:
+            cached = self.listings.get(key)
+            if cached and cached[0] == mtime:
+                self.listings.move_to_end(key)
+                return cached[1]
+
+        listing = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if is_hidden(entry.name):
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if rules.is_ignored(f"{rule_dir}/{entry.name}" if rule_dir else entry.name, is_dir):
+                        continue
+                    listing.append((not is_dir, entry.name))
+        except OSError:
+            return []
+        listing.sort()
+
+        with self.lock:
+            self.listings[key] = (mtime, listing)
+            while len(self.listings) > self.max_listings:
+                self.listings.popitem(last=False)
+        return listing
+
+    def get_changes(self, root: str, since: int, timeout: float = 0) -> Dict[str, Any]:
+        """Return the changes after version `since`, waiting up to timeout seconds for one.
+
+        Returns:
+            A dictionary with the current version and the list of changes, or
+            reset=True when the requested version is too old and the client
+            should refetch the whole tree.
+        """
+        deadline = time.time() + timeout
+        tree = self._get_tree(root)
+        with self.lock:
+            while tree.version <= since and timeout > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+                # A rebuild replaces the tree; an evicted one is answered from as it was
+                tree = self.trees.get(tree.root, tree)
+
+            oldest = tree.changes[0][0] if tree.changes else tree.version + 1
+            if since > tree.version or (since < oldest - 1 and since < tree.version):
+                return {"version": tree.version, "reset": True, "changes": []}
+            return {
+                "version": tree.version,
+                "reset": False,
+                "changes": [dict(event, version=version) for version, event in tree.changes if version > since],
+            }
+
+# Create a singleton instance
+file_tree_service = FileTreeService()
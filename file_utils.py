@@ -0,0 +1,125 @@
+import os
+import stat
+import tempfile
+from typing import Dict, Union
+
+# The umask can only be read by setting it, which would race with files other threads create,
+# so it is read once, at import, and new files get the mode open() would have given them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_NEW_FILE_MODE = 0o666 & ~_UMASK
+
+
+def atomic_write(path: str, data: Union[str, bytes], fsync: bool = True, encoding: str = "utf-8"):
+    """Replace a file's content in one step by writing a temp file next to it and renaming it into place.
+
+    Readers see either the old or the new content, never a truncated file, and
+    a crash mid-write leaves the original untouched. The existing file's
+    permission bits are kept. Because the file is replaced rather than
+    rewritten, any hard links to the old content are left pointing at it.
+
+    Args:
+        path: File to write.
+        data: New content; str is encoded with encoding.
+        fsync: Flush the data (and the rename) to disk before returning.
+        encoding: Encoding for str content.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode(encoding)
+
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = _NEW_FILE_MODE
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def atomic_write_many(files: Dict[str, Union[str, bytes]], fsync: bool = True, encoding: str = "utf-8"):
+    """Replace several files together: either every file gets its new content or none does.
+
+    All new contents are first written to temp files next to their targets,
+    which is where almost every failure (disk full, permissions) happens.
+    Only then are they renamed into place, keeping a hard link to each
+    original so that a failed rename rolls the earlier ones back.
+
+    Args:
+        files: Target path -> new content.
+        fsync: Flush the temp files to disk before any is renamed into place.
+        encoding: Encoding for str content.
+    """
+    staged = []  # (path, temp path, backup path or None)
+    try:
+        for path, data in files.items():
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            if isinstance(data, str):
+                data = data.encode(encoding)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+            staged.append((path, temp_path, None))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if os.path.exists(path):
+                os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+                backup_path = f"{temp_path}.orig"
+                os.link(path, backup_path)
+                staged[-1] = (path, temp_path, backup_path)
+            else:
+                os.chmod(temp_path, _NEW_FILE_MODE)
+    except BaseException:
+        _discard(staged)
+        raise
+
+    replaced = []
+    try:
+        for path, temp_path, backup_path in staged:
+            os.replace(temp_path, path)
+            replaced.append((path, backup_path))
+    except BaseException:
+        for path, backup_path in reversed(replaced):
+            try:
+                if backup_path:
+                    os.replace(backup_path, path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+        _discard(staged)
+        raise
+    _discard(staged)
+
+
+def _discard(staged):
+    for _, temp_path, backup_path in staged:
+        for leftover in (temp_path, backup_path):
+            if leftover:
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
@@ -1,92 +1,104 @@
 import os
 import re
+import time
 import difflib
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple, Optional, Any
 from dotenv import load_dotenv
-import google.generativeai as genai
+from model_backends import create_backend, estimate_tokens
+from telemetry_service import telemetry_service, AIRequestTrace
+from job_service import check_cancelled
+
+logger = logging.getLogger(__name__)
 
 class GeminiService:
     def __init__(self):
         """Initialize the Gemini service."""
-        self.model = None
+        self.backend = None
+        self.model = None  # Name of the default model once the backend is ready
+        try:
+            from config import AI_MAX_CONCURRENCY
+        except ImportError:
+            AI_MAX_CONCURRENCY = 8
+        self.concurrency = threading.BoundedSemaphore(AI_MAX_CONCURRENCY)
+        # Model calls waiting for a slot and in progress, for the metrics gauges
+        self.calls = {"waiting": 0, "in_flight": 0}
+        self.calls_lock = threading.Lock()
         self.setup_api()
     
     def setup_api(self):
-        """Set up the Gemini API with the API key from environment variables."""
+        """Set up the model backend, reading the API key from environment variables when it is Gemini."""
         try:
             # Load environment variables from .env file
             load_dotenv()
             
+            try:
+                from config import MODEL_BACKEND
+            except (ImportError, AttributeError):
+                MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini")
+            
+            # The offline backends need no key
+            if MODEL_BACKEND != "gemini":
+                logger.info("Using offline model backend", extra={"backend": MODEL_BACKEND})
+                self.backend = create_backend(MODEL_BACKEND)
+                self.init_model()
+                return
+            
             # Try to get API key from config.py first
             api_key = None
             try:
                 from config import GOOGLE_API_KEY
                 api_key = GOOGLE_API_KEY
-                print("Using Google API key from config.py")
+                logger.info("Using Google API key from config.py")
             except (ImportError, AttributeError):
                 # Fall back to environment variable
                 api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
                 if api_key:
-                    print("Using Google API key from environment variables")
+                    logger.info("Using Google API key from environment variables")
             
             if not api_key or api_key == "your_api_key_here":
-                print("WARNING: No valid Google API key found. Please set GOOGLE_API_KEY in config.py or GEMINI_API_KEY in environment variables.")
+                logger.warning("No valid Google API key found. Please set GOOGLE_API_KEY in config.py or GEMINI_API_KEY in environment variables.")
                 return
             
             # Configure the API
-            genai.configure(api_key=api_key)
+            self.backend = create_backend("gemini", api_key)
             
             # Initialize the model
             self.init_model()
         except Exception as e:
-            print(f"Error setting up Gemini API: {str(e)}")
+            logger.error("Error setting up Gemini API", extra={"error": str(e)})
     
     def init_model(self, model_name: str = None):
-        """Initialize the Gemini model.
+        """Initialize the default model.
         
         Args:
             model_name: The name of the model to use. If None, uses the model from config.
         """
         try:
             from config import GEMINI_MODEL
-            
+        except ImportError:
+            logger.warning("config.py not found, using default model name 'gemini-pro'")
+            GEMINI_MODEL = "gemini-pro"
+        
+        try:
             # Use provided model name or fall back to config
             model_name = model_name or GEMINI_MODEL or "gemini-pro"
             
-            print(f"Initializing Gemini model: {model_name}")
+            logger.info("Initializing model", extra={"model": model_name})
+            self.backend.warm_up(model_name)
+            self.model = model_name
             
-            generation_config = {
-                "temperature": 0.2,
-                "top_p": 0.95,
-                "top_k": 0,
-                "max_output_tokens": 8192,
-            }
-            
-            self.model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config
-            )
-            
-            print("Gemini model initialized successfully")
-            
-        except ImportError:
-            print("Warning: config.py not found, using default model name 'gemini-pro'")
-            self.model = genai.GenerativeModel(
-                model_name="gemini-pro",
-                generation_config={
-                    "temperature": 0.2,
-                    "top_p": 0.95,
-                    "top_k": 0,
-                    "max_output_tokens": 8192,
-                }
-            )
+            logger.info("Model initialized", extra={"model": model_name})
         except Exception as e:
-            print(f"Error initializing Gemini model: {str(e)}")
+            logger.error("Error initializing model", extra={"model": model_name, "error": str(e)})
             self.model = None
     
     def get_code_suggestions(self, file_content: str, file_path: str, user_prompt: str, 
                              project_structure=None, selected_text=None, selected_range=None, 
-                             explanation_mode=False) -> Dict:
+                             explanation_mode=False, related_summaries=None) -> Dict:
         """Get code suggestions using the Gemini model.
         
         Args:
@@ -97,6 +109,8 @@ class GeminiService:
             selected_text: Optional selected portion of code to focus on.
             selected_range: Optional range information about the selection.
             explanation_mode: If True, focus on explaining the code rather than modifying it.
+            related_summaries: Optional mapping of related file paths to short summaries, used
+                as context in place of the files themselves.
             
         Returns:
             A dictionary containing:
@@ -105,14 +119,26 @@ class GeminiService:
             - diff: A unified diff between original and suggested code (if successful)
             - explanation: Explanation of the changes or code (if successful)
             - suggestion_for_selection: Only the modified selected text (if selection provided)
+            - usage: Model calls and prompt/output token counts for the request (if successful)
             - error: Error message (if error)
         """
-        if not self.model:
+        if not self.backend or not self.model:
             return {
                 "status": "error", 
                 "error": "Gemini model is not initialized. Please check your API key."
             }
         
+        # Determine if we're working with selected text or the whole file
+        is_selection_mode = selected_text and len(selected_text.strip()) > 0
+        if explanation_mode and is_selection_mode:
+            mode = "explanation"
+        elif is_selection_mode:
+            mode = "selection"
+        else:
+            mode = "whole_file"
+        project_name = project_structure.get('name') if project_structure else None
+        trace = telemetry_service.start_request(project_name, mode, file_path)
+        
         try:
             file_type = self._get_file_type(file_path)
             
@@ -131,20 +157,31 @@ class GeminiService:
                     for file in files[:50]:  # Limit to 50 files to avoid too long context
                         project_context += f"- {file}\n"
             
-            # Determine if we're working with selected text or the whole file
-            is_selection_mode = selected_text and len(selected_text.strip()) > 0
+            # Summaries of related files are a fraction of the tokens of the files themselves
+            if related_summaries:
+                project_context += "\nRELATED FILES (summaries):\n"
+                for related_path, summary in related_summaries.items():
+                    project_context += f"- {related_path}: {summary}\n"
             
             # Special handling for explanation mode
             if explanation_mode and is_selection_mode:
+                route = self._route_request("explanation", file_content, selected_text, user_prompt)
+                if route["prompt_variant"] == "compact":
+                    context_note = "Here's the code surrounding the selection to help you understand what the selected code does:"
+                    context_code = self._get_context_window(file_content, selected_text, selected_range)
+                else:
+                    context_note = "Here's the full context of the file to help you understand what the selected code does:"
+                    context_code = file_content
+                
                 # Create a prompt specifically for explaining the selected code
                 explanation_prompt = f"""
                 You are a helpful code explainer. You will be provided with a portion of a {file_type} file and a request to explain it.
                 
                 Your task is to analyze the selected code and provide a CONCISE explanation.
                 
-                The code is part of a larger file. Here's the full context of the file to help you understand what the selected code does:
+                The code is part of a larger file. {context_note}
                 ```
-                {file_content}
+                {context_code}
                 ```
                 
                 Now, focus on explaining this SELECTED PORTION of the code:
@@ -168,22 +205,31 @@ class GeminiService:
                 
                 # Generate explanation
                 try:
-                    explanation_response = self.model.generate_content(explanation_prompt)
+                    explanation_response = self._generate(route, explanation_prompt, trace)
                     explanation = explanation_response.text.strip()
                     
                     # No need for code suggestions in explanation mode
                     return {
                         "status": "success",
-                        "explanation": explanation
+                        "explanation": explanation,
+                        "usage": trace.usage
                     }
                 except Exception as e:
-                    print(f"Error getting explanation: {e}")
+                    logger.warning("Error getting explanation", extra={"error": str(e)})
                     return {
                         "status": "error",
                         "error": f"Failed to generate explanation: {str(e)}"
                     }
             
             elif is_selection_mode:
+                route = self._route_request("selection", file_content, selected_text, project_context, user_prompt)
+                if route["prompt_variant"] == "compact":
+                    context_note = "For context, here's the code surrounding the selection:"
+                    context_code = self._get_context_window(file_content, selected_text, selected_range)
+                else:
+                    context_note = "For context, here's the full file content:"
+                    context_code = file_content
+                
                 # Step 1: Get code suggestion for the selected text
                 selection_context = f"""
                 You are an expert code assistant. You will be provided with a portion of a {file_type} file and a request to modify or enhance it.
@@ -193,11 +239,11 @@ class GeminiService:
                 IMPORTANT: Your response should be ONLY the complete updated code for the selected portion.
                 DO NOT include any explanations, comments about what you changed, or markdown formatting.
                 
-                The selected code is part of a larger file. For context, here's the full file content:
+                The selected code is part of a larger file. {context_note}
                 ```
-                {file_content}
+                {context_code}
                 ```
-                
+                {project_context}
                 Now, focus ONLY on modifying this SELECTED PORTION of the code:
                 ```
                 {selected_text}
@@ -209,7 +255,7 @@ class GeminiService:
                 """
                 
                 # Generate code response for selection
-                code_response = self.model.generate_content(selection_context)
+                code_response = self._generate(route, selection_context, trace)
                 
                 # Extract code from response
                 suggestion_for_selection = self._extract_code(code_response.text)
@@ -241,10 +287,11 @@ class GeminiService:
                 
                 try:
                     # Generate explanation
-                    explanation_response = self.model.generate_content(explanation_prompt)
+                    explanation_route = self._route_request("explanation", selected_text, suggestion_for_selection)
+                    explanation_response = self._generate(explanation_route, explanation_prompt, trace)
                     explanation = explanation_response.text.strip()
                 except Exception as e:
-                    print(f"Error getting explanation: {e}")
+                    logger.warning("Error getting explanation", extra={"error": str(e)})
                     explanation = "Selected code was modified based on your request."
                 
                 return {
@@ -252,9 +299,12 @@ class GeminiService:
                     "suggestion": suggestion,
                     "suggestion_for_selection": suggestion_for_selection,
                     "diff": diff,
-                    "explanation": explanation
+                    "explanation": explanation,
+                    "usage": trace.usage
                 }
             else:
+                route = self._route_request("whole_file", file_content, project_context, user_prompt)
+                
                 # Process the whole file (existing code)
                 code_prompt = f"""
                 You are an expert code assistant. You will be provided with the content of a {file_type} file and a request to modify or enhance it.
@@ -277,7 +327,7 @@ class GeminiService:
                 """
                 
                 # Generate code response
-                code_response = self.model.generate_content(code_prompt)
+                code_response = self._generate(route, code_prompt, trace)
                 
                 # Extract code from response
                 suggestion = self._extract_code(code_response.text)
@@ -285,18 +335,14 @@ class GeminiService:
                 # Generate diff
                 diff = self._generate_diff(file_content, suggestion, file_path)
                 
-                # Step 2: Get explanation for the changes
+                # Step 2: Get explanation for the changes. The diff is enough for
+                # the model to describe what changed, and much smaller than both files.
                 explanation_prompt = f"""
                 You are a helpful coding assistant. You've just made changes to a {file_type} file.
                 
-                Original code:
-                ```
-                {file_content}
-                ```
-                
-                Modified code:
+                Unified diff of the changes:
                 ```
-                {suggestion}
+                {diff}
                 ```
                 
                 Explain the changes you made in response to this request: "{user_prompt}"
@@ -306,17 +352,19 @@ class GeminiService:
                 
                 try:
                     # Generate explanation
-                    explanation_response = self.model.generate_content(explanation_prompt)
+                    explanation_route = self._route_request("explanation", diff)
+                    explanation_response = self._generate(explanation_route, explanation_prompt, trace)
                     explanation = explanation_response.text.strip()
                 except Exception as e:
-                    print(f"Error getting explanation: {e}")
+                    logger.warning("Error getting explanation", extra={"error": str(e)})
                     explanation = "Code was modified based on your request."
                 
                 return {
                     "status": "success",
                     "suggestion": suggestion,
                     "diff": diff,
-                    "explanation": explanation
+                    "explanation": explanation,
+                    "usage": trace.usage
                 }
             
         except Exception as e:
@@ -324,6 +372,376 @@ class GeminiService:
                 "status": "error",
                 "error": f"Error generating code suggestions: {str(e)}"
             }
+        finally:
+            trace.finish()
+    
+    def get_multi_file_suggestions(self, user_prompt: str, files: Dict[str, str], project_name: str = None,
+                                   related_summaries: Dict[str, str] = None) -> Dict:
+        """Generate edits for several files at once, as one changeset.
+        
+        Each file is rewritten by its own model call. The calls run concurrently
+        and share the AI_MAX_CONCURRENCY limit with every other AI request. The
+        changeset is all or nothing: if any file fails, no edits are returned.
+        
+        Args:
+            user_prompt: The change the user wants, e.g. "rename load_config to read_config".
+            files: Mapping of file path to current content for every target file.
+            project_name: Optional project name, for telemetry.
+            related_summaries: Optional summaries of other project files, used as context.
+            
+        Returns:
+            A dictionary containing:
+            - status: "success" or "error"
+            - files: Per-file results with path, base_hash, suggestion, diff, additions,
+              deletions and changed (if successful)
+            - stats: Aggregate files_changed, additions and deletions (if successful)
+            - explanation: Explanation of the changeset (if successful)
+            - usage: Model calls and token counts summed over all files (if successful)
+            - error: Error message (if error)
+        """
+        if not self.backend or not self.model:
+            return {
+                "status": "error",
+                "error": "Gemini model is not initialized. Please check your API key."
+            }
+        if not files:
+            return {"status": "error", "error": "No target files"}
+        
+        try:
+            from config import AI_MAX_CONCURRENCY
+        except ImportError:
+            AI_MAX_CONCURRENCY = 8
+        
+        traces = []
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(files), AI_MAX_CONCURRENCY)) as executor:
+                futures = {
+                    path: executor.submit(self._suggest_file_edit, user_prompt, path, content,
+                                          list(files), project_name, related_summaries, traces)
+                    for path, content in files.items()
+                }
+                results = []
+                for path, future in futures.items():
+                    results.append(future.result())
+        except Exception as e:
+            return {
+                "status": "error",
+                "error": f"Error generating multi-file edits: {str(e)}"
+            }
+        
+        changed = [r for r in results if r["changed"]]
+        stats = {
+            "files": len(results),
+            "files_changed": len(changed),
+            "additions": sum(r["additions"] for r in results),
+            "deletions": sum(r["deletions"] for r in results),
+        }
+        
+        # One explanation for the whole changeset, from the (size-capped) combined diff
+        explanation = f"Changed {stats['files_changed']} of {stats['files']} files."
+        if changed:
+            combined_diff = "".join(r["diff"] for r in changed)[:20000]
+            explanation_prompt = f"""
+            You are a helpful coding assistant. You've just made a change across several files.
+            
+            Unified diff of the changes:
+            ```
+            {combined_diff}
+            ```
+            
+            Explain the changes you made in response to this request: "{user_prompt}"
+            
+            Keep your explanation brief (2-4 sentences) and focus on what was changed and why.
+            """
+            trace = telemetry_service.start_request(project_name, "multi_file", "")
+            traces.append(trace)
+            try:
+                explanation_route = self._route_request("explanation", combined_diff)
+                explanation = self._generate(explanation_route, explanation_prompt, trace).text.strip()
+            except Exception as e:
+                logger.warning("Error getting explanation", extra={"error": str(e)})
+            finally:
+                trace.finish()
+        
+        usage = {"calls": 0, "prompt_tokens": 0, "output_tokens": 0}
+        for trace in traces:
+            for key, value in trace.usage.items():
+                usage[key] += value
+        
+        return {
+            "status": "success",
+            "files": results,
+            "stats": stats,
+            "explanation": explanation,
+            "usage": usage
+        }
+    
+    def _suggest_file_edit(self, user_prompt: str, file_path: str, file_content: str, all_paths: List[str],
+                           project_name: str, related_summaries: Dict[str, str], traces: List) -> Dict:
+        """Rewrite one file of a multi-file change. Raises on failure so the whole changeset fails."""
+        trace = telemetry_service.start_request(project_name, "multi_file", file_path)
+        traces.append(trace)
+        try:
+            file_type = self._get_file_type(file_path)
+            other_files = "\n".join(f"- {path}" for path in all_paths if path != file_path)
+            summaries = ""
+            if related_summaries:
+                summaries = "\nRELATED FILES (summaries):\n" + "".join(
+                    f"- {path}: {summary}\n" for path, summary in related_summaries.items())
+            route = self._route_request("whole_file", file_content, other_files, summaries, user_prompt)
+            
+            code_prompt = f"""
+            You are an expert code assistant. A change is being made across several files of a project, and you are updating ONE of them.
+            
+            Your response should be ONLY the complete updated code of this file. If this file needs no changes, return it unchanged.
+            
+            DO NOT include any explanations, comments about what you changed, or markdown formatting.
+            
+            Maintain the same coding style, formatting, and comment style as the original code.
+            
+            OTHER FILES CHANGED TOGETHER WITH THIS ONE:
+            {other_files}
+            {summaries}
+            FILE: {file_path}
+            
+            CONTENT:
+            ```
+            {file_content}
+            ```
+            
+            REQUEST: {user_prompt}
+            """
+            
+            response = self._generate(route, code_prompt, trace)
+            suggestion = self._extract_code(response.text)
+            
+            # The model strips trailing newlines; don't report that as a change
+            if suggestion.strip() == file_content.strip():
+                suggestion = file_content
+            diff = self._generate_diff(file_content, suggestion, file_path)
+            diff_lines = diff.splitlines()
+            
+            return {
+                "path": file_path,
+                "base_hash": hashlib.sha256(file_content.encode("utf-8")).hexdigest(),
+                "suggestion": suggestion,
+                "diff": diff,
+                "changed": suggestion != file_content,
+                "additions": sum(1 for line in diff_lines if line.startswith('+') and not line.startswith('+++')),
+                "deletions": sum(1 for line in diff_lines if line.startswith('-') and not line.startswith('---')),
+            }
+        finally:
+            trace.finish()
+    
+    def get_inline_completion(self, prefix: str, suffix: str, file_path: str, project_name: str = None) -> Dict:
+        """Get a short completion to insert at the cursor, for ghost-text suggestions.
+        
+        Args:
+            prefix: The text before the cursor (already bounded by the caller).
+            suffix: The text after the cursor (already bounded by the caller).
+            file_path: The path of the current file.
+            project_name: Optional project name, for telemetry.
+            
+        Returns:
+            A dictionary containing:
+            - status: "success" or "error"
+            - completion: The text to insert at the cursor (if successful)
+            - model: The model that produced it (if successful)
+            - error: Error message (if error)
+        """
+        if not self.backend or not self.model:
+            return {
+                "status": "error",
+                "error": "Gemini model is not initialized. Please check your API key."
+            }
+        
+        trace = telemetry_service.start_request(project_name, "inline", file_path)
+        try:
+            file_type = self._get_file_type(file_path)
+            route = self._route_request("inline", prefix, suffix)
+            
+            completion_prompt = f"""You are a code completion engine for a {file_type} file. Output ONLY the text that belongs at <CURSOR>, with no explanation and no markdown. Complete at most the current statement or a few short lines. If nothing should be inserted, output nothing.
+{prefix}<CURSOR>{suffix}"""
+            
+            response = self._generate(route, completion_prompt, trace)
+            return {
+                "status": "success",
+                "completion": self._clean_completion(response.text, prefix, suffix),
+                "model": route["model"]
+            }
+        except Exception as e:
+            return {
+                "status": "error",
+                "error": f"Error generating completion: {str(e)}"
+            }
+        finally:
+            trace.finish()
+    
+    def summarize_file(self, file_content: str, file_path: str) -> Dict:
+        """Summarize a file's purpose, public API and key invariants for use as compact context.
+        
+        Args:
+            file_content: The content of the file.
+            file_path: The path of the file.
+            
+        Returns:
+            A dictionary containing:
+            - status: "success" or "error"
+            - summary: The summary (if successful)
+            - error: Error message (if error)
+        """
+        if not self.backend or not self.model:
+            return {
+                "status": "error",
+                "error": "Gemini model is not initialized. Please check your API key."
+            }
+        
+        trace = telemetry_service.start_request(None, "summary", file_path)
+        try:
+            file_type = self._get_file_type(file_path)
+            route = self._route_request("summary", file_content)
+            
+            summary_prompt = f"""
+            Summarize this {file_type} file for another engineer who will edit code that depends on it.
+            In at most 5 short lines, cover: its purpose, its public API (names and signatures), and key invariants or side effects.
+            Do not use markdown headings or code blocks.
+            
+            FILE: {file_path}
+            ```
+            {file_content}
+            ```
+            """
+            
+            response = self._generate(route, summary_prompt, trace)
+            return {
+                "status": "success",
+                "summary": " ".join(response.text.split())
+            }
+        except Exception as e:
+            return {
+                "status": "error",
+                "error": f"Error generating summary: {str(e)}"
+            }
+        finally:
+            trace.finish()
+    
+    def _route_request(self, mode: str, *inputs: str) -> Dict[str, Any]:
+        """Pick the model, output cap and prompt variant for a request.
+        
+        Args:
+            mode: The MODEL_ROUTES key: "explanation", "selection", "whole_file", "inline" (inline
+                completions) or "summary" (file summaries). A mode without routes gets the default model.
+            inputs: The pieces of text that will go into the prompt, used to estimate its size.
+            
+        Returns:
+            A dictionary with model, max_output_tokens, prompt_variant and estimated_input_tokens.
+        """
+        try:
+            from config import MODEL_ROUTES, CHARS_PER_TOKEN, GEMINI_MODEL
+        except ImportError:
+            MODEL_ROUTES, CHARS_PER_TOKEN, GEMINI_MODEL = {}, 4, "gemini-pro"
+        
+        input_chars = sum(len(text) for text in inputs if text)
+        estimated_tokens = input_chars // CHARS_PER_TOKEN
+        
+        route = {"model": GEMINI_MODEL, "max_output_tokens": 8192, "prompt_variant": "full"}
+        for rule in MODEL_ROUTES.get(mode, []):
+            limit = rule.get("max_input_tokens")
+            if limit is None or estimated_tokens <= limit:
+                route = {
+                    "model": rule.get("model", GEMINI_MODEL),
+                    "max_output_tokens": rule.get("max_output_tokens", 8192),
+                    "prompt_variant": rule.get("prompt_variant", "full"),
+                }
+                break
+        
+        route["mode"] = mode
+        route["estimated_input_tokens"] = estimated_tokens
+        return route
+    
+    def _count_call(self, state: str, delta: int):
+        with self.calls_lock:
+            self.calls[state] += delta
+
+    def _generate(self, route: Dict[str, Any], prompt: str, trace: AIRequestTrace = None):
+        """Run a prompt on the model selected by a route.
+        
+        Calls wait for a slot under AI_MAX_CONCURRENCY, which is shared by every
+        AI request in the process. Run from a job, a call that is cancelled
+        before it gets a slot is never made.
+        
+        Args:
+            route: A route returned by _route_request.
+            prompt: The full prompt text.
+            trace: Optional telemetry trace of the request this call belongs to.
+            
+        Returns:
+            The model response.
+        """
+        generation_config = {
+            "temperature": 0.2,
+            "top_p": 0.95,
+            "top_k": 0,
+            "max_output_tokens": route["max_output_tokens"],
+        }
+        queued = time.perf_counter()
+        self._count_call("waiting", 1)
+        try:
+            check_cancelled()
+            while not self.concurrency.acquire(timeout=0.25):
+                check_cancelled()
+        finally:
+            self._count_call("waiting", -1)
+        self._count_call("in_flight", 1)
+        try:
+            check_cancelled()
+            started = time.perf_counter()
+            try:
+                response = self.backend.generate(route["model"], prompt, generation_config)
+            except Exception:
+                if trace is not None:
+                    trace.add_call(route["model"], (started - queued) * 1000, (time.perf_counter() - started) * 1000,
+                                   estimate_tokens(prompt), 0, status="error")
+                raise
+            finished = time.perf_counter()
+        finally:
+            self.concurrency.release()
+            self._count_call("in_flight", -1)
+        
+        if trace is not None:
+            trace.add_call(route["model"], (started - queued) * 1000, (finished - started) * 1000,
+                           response.prompt_tokens, response.output_tokens)
+        return response
+    
+    def _get_context_window(self, file_content: str, selected_text: str, selected_range=None) -> str:
+        """Return the lines surrounding a selection, for the compact prompt variant.
+        
+        Args:
+            file_content: The entire file content.
+            selected_text: The selected text.
+            selected_range: Optional editor range with startRow and endRow.
+            
+        Returns:
+            The selection plus up to COMPACT_CONTEXT_LINES lines on either side.
+        """
+        try:
+            from config import COMPACT_CONTEXT_LINES
+        except ImportError:
+            COMPACT_CONTEXT_LINES = 40
+        
+        lines = file_content.splitlines()
+        if selected_range and "startRow" in selected_range and "endRow" in selected_range:
+            start_row, end_row = selected_range["startRow"], selected_range["endRow"]
+        else:
+            offset = file_content.find(selected_text)
+            if offset < 0:
+                return file_content
+            start_row = file_content.count("\n", 0, offset)
+            end_row = start_row + selected_text.count("\n")
+        
+        first = max(0, start_row - COMPACT_CONTEXT_LINES)
+        last = min(len(lines), end_row + COMPACT_CONTEXT_LINES + 1)
+        return "\n".join(lines[first:last])
     
     def _extract_code(self, text: str) -> str:
         """Extract code from the model's response, removing any markdown code blocks.
@@ -345,6 +763,39 @@ class GeminiService:
         # If no code blocks found, return the whole text
         return text.strip()
     
+    def _clean_completion(self, text: str, prefix: str, suffix: str) -> str:
+        """Strip markdown fences and echoed context from an inline completion.
+        
+        Unlike _extract_code, leading whitespace is kept since it is part of the insertion.
+        
+        Args:
+            text: The text response from the model.
+            prefix: The text before the cursor.
+            suffix: The text after the cursor.
+            
+        Returns:
+            The completion, limited to COMPLETION_MAX_LINES lines.
+        """
+        try:
+            from config import COMPLETION_MAX_LINES
+        except ImportError:
+            COMPLETION_MAX_LINES = 4
+        
+        lines = [line for line in text.split("\n") if not line.strip().startswith("```")]
+        completion = "\n".join(lines).rstrip()
+        
+        # Models sometimes repeat the end of the current line before completing it
+        current_line = prefix.rsplit("\n", 1)[-1]
+        if current_line.strip() and completion.startswith(current_line):
+            completion = completion[len(current_line):]
+        
+        # Don't duplicate text that already follows the cursor
+        next_text = suffix.split("\n", 1)[0]
+        if next_text.strip() and completion.endswith(next_text):
+            completion = completion[:-len(next_text)]
+        
+        return "\n".join(completion.split("\n")[:COMPLETION_MAX_LINES])
+    
     def _generate_diff(self, original: str, modified: str, file_path: str) -> str:
         """Generate a unified diff between original and modified code.
         
@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import difflib
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Union
+
+from chunk_store import ChunkStore
+from metrics_service import metrics_service
+
+
+class HistoryError(Exception):
+    """Raised when a revision does not exist or does not belong to the file asked about."""
+    pass
+
+
+def _split_lines(data: bytes) -> List[bytes]:
+    return data.splitlines(keepends=True)
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    """Encode target as a line delta against base.
+
+    The delta is a JSON list whose items are either [start, end], copying
+    lines start..end of base, or a string of new text. The unchanged head and
+    tail are trimmed before diffing, so an edit in one place costs one
+    SequenceMatcher pass over the lines in between.
+    """
+    base_lines = _split_lines(base)
+    target_lines = _split_lines(target)
+    head = 0
+    limit = min(len(base_lines), len(target_lines))
+    while head < limit and base_lines[head] == target_lines[head]:
+        head += 1
+    tail = 0
+    while (tail < limit - head and base_lines[len(base_lines) - 1 - tail] == target_lines[len(target_lines) - 1 - tail]):
+        tail += 1
+
+    ops = []
+    if head:
+        ops.append([0, head])
+    middle = difflib.SequenceMatcher(None, base_lines[head:len(base_lines) - tail],
+                                     target_lines[head:len(target_lines) - tail], autojunk=False)
+    for tag, i1, i2, j1, j2 in middle.get_opcodes():
+        if tag == "equal":
+            ops.append([head + i1, head + i2])
+        elif j2 > j1:
+            ops.append(b"".join(target_lines[head + j1:head + j2]).decode("utf-8"))
+    if tail:
+        ops.append([len(base_lines) - tail, len(base_lines)])
+    return zlib.compress(json.dumps(ops, separators=(",", ":")).encode("utf-8"))
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    base_lines = _split_lines(base)
+    parts = []
+    for op in json.loads(zlib.decompress(delta)):
+        if isinstance(op, str):
+            parts.append(op.encode("utf-8"))
+        else:
+            parts.extend(base_lines[op[0]:op[1]])
+    return b"".join(parts)
+
+
+class HistoryService:
+    """Saved revisions of project files, deduplicated and delta-compressed.
+
+    Each revision of a text file is stored as a line delta against the
+    revision before it, kept inline in SQLite, so a one-line change to a
+    large file costs a few dozen bytes. Every HISTORY_KEYFRAME_INTERVAL
+    revisions (and for binary files, or when a delta would not be smaller)
+    the full content is stored instead, zlib-compressed in a content-addressed
+    ChunkStore, so identical content saved anywhere is stored once and
+    rebuilding any revision applies a bounded number of deltas. A save with
+    the same content as the file's latest revision adds nothing, and saves
+    from the same source within HISTORY_COALESCE_SECONDS replace the latest
+    revision instead of adding one, so a burst of autosaves becomes one step
+    of history. Recording runs in a write transaction, so worker processes
+    sharing the database cannot both extend the same tip.
+    """
+
+    def __init__(self):
+        """Initialize the history service."""
+        try:
+            from config import (HISTORY_DIR, HISTORY_KEYFRAME_INTERVAL, HISTORY_COALESCE_SECONDS,
+                                HISTORY_MAX_FILE_BYTES, HISTORY_DELTA_MAX_BYTES)
+        except ImportError:
+            HISTORY_DIR = os.path.join(".cache", "history")
+            HISTORY_KEYFRAME_INTERVAL, HISTORY_COALESCE_SECONDS = 50, 30
+            HISTORY_MAX_FILE_BYTES, HISTORY_DELTA_MAX_BYTES = 16 * 1024 * 1024, 2 * 1024 * 1024
+
+        self.directory = HISTORY_DIR
+        self.keyframe_interval = HISTORY_KEYFRAME_INTERVAL
+        self.coalesce_seconds = HISTORY_COALESCE_SECONDS
+        self.max_file_bytes = HISTORY_MAX_FILE_BYTES
+        self.delta_max_bytes = HISTORY_DELTA_MAX_BYTES
+        self.store = None
+        self.connection = None
+        self.lock = threading.Lock()
+        self.tips = OrderedDict()  # abs path -> (revision id, hash, content) of its latest revision
+        self.max_tips = 64
+
+    def _db(self) -> sqlite3.Connection:
+        """The revision database, opened on first use. Call with the lock held."""
+        if self.connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.store = ChunkStore(os.path.join(self.directory, "objects"))
+            connection = sqlite3.connect(os.path.join(self.directory, "history.db"), timeout=30,
+                                         check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS revisions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, created REAL NOT NULL, "
+                "source TEXT NOT NULL, hash TEXT NOT NULL, size INTEGER NOT NULL, "
+                "object TEXT, base INTEGER, delta BLOB, depth INTEGER NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS revisions_path ON revisions (path, id)")
+            self.connection = connection
+        return self.connection
+
+    def _remember_tip(self, abs_path: str, revision_id: int, digest: str, data: bytes):
+        if len(data) > self.delta_max_bytes:
+            self.tips.pop(abs_path, None)
+            return
+        self.tips[abs_path] = (revision_id, digest, data)
+        self.tips.move_to_end(abs_path)
+        while len(self.tips) > self.max_tips:
+            self.tips.popitem(last=False)
+
+    def _content(self, revision_id: int) -> bytes:
+        """Rebuild a revision's content from its keyframe and the deltas after it. Call with the lock held."""
+        chain = []
+        current = revision_id
+        while True:
+            row = self._db().execute("SELECT object, base, delta FROM revisions WHERE id = ?", (current,)).fetchone()
+            if row is None:
+                raise HistoryError(f"Revision {revision_id} not found")
+            if row[0] is not None:
+                data = zlib.decompress(self.store.get(row[0]))
+                break
+            chain.append(row[2])
+            current = row[1]
+        for delta in reversed(chain):
+            data = apply_delta(data, delta)
+        return data
+
+    @staticmethod
+    def _is_text(data: bytes) -> bool:
+        if b"\0" in data[:8192]:
+            return False
+        try:
+            data.decode("utf-8")
+            return True
+        except UnicodeDecodeError:
+            return False
+
+    def record(self, abs_path: str, content: Union[str, bytes], source: str = "save") -> Optional[Dict[str, Any]]:
+        """Record content as the file's newest revision.
+
+        Args:
+            abs_path: The file saved.
+            content: Its new content.
+            source: What wrote it, e.g. "save", "ai" or "replace".
+
+        Returns:
+            The revision recorded (or extended, when coalesced), or None if the
+            file is too large to keep history for.
+        """
+        abs_path = os.path.abspath(abs_path)
+        data = content.encode("utf-8") if isinstance(content, str) else content
+        if len(data) > self.max_file_bytes:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+
+        with self.lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                revision = self._record(db, abs_path, data, digest, source, now)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            return revision
+
+    def _record(self, db: sqlite3.Connection, abs_path: str, data: bytes, digest: str, source: str,
+                now: float) -> Dict[str, Any]:
+        """Add or coalesce the revision. Call with the lock held, inside a write transaction."""
+        tip = db.execute("SELECT id, created, source, hash, base, object, depth FROM revisions "
+                         "WHERE path = ? ORDER BY id DESC LIMIT 1", (abs_path,)).fetchone()
+        if tip is not None and tip[3] == digest:
+            return self._revision_dict(tip[0])
+
+        # A quick follow-up save from the same source replaces the latest delta rather than adding one
+        coalesce = (tip is not None and tip[5] is None and tip[2] == source
+                    and now - tip[1] < self.coalesce_seconds)
+        base_id = tip[4] if coalesce else (tip[0] if tip is not None else None)
+        depth = (tip[6] if coalesce else tip[6] + 1) if tip is not None else 0
+
+        delta = None
+        if (base_id is not None and depth < self.keyframe_interval and len(data) <= self.delta_max_bytes
+                and self._is_text(data)):
+            # The cached tip may be stale if another process has coalesced into it since
+            cached = self.tips.get(abs_path)
+            base_hash = tip[3] if base_id == tip[0] else None
+            if cached and cached[0] == base_id and base_hash is None:
+                base_hash = db.execute("SELECT hash FROM revisions WHERE id = ?", (base_id,)).fetchone()[0]
+            hit = bool(cached and cached[0] == base_id and cached[1] == base_hash)
+            metrics_service.cache_lookup("history_tip", hit)
+            base_data = cached[2] if hit else self._content(base_id)
+            if self._is_text(base_data):
+                delta = make_delta(base_data, data)
+        keyframe = None
+        if delta is None:
+            keyframe = zlib.compress(data)
+        elif len(delta) > 1024:
+            # A rewrite rather than an edit: store whichever is smaller
+            compressed = zlib.compress(data)
+            if len(compressed) <= len(delta):
+                keyframe = compressed
+
+        if keyframe is not None:
+            values = (now, source, digest, len(data), self.store.put(keyframe), None, None, 0)
+        else:
+            values = (now, source, digest, len(data), None, base_id, delta, depth)
+        if coalesce:
+            revision_id = tip[0]
+            db.execute("UPDATE revisions SET created = ?, source = ?, hash = ?, size = ?, object = ?, "
+                       "base = ?, delta = ?, depth = ? WHERE id = ?", values + (revision_id,))
+        else:
+            revision_id = db.execute("INSERT INTO revisions (created, source, hash, size, object, base, delta, "
+                                     "depth, path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     values + (abs_path,)).lastrowid
+        self._remember_tip(abs_path, revision_id, digest, data)
+        return self._revision_dict(revision_id)
+
+    def ensure_baseline(self, abs_path: str):
+        """Record a file's content on disk as its first revision if it has no history yet, so its first change can be undone."""
+        abs_path = os.path.abspath(abs_path)
+        with self.lock:
+            if self._db().execute("SELECT 1 FROM revisions WHERE path = ? LIMIT 1", (abs_path,)).fetchone():
+                return
+        try:
+            if os.path.getsize(abs_path) > self.max_file_bytes:
+                return
+            with open(abs_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        self.record(abs_path, data, source="original")
+
+    def _revision_dict(self, revision_id: int) -> Dict[str, Any]:
+        row = self._db().execute("SELECT id, created, source, hash, size, object, LENGTH(delta) FROM revisions "
+                                 "WHERE id = ?", (revision_id,)).fetchone()
+        return self._row_dict(row)
+
+    @staticmethod
+    def _row_dict(row) -> Dict[str, Any]:
+        return {"id": row[0], "created": row[1], "source": row[2], "hash": row[3], "size": row[4],
+                "stored": "keyframe" if row[5] is not None else "delta", "delta_bytes": row[6] or 0}
+
+    def history(self, abs_path: str, limit: int = 100, before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """A file's revisions, newest first; pass the last id seen as before for the next page."""
+        with self.lock:
+            rows = self._db().execute(
+                "SELECT id, created, source, hash, size, object, LENGTH(delta) FROM revisions "
+                "WHERE path = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (os.path.abspath(abs_path), before if before is not None else 2 ** 62, limit)).fetchall()
+        return [self._row_dict(row) for row in rows]
+
+    def content(self, abs_path: str, revision_id: int) -> bytes:
+        """A revision's content.
+
+        Raises:
+            HistoryError: If the revision is not one of abs_path's.
+        """
+        with self.lock:
+            row = self._db().execute("SELECT path FROM revisions WHERE id = ?", (revision_id,)).fetchone()
+            if row is None or row[0] != os.path.abspath(abs_path):
+                raise HistoryError(f"Revision {revision_id} not found")
+            return self._content(revision_id)
+
+    def diff(self, abs_path: str, from_revision: int, to_revision: Optional[int] = None,
+             current: Optional[bytes] = None, context: int = 3) -> Dict[str, Any]:
+        """Unified diff between two revisions, or from a revision to the current content.
+
+        Returns:
+            A dictionary with the diff text and the number of lines added and removed,
+            or binary: True if either side is not text.
+        """
+        before = self.content(abs_path, from_revision)
+        after = self.content(abs_path, to_revision) if to_revision is not None else (current or b"")
+        to_label = f"r{to_revision}" if to_revision is not None else "current"
+        if not (self._is_text(before) and self._is_text(after)):
+            return {"from": from_revision, "to": to_label, "binary": True, "identical": before == after}
+
+        lines = list(difflib.unified_diff(before.decode("utf-8").splitlines(keepends=True),
+                                          after.decode("utf-8").splitlines(keepends=True),
+                                          fromfile=f"r{from_revision}", tofile=to_label, n=context))
+        added = sum(1 for line in lines if line.startswith("+") and not line.startswith("+++"))
+        removed = sum(1 for line in lines if line.startswith("-") and not line.startswith("---"))
+        return {"from": from_revision, "to": to_label, "binary": False, "diff": "".join(lines),
+                "added": added, "removed": removed}
+
+    def forget(self, abs_path: str):
+        """Drop the history of a file or of everything under a directory, and keyframes no longer used."""
+        prefix = os.path.abspath(abs_path)
+        with self.lock:
+            db = self._db()
+            pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%"
+            where = "path = ? OR path LIKE ? ESCAPE '\\'"
+            objects = {row[0] for row in db.execute(f"SELECT DISTINCT object FROM revisions WHERE ({where}) "
+                                                    "AND object IS NOT NULL", (prefix, pattern))}
+            db.execute(f"DELETE FROM revisions WHERE {where}", (prefix, pattern))
+            for digest in objects:
+                if db.execute("SELECT 1 FROM revisions WHERE object = ? LIMIT 1", (digest,)).fetchone() is None:
+                    try:
+                        os.remove(self.store.path(digest))
+                    except OSError:
+                        pass
+            for path in [p for p in self.tips if p == prefix or p.startswith(prefix + os.sep)]:
+                del self.tips[path]
+
+
+# Create a singleton instance
+history_service = HistoryService()
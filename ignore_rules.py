@@ -0,0 +1,133 @@
+import os
+import re
+import hashlib
+import threading
+from typing import List, Optional, Tuple
+
+
+def _translate(pattern: str) -> str:
+    """Translate the body of a .gitignore glob into a regular expression."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                regex += re.escape(char)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body}]"
+                i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+        i += 1
+    return regex
+
+
+class IgnoreRules:
+    """A list of .gitignore-style rules. The last matching rule wins; "!" rules un-ignore."""
+
+    def __init__(self, patterns: List[str]):
+        self.rules: List[Tuple[re.Pattern, bool, bool]] = []  # (regex, negated, directories only)
+        self.digest = hashlib.sha1()
+        for line in patterns:
+            self.add(line)
+
+    def add(self, line: str):
+        line = line.rstrip("\n")
+        if not line.strip() or line.startswith("#"):
+            return
+        line = line.rstrip()
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return
+
+        # A slash anywhere but the end anchors the pattern to the root
+        anchored = "/" in line
+        line = line.lstrip("/")
+        prefix = "^" if anchored else "^(?:.*/)?"
+        self.rules.append((re.compile(prefix + _translate(line) + "$"), negated, dir_only))
+        self.digest.update(f"{negated:d}{dir_only:d}{prefix}{line}\n".encode("utf-8"))
+
+    @property
+    def fingerprint(self) -> str:
+        """A hash of the rules, equal for rule sets that ignore the same paths however they were loaded."""
+        return self.digest.hexdigest()
+
+    def is_ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """Check a path relative to the project root, using forward slashes."""
+        ignored = False
+        for regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                ignored = not negated
+        return ignored
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_ignore_rules(project_dir: str) -> IgnoreRules:
+    """Return the configured default rules plus the project's root .gitignore, cached by its mtime."""
+    try:
+        from config import IGNORE_DEFAULTS
+    except ImportError:
+        IGNORE_DEFAULTS = ["node_modules/", "__pycache__/", "venv/", ".venv/", "*.pyc"]
+
+    project_dir = os.path.abspath(project_dir)
+    gitignore = os.path.join(project_dir, ".gitignore")
+    try:
+        mtime: Optional[int] = os.stat(gitignore).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    with _cache_lock:
+        cached = _cache.get(project_dir)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    patterns = list(IGNORE_DEFAULTS)
+    if mtime is not None:
+        try:
+            with open(gitignore, "r", encoding="utf-8", errors="replace") as f:
+                patterns.extend(f.readlines())
+        except OSError:
+            pass
+    rules = IgnoreRules(patterns)
+
+    with _cache_lock:
+        _cache[project_dir] = (mtime, rules)
+    return rules
+
+
+def to_rule_path(rel_path: str) -> str:
+    """Convert an OS relative path to the forward-slash form rules match against."""
+    return rel_path.replace(os.sep, "/")
@@ -0,0 +1,349 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """Raised when a job cannot be submitted; status is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 503, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class JobCancelled(BaseException):
+    """Raised inside a job's function once the job has been cancelled.
+
+    Like KeyboardInterrupt it is not an Exception, so the broad `except Exception`
+    handlers around model calls let it through to the job runner.
+    """
+    pass
+
+
+_current = threading.local()
+
+
+def current_job() -> Optional["Job"]:
+    """The job running on this thread, if any."""
+    return getattr(_current, "job", None)
+
+
+def check_cancelled():
+    """Raise JobCancelled if the job running on this thread has been cancelled. Does nothing outside a job.
+
+    Long-running code called from jobs (model calls, waits for a slot) calls this
+    between steps, so work for a client that gave up stops at the next one.
+    """
+    job = current_job()
+    if job is not None and job.cancelled():
+        raise JobCancelled()
+
+
+FINISHED = ("done", "error", "cancelled")
+
+
+class Job:
+    """One submitted piece of work: its state, progress events and result."""
+
+    def __init__(self, service: "JobService", kind: str, owner: Optional[str], detached: bool):
+        self.service = service
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.owner = owner
+        self.detached = detached
+        self.state = "queued"  # queued, running, done, error, cancelled
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.last_seen = self.created
+        self.seq = 0
+        self.events = deque(maxlen=service.max_events)  # (seq, data), oldest first
+        self.cancel_event = threading.Event()
+        self.cancel_checked = 0.0
+        self.published_at = 0.0
+
+    def report(self, **data):
+        """Add a progress event, e.g. job.report(output="...") or job.report(stage="generating")."""
+        with self.service.condition:
+            self.seq += 1
+            self.events.append((self.seq, data))
+            self.service.condition.notify_all()
+        self.service.publish(self, force=False)
+
+    def cancelled(self) -> bool:
+        """Whether the job has been cancelled, here or (with a shared store) through another worker process."""
+        if self.cancel_event.is_set():
+            return True
+        store = self.service.store
+        if store is not None and time.time() - self.cancel_checked > 0.5:
+            self.cancel_checked = time.time()
+            if store.get("job-cancel", self.id):
+                self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "owner": self.owner,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "elapsed": round((self.finished or time.time()) - (self.started or self.created), 3),
+            "seq": self.seq,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobService:
+    """Runs long requests (model calls, program executions) in the background.
+
+    Submitting returns a job id at once; the client polls the job, or streams
+    its progress events, until it finishes, and the result is kept for
+    JOB_RESULT_TTL seconds after that. At most JOB_MAX_BACKLOG jobs wait for
+    one of the JOB_WORKERS threads; beyond that, submissions are refused
+    rather than queued without bound. A job can be cancelled while queued
+    (it never runs) or while running, which sets a flag its function checks
+    between steps (see check_cancelled). Jobs nobody has polled for
+    JOB_ABANDON_SECONDS are cancelled as abandoned, unless submitted detached,
+    so a client or proxy that gave up does not keep a model call queued or a
+    program running.
+
+    With several worker processes (use_shared_store), each job runs in the
+    process it was submitted to, which publishes its state and events to the
+    shared store; any other process can answer polls and streams from there
+    and cancels through a flag the running process checks.
+    """
+
+    def __init__(self):
+        """Initialize the job service."""
+        try:
+            from config import JOB_WORKERS, JOB_MAX_BACKLOG, JOB_RESULT_TTL, JOB_ABANDON_SECONDS, JOB_MAX_EVENTS
+        except ImportError:
+            JOB_WORKERS, JOB_MAX_BACKLOG, JOB_RESULT_TTL, JOB_ABANDON_SECONDS, JOB_MAX_EVENTS = 4, 64, 600, 60, 500
+
+        self.workers = JOB_WORKERS
+        self.result_ttl = JOB_RESULT_TTL
+        self.abandon_seconds = JOB_ABANDON_SECONDS
+        self.max_events = JOB_MAX_EVENTS
+        self.queue = queue.Queue(maxsize=JOB_MAX_BACKLOG)
+        self.jobs: Dict[str, Job] = {}
+        self.condition = threading.Condition()
+        self.threads: List[threading.Thread] = []
+        self.store = None
+
+    def use_shared_store(self, store):
+        """Publish jobs to store, so that every worker process can report on and cancel them."""
+        self.store = store
+
+    def _start_threads(self):
+        """Start the worker threads and the reaper on first use. Call with the condition held."""
+        if self.threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        reaper = threading.Thread(target=self._reap_loop, name="job-reaper", daemon=True)
+        reaper.start()
+        self.threads.append(reaper)
+
+    def submit(self, kind: str, function: Callable[[Job], Any], owner: Optional[str] = None,
+               detached: bool = False) -> Job:
+        """Queue function(job) to run in the background.
+
+        Args:
+            kind: What the job does, e.g. "code-suggestion" or "execute-command".
+            function: Called with the job; its return value (JSON-serializable) is the result.
+            owner: Workspace the job belongs to; only it can see or cancel the job.
+            detached: Keep running even if nobody polls it.
+
+        Raises:
+            JobError: If JOB_MAX_BACKLOG jobs are already waiting.
+        """
+        job = Job(self, kind, owner, detached)
+        with self.condition:
+            self._start_threads()
+            try:
+                self.queue.put_nowait((job, function))
+            except queue.Full:
+                raise JobError("Too many jobs are waiting; try again shortly", status=503, retry_after=5)
+            self.jobs[job.id] = job
+        self.publish(job)
+        return job
+
+    def _work(self):
+        while True:
+            job, function = self.queue.get()
+            if job.cancelled() and job.state not in FINISHED:
+                self._finish(job, "cancelled")
+            with self.condition:
+                if job.state in FINISHED:
+                    continue  # Cancelled while it waited
+                job.state = "running"
+                job.started = time.time()
+                self.condition.notify_all()
+            self.publish(job)
+
+            _current.job = job
+            try:
+                result = function(job)
+                self._finish(job, "cancelled" if job.cancelled() else "done", result=result)
+            except JobCancelled:
+                self._finish(job, "cancelled")
+            except Exception as e:
+                logger.exception("Error in job", extra={"kind": job.kind, "job_id": job.id})
+                self._finish(job, "error", error=str(e))
+            finally:
+                _current.job = None
+
+    def _finish(self, job: Job, state: str, result: Any = None, error: Optional[str] = None):
+        with self.condition:
+            job.state = state
+            job.result = result
+            job.error = error
+            job.finished = time.time()
+            self.condition.notify_all()
+        self.publish(job)
+
+    def publish(self, job: Job, force: bool = True):
+        """Write a job's state and recent events to the shared store, if there is one."""
+        if self.store is None or (not force and time.time() - job.published_at < 0.25):
+            return
+        job.published_at = time.time()
+        with self.condition:
+            state = dict(job.to_dict(), events=list(job.events))
+        # Unfinished jobs are republished by the reaper, so their entries outlive their process only briefly
+        self.store.set("jobs", job.id, state, ttl=self.result_ttl if job.finished else max(60, self.abandon_seconds * 2))
+
+    # Queries
+
+    def _touch(self, job_id: str, job: Optional[Job]):
+        if job is not None:
+            job.last_seen = time.time()
+        elif self.store is not None:
+            self.store.set("job-seen", job_id, time.time(), ttl=max(60, self.abandon_seconds * 2))
+
+    def _snapshot(self, job_id: str, owner: Optional[str]) -> Optional[Dict[str, Any]]:
+        """A job's state with its kept events, from this process or the shared store."""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                state = dict(job.to_dict(), events=list(job.events))
+        if job is None and self.store is not None:
+            state = self.store.get("jobs", job_id)
+            if state is not None:
+                state["events"] = [tuple(event) for event in state["events"]]
+        elif job is None:
+            state = None
+        if state is None or state["owner"] != owner:
+            return None
+        self._touch(job_id, job)
+        return state
+
+    def get(self, job_id: str, owner: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """A job's state and, once finished, its result. None if there is no such job for this owner."""
+        state = self._snapshot(job_id, owner)
+        if state is not None:
+            del state["events"]
+        return state
+
+    def wait(self, job_id: str, owner: Optional[str] = None, after: int = 0,
+             timeout: float = 30) -> Optional[Dict[str, Any]]:
+        """Wait up to timeout seconds for events after seq `after`, or for the job to finish.
+
+        Returns:
+            The job's state with `events`: a list of {"seq", ...data} after `after`,
+            or None if there is no such job for this owner.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is not None and job.owner == owner:
+                    while job.seq <= after and job.state not in FINISHED and time.time() < deadline:
+                        self.condition.wait(deadline - time.time())
+            state = self._snapshot(job_id, owner)
+            if state is None:
+                return None
+            if job is not None or state["seq"] > after or state["state"] in FINISHED or time.time() >= deadline:
+                break
+            time.sleep(0.2)  # Running in another worker process: poll the shared store
+        state["events"] = [dict(data, seq=seq) for seq, data in state["events"] if seq > after]
+        return state
+
+    def list(self, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """This process's jobs for an owner, newest first."""
+        with self.condition:
+            jobs = [job.to_dict() for job in self.jobs.values() if job.owner == owner]
+        for job in jobs:
+            del job["result"]
+        return sorted(jobs, key=lambda job: job["created"], reverse=True)
+
+    def stats(self) -> Dict[str, int]:
+        """How many of this process's jobs are waiting for a worker thread and running."""
+        with self.condition:
+            states = [job.state for job in self.jobs.values()]
+        return {"queued": states.count("queued"), "running": states.count("running")}
+
+    def cancel(self, job_id: str, owner: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Cancel a job. Returns its state, or None if there is no such job for this owner."""
+        with self.condition:
+            job = self.jobs.get(job_id)
+        state = self.get(job_id, owner)
+        if state is None:
+            return None
+        if state["state"] not in FINISHED:
+            if job is not None:
+                self._cancel(job)
+            else:
+                self.store.set("job-cancel", job_id, True, ttl=self.result_ttl)
+            state["state"] = "cancelling"
+        return state
+
+    def _cancel(self, job: Job):
+        """Cancel a job of this process: a queued one finishes at once, a running one at its next check."""
+        job.cancel_event.set()
+        with self.condition:
+            if job.state == "queued":
+                self._finish(job, "cancelled")
+
+    # Expiry
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(5)
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Error reaping jobs")
+
+    def reap(self):
+        """Drop results past JOB_RESULT_TTL and cancel jobs nobody has polled for JOB_ABANDON_SECONDS."""
+        now = time.time()
+        with self.condition:
+            for job_id in [i for i, job in self.jobs.items() if job.finished and now - job.finished > self.result_ttl]:
+                del self.jobs[job_id]
+            unfinished = [job for job in self.jobs.values() if job.finished is None]
+        for job in unfinished:
+            if not job.detached and now - job.last_seen > self.abandon_seconds:
+                seen = self.store.get("job-seen", job.id) if self.store is not None else None
+                if seen is None or now - seen > self.abandon_seconds:
+                    logger.info("Cancelling abandoned job", extra={"kind": job.kind, "job_id": job.id})
+                    self._cancel(job)
+            self.publish(job)
+
+
+# Create a singleton instance
+job_service = JobService()
@@ -0,0 +1,138 @@
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Optional
+
+# Attributes every LogRecord has; anything else on a record was passed in `extra` and is logged as a field
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, the fields passed in `extra`, and any exception."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for development, with the `extra` fields appended as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = " ".join(f"{key}={value}" for key, value in vars(record).items()
+                          if key not in _STANDARD_ATTRIBUTES and not key.startswith("_"))
+        return f"{line} {fields}" if fields else line
+
+
+class LogService:
+    """Structured logging for the whole server, written by a background thread.
+
+    Modules log through logging.getLogger(__name__) with the details of an event
+    passed as fields (logger.warning("Error writing file", extra={"path": p})).
+    configure() routes every record through a queue to a listener thread that
+    formats and writes it, as JSON lines (LOG_FORMAT = "json") or readable text,
+    to stderr and optionally a rotating LOG_PATH, so request threads never wait
+    on the terminal or the disk. The queue is drained at exit.
+    """
+
+    def __init__(self):
+        """Initialize the log service."""
+        try:
+            from config import LOG_LEVEL, LOG_FORMAT, LOG_PATH, LOG_MAX_BYTES, LOG_BACKUPS, LOG_QUEUE_SIZE
+        except ImportError:
+            LOG_LEVEL, LOG_FORMAT, LOG_PATH, LOG_MAX_BYTES, LOG_BACKUPS, LOG_QUEUE_SIZE = (
+                "INFO", "json", None, 10 * 1024 * 1024, 5, 10000)
+
+        self.level = LOG_LEVEL
+        self.format = LOG_FORMAT
+        self.path = LOG_PATH
+        self.max_bytes = LOG_MAX_BYTES
+        self.backups = LOG_BACKUPS
+        self.queue_size = LOG_QUEUE_SIZE
+        self.listener: Optional[QueueListener] = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def configure(self):
+        """Send every log record through the background writer. Safe to call more than once."""
+        with self.lock:
+            if self.listener is not None:
+                return
+            formatter = JsonFormatter() if self.format == "json" else TextFormatter()
+            handlers = [logging.StreamHandler(sys.stderr)]
+            if self.path:
+                try:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    handlers.append(RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                        backupCount=self.backups, encoding="utf-8"))
+                except OSError as e:
+                    sys.stderr.write(f"Cannot open log file {self.path}: {str(e)}\n")
+            for handler in handlers:
+                handler.setFormatter(formatter)
+
+            records = queue.Queue(maxsize=self.queue_size)
+            root = logging.getLogger()
+            root.setLevel(self.level)
+            root.handlers = [_DroppingQueueHandler(records, self)]
+            self.listener = QueueListener(records, *handlers, respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Write out everything queued and stop the writer thread."""
+        with self.lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Queues records without ever blocking the caller; when the writer falls behind, records are counted and dropped."""
+
+    def __init__(self, records: queue.Queue, service: LogService):
+        super().__init__(records)
+        self.service = service
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike QueueHandler.prepare, keep the traceback apart from the message for the formatter
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.service.dropped += 1
+
+
+# Create a singleton instance
+log_service = LogService()
@@ -0,0 +1,307 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets: request latency in seconds, and request and response sizes in bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _labels_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsService:
+    """Counters, histograms and gauges served at /metrics in Prometheus text format.
+
+    Counters and histograms are updated where things happen (the request
+    middleware, cache lookups); gauges are callbacks read when /metrics is
+    scraped, such as the job queue depth. Cache lookups are counted as
+    cache_requests_total{cache, result="hit"|"miss"}, from which a dashboard
+    derives hit rates.
+
+    With several worker processes (use_shared_store), each worker publishes
+    its values to the shared store every METRICS_PUBLISH_SECONDS, and /metrics,
+    whichever worker answers it, adds up every live worker's counters and
+    histograms. Gauges are added up too, or for values every worker sees the
+    same (programs running in the execution supervisor) the largest is taken.
+    """
+
+    def __init__(self):
+        """Initialize the metrics service."""
+        try:
+            from config import METRICS_ENABLED, METRICS_PUBLISH_SECONDS, LOG_SLOW_REQUEST_SECONDS
+        except ImportError:
+            METRICS_ENABLED, METRICS_PUBLISH_SECONDS, LOG_SLOW_REQUEST_SECONDS = True, 5, 2.0
+
+        self.enabled = METRICS_ENABLED
+        self.publish_seconds = METRICS_PUBLISH_SECONDS
+        self.slow_request_seconds = LOG_SLOW_REQUEST_SECONDS
+        self.lock = threading.Lock()
+        # name -> {"type", "help", "buckets", "merge", "values": {labels: value}}; a histogram's value is
+        # [count per bucket..., count above the last bucket, sum]
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+        self.gauges: Dict[str, Callable[[], Any]] = {}
+        self.store = None
+        self.publisher = None
+        self.counter("cache_requests_total", "Lookups in in-memory caches by cache and result (hit or miss)")
+
+    # Registration
+
+    def _register(self, name: str, kind: str, help_text: str, buckets: Tuple = (), merge: str = "sum"):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = {"type": kind, "help": help_text, "buckets": buckets, "merge": merge,
+                                      "values": {}}
+
+    def counter(self, name: str, help_text: str):
+        """Declare a counter, so that it is listed (empty) before anything has been counted."""
+        self._register(name, "counter", help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple = LATENCY_BUCKETS):
+        """Declare a histogram with the upper bounds of its buckets."""
+        self._register(name, "histogram", help_text, buckets=tuple(buckets))
+
+    def gauge(self, name: str, help_text: str, callback: Callable[[], Any], merge: str = "sum"):
+        """Declare a gauge read from callback at every scrape.
+
+        Args:
+            name: Metric name.
+            help_text: One-line description.
+            callback: Returns a number, or a list of (labels dict, number).
+            merge: How workers' values are combined: "sum", or "max" for values every worker sees the same.
+        """
+        self._register(name, "gauge", help_text, merge=merge)
+        self.gauges[name] = callback
+
+    # Updates
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add value to a counter."""
+        if not self.enabled:
+            return
+        key = _labels_key(labels)
+        with self.lock:
+            values = self.metrics[name]["values"]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Count one observation in a histogram."""
+        if not self.enabled:
+            return
+        key = _labels_key(labels)
+        with self.lock:
+            metric = self.metrics[name]
+            buckets = metric["buckets"]
+            counts = metric["values"].get(key)
+            if counts is None:
+                counts = metric["values"][key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(buckets)] += 1
+            counts[-1] += value
+
+    def cache_lookup(self, cache: str, hit: bool):
+        """Count a lookup in one of the in-memory caches."""
+        self.inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    # Collection
+
+    def snapshot(self) -> Dict[str, List]:
+        """This process's values: name -> [[labels, value], ...], with gauges read now."""
+        with self.lock:
+            values = {name: [[list(key), list(value) if isinstance(value, list) else value]
+                             for key, value in metric["values"].items()]
+                      for name, metric in self.metrics.items() if name not in self.gauges}
+        for name, callback in list(self.gauges.items()):
+            try:
+                result = callback()
+            except Exception as e:
+                logger.warning("Error reading gauge", extra={"gauge": name, "error": str(e)})
+                continue
+            if isinstance(result, (int, float)):
+                values[name] = [[[], result]]
+            else:
+                values[name] = [[list(_labels_key(labels)), value] for labels, value in result]
+        return values
+
+    def use_shared_store(self, store):
+        """Publish this process's metrics to store, so /metrics on any worker covers them all."""
+        self.store = store
+        if self.enabled and self.publisher is None:
+            self.publisher = threading.Thread(target=self._publish_loop, name="metrics-publisher", daemon=True)
+            self.publisher.start()
+
+    def publish(self, values: Optional[Dict[str, List]] = None):
+        if self.store is not None:
+            self.store.set("metrics", str(os.getpid()), values if values is not None else self.snapshot(),
+                           ttl=self.publish_seconds * 3)
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(self.publish_seconds)
+            try:
+                self.publish()
+            except Exception as e:
+                logger.warning("Error publishing metrics", extra={"error": str(e)})
+
+    def _merge(self, snapshots: List[Dict[str, List]]) -> Dict[str, Dict[Tuple, Any]]:
+        merged: Dict[str, Dict[Tuple, Any]] = {name: {} for name in self.metrics}
+        for values in snapshots:
+            for name, samples in values.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                target = merged[name]
+                for labels, value in samples:
+                    key = tuple(tuple(pair) for pair in labels)
+                    current = target.get(key)
+                    if current is None:
+                        target[key] = list(value) if isinstance(value, list) else value
+                    elif isinstance(value, list):
+                        target[key] = [a + b for a, b in zip(current, value)]
+                    elif metric["merge"] == "max":
+                        target[key] = max(current, value)
+                    else:
+                        target[key] = current + value
+        return merged
+
+    def render(self) -> str:
+        """Every metric in Prometheus text exposition format, across worker processes with a shared store."""
+        values = self.snapshot()
+        snapshots = [values]
+        if self.store is not None:
+            self.publish(values)
+            pid = str(os.getpid())
+            snapshots += [snapshot for key, snapshot in self.store.items("metrics") if key != pid]
+
+        lines = []
+        for name, samples in sorted(self._merge(snapshots).items()):
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in sorted(samples.items()):
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {round(value[-1], 6)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """WSGI middleware recording every request: count by status, latency, sizes and requests in flight.
+
+    Requests are labelled with their route pattern (/api/jobs/<job_id>, not the
+    path), which the app puts in environ["metrics.route"] once the URL is
+    matched; anything unmatched is "unmatched". Latency runs until the server
+    closes the response, so for streamed responses it covers the whole stream.
+    Requests slower than LOG_SLOW_REQUEST_SECONDS are logged.
+    """
+
+    def __init__(self, wsgi_app, metrics: MetricsService):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        metrics.counter("http_requests_total", "HTTP requests by method, route and status")
+        metrics.histogram("http_request_duration_seconds", "HTTP request latency by route", LATENCY_BUCKETS)
+        metrics.histogram("http_request_size_bytes", "HTTP request body sizes by route", SIZE_BUCKETS)
+        metrics.histogram("http_response_size_bytes", "HTTP response body sizes by route", SIZE_BUCKETS)
+        metrics.gauge("http_requests_in_flight", "HTTP requests being handled", lambda: self.in_flight)
+
+    def __call__(self, environ, start_response):
+        if not self.metrics.enabled:
+            return self.wsgi_app(environ, start_response)
+        started = time.perf_counter()
+        with self.lock:
+            self.in_flight += 1
+        response = {"status": "500", "length": None}
+
+        def record_start(status, headers, exc_info=None):
+            response["status"] = status.split(" ", 1)[0]
+            for name, value in headers:
+                if name.lower() == "content-length" and value.isdigit():
+                    response["length"] = int(value)
+            return start_response(status, headers, exc_info)
+
+        def finish(sent: int):
+            with self.lock:
+                self.in_flight -= 1
+            duration = time.perf_counter() - started
+            method = environ.get("REQUEST_METHOD", "")
+            route = environ.get("metrics.route", "unmatched")
+            try:
+                received = int(environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                received = 0
+            self.metrics.inc("http_requests_total", method=method, route=route, status=response["status"])
+            self.metrics.observe("http_request_duration_seconds", duration, method=method, route=route)
+            self.metrics.observe("http_request_size_bytes", received, route=route)
+            self.metrics.observe("http_response_size_bytes", sent, route=route)
+            if self.metrics.slow_request_seconds and duration > self.metrics.slow_request_seconds:
+                logger.warning("Slow request", extra={"method": method, "route": route,
+                                                      "path": environ.get("PATH_INFO"), "status": response["status"],
+                                                      "duration": round(duration, 3)})
+
+        try:
+            body = self.wsgi_app(environ, record_start)
+        except BaseException:
+            finish(0)
+            raise
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Wrapping it would stop the server from using sendfile; count it as sent now
+            finish(response["length"] or 0)
+            return body
+        return _MeasuredBody(body, finish)
+
+
+class _MeasuredBody:
+    """A response iterable that counts the bytes sent and reports when the server closes it."""
+
+    def __init__(self, body, finish: Callable[[int], None]):
+        self.body = body
+        self.finish = finish
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            finish, self.finish = self.finish, None
+            if finish is not None:
+                finish(self.sent)
+
+
+# Create a singleton instance
+metrics_service = MetricsService()
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from typing import Dict, Optional, Any
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a piece of text from its length."""
+    try:
+        from config import CHARS_PER_TOKEN
+    except ImportError:
+        CHARS_PER_TOKEN = 4
+    return max(1, len(text or "") // CHARS_PER_TOKEN)
+
+
+class ModelResponse:
+    """The result of one model call, shaped like the Gemini response objects we use."""
+
+    def __init__(self, text: str, model: str, prompt_tokens: int = None, output_tokens: int = None):
+        self.text = text
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens if output_tokens is not None else estimate_tokens(text)
+
+
+class ModelBackend:
+    """Interface every model backend implements.
+
+    A backend turns a prompt into a ModelResponse for a given model name and
+    generation config. GeminiService only talks to models through this interface,
+    so the AI path can run against a local stub or a recorded corpus.
+    """
+
+    name = "base"
+
+    def generate(self, model_name: str, prompt: str, generation_config: Dict[str, Any]) -> ModelResponse:
+        raise NotImplementedError
+
+    def warm_up(self, model_name: str):
+        """Prepare a model ahead of the first request. Optional."""
+        pass
+
+
+class GeminiBackend(ModelBackend):
+    """Backend that calls the Google Gemini API."""
+
+    name = "gemini"
+
+    def __init__(self, api_key: str):
+        import google.generativeai as genai
+
+        self.genai = genai
+        self.genai.configure(api_key=api_key)
+        self.models = {}  # Model instances by name
+        self.models_lock = threading.Lock()
+
+    def _get_model(self, model_name: str):
+        with self.models_lock:
+            model = self.models.get(model_name)
+            if model is None:
+                model = self.genai.GenerativeModel(model_name=model_name)
+                self.models[model_name] = model
+            return model
+
+    def warm_up(self, model_name: str):
+        self._get_model(model_name)
+
+    def generate(self, model_name: str, prompt: str, generation_config: Dict[str, Any]) -> ModelResponse:
+        response = self._get_model(model_name).generate_content(prompt, generation_config=generation_config)
+        text = response.text
+
+        # Newer client versions report usage; fall back to an estimate otherwise
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)
+        output_tokens = getattr(usage, "candidates_token_count", None) or estimate_tokens(text)
+        return ModelResponse(text, model_name, prompt_tokens, output_tokens)
+
+
+class StubBackend(ModelBackend):
+    """Deterministic offline backend with configurable latency and token-rate distributions.
+
+    Latency is modelled as a time to first token plus output tokens divided by a
+    token rate, both drawn from log-normal distributions described by a median
+    and a sigma. The random draws are seeded from the prompt, so the same
+    request always takes the same time and returns the same text.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency_ms: Dict[str, float] = None, tokens_per_second: Dict[str, float] = None,
+                 seed: int = 0, sleep: bool = True):
+        self.latency_ms = latency_ms or {"median": 300, "sigma": 0.5}
+        self.tokens_per_second = tokens_per_second or {"median": 150, "sigma": 0.3}
+        self.seed = seed
+        self.sleep = sleep
+
+    def _draw(self, rng: random.Random, distribution: Dict[str, float]) -> float:
+        median = distribution.get("median", 1.0)
+        sigma = distribution.get("sigma", 0.0)
+        if sigma <= 0:
+            return median
+        return rng.lognormvariate(0, sigma) * median
+
+    def _respond(self, prompt: str) -> str:
+        """Build a plausible response: echo the last code block for edits, a fixed summary otherwise."""
+        blocks = re.findall(r"```(?:\w+)?\s*([\s\S]*?)\s*```", prompt)
+        if blocks and ("return ONLY" in prompt or "ONLY return" in prompt):
+            return f"```\n{blocks[-1]}\n```"
+        return ("1. Purpose: Stub explanation of the selected code.\n"
+                "2. Key points:\n   - Generated offline by the stub backend\n"
+                "3. Context: No model was called.")
+
+    def generate(self, model_name: str, prompt: str, generation_config: Dict[str, Any]) -> ModelResponse:
+        digest = hashlib.sha256(f"{self.seed}:{model_name}:{prompt}".encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest[:16], 16))
+
+        text = self._respond(prompt)
+        output_tokens = min(estimate_tokens(text), generation_config.get("max_output_tokens", 8192))
+
+        first_token_ms = self._draw(rng, self.latency_ms)
+        rate = max(1.0, self._draw(rng, self.tokens_per_second))
+        if self.sleep:
+            time.sleep((first_token_ms + output_tokens / rate * 1000) / 1000)
+
+        return ModelResponse(text, model_name, estimate_tokens(prompt), output_tokens)
+
+
+def _corpus_key(model_name: str, prompt: str) -> str:
+    """Key a recorded request by its model and whitespace-normalised prompt."""
+    normalised = " ".join(prompt.split())
+    return hashlib.sha256(f"{model_name}\n{normalised}".encode("utf-8")).hexdigest()
+
+
+class ReplayBackend(ModelBackend):
+    """Backend that answers from a recorded corpus of real request/response pairs.
+
+    The corpus is a JSON-lines file written by RecordingBackend. Requests are
+    matched on model and prompt; on a miss the backend either raises or, with
+    on_miss="cycle", hands out recorded responses in order so that synthetic
+    load still gets realistic response sizes and latencies.
+    """
+
+    name = "replay"
+
+    def __init__(self, corpus_path: str, on_miss: str = "cycle", speed: float = 1.0):
+        self.corpus_path = corpus_path
+        self.on_miss = on_miss
+        self.speed = speed  # Latency multiplier, 0 disables sleeping
+        self.records = {}
+        self.ordered = []
+        self.next_index = 0
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.corpus_path):
+            raise FileNotFoundError(f"Replay corpus not found: {self.corpus_path}")
+        with open(self.corpus_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                self.records[record["key"]] = record
+                self.ordered.append(record)
+
+    def generate(self, model_name: str, prompt: str, generation_config: Dict[str, Any]) -> ModelResponse:
+        record = self.records.get(_corpus_key(model_name, prompt))
+        if record is None:
+            if self.on_miss != "cycle" or not self.ordered:
+                raise KeyError("No recorded response for this prompt")
+            with self.lock:
+                record = self.ordered[self.next_index % len(self.ordered)]
+                self.next_index += 1
+
+        if self.speed > 0:
+            time.sleep(record.get("latency_ms", 0) * self.speed / 1000)
+
+        return ModelResponse(record["response"], model_name,
+                             record.get("prompt_tokens") or estimate_tokens(prompt),
+                             record.get("output_tokens"))
+
+
+class RecordingBackend(ModelBackend):
+    """Wraps another backend and appends every request/response pair to a corpus file for replay."""
+
+    def __init__(self, inner: ModelBackend, corpus_path: str):
+        self.inner = inner
+        self.name = inner.name
+        self.corpus_path = corpus_path
+        self.lock = threading.Lock()
+        corpus_dir = os.path.dirname(corpus_path)
+        if corpus_dir:
+            os.makedirs(corpus_dir, exist_ok=True)
+
+    def warm_up(self, model_name: str):
+        self.inner.warm_up(model_name)
+
+    def generate(self, model_name: str, prompt: str, generation_config: Dict[str, Any]) -> ModelResponse:
+        start = time.time()
+        response = self.inner.generate(model_name, prompt, generation_config)
+        record = {
+            "key": _corpus_key(model_name, prompt),
+            "model": model_name,
+            "prompt": prompt,
+            "response": response.text,
+            "prompt_tokens": response.prompt_tokens,
+            "output_tokens": response.output_tokens,
+            "latency_ms": round((time.time() - start) * 1000, 1),
+        }
+        with self.lock:
+            with open(self.corpus_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        return response
+
+
+def create_backend(kind: str, api_key: Optional[str] = None) -> ModelBackend:
+    """Create the backend named in config.
+
+    Args:
+        kind: "gemini", "stub" or "replay".
+        api_key: API key, required for the gemini backend.
+
+    Returns:
+        A ModelBackend, wrapped in a RecordingBackend when RECORD_CORPUS_PATH is set.
+    """
+    import config
+
+    if kind == "stub":
+        backend = StubBackend(config.STUB_LATENCY_MS, config.STUB_TOKENS_PER_SECOND, config.STUB_SEED)
+    elif kind == "replay":
+        backend = ReplayBackend(config.REPLAY_CORPUS_PATH, config.REPLAY_ON_MISS, config.REPLAY_SPEED)
+    elif kind == "gemini":
+        backend = GeminiBackend(api_key)
+    else:
+        raise ValueError(f"Unknown model backend: {kind}")
+
+    if config.RECORD_CORPUS_PATH and kind != "replay":
+        backend = RecordingBackend(backend, config.RECORD_CORPUS_PATH)
+    return backend
@@ -0,0 +1,468 @@
+import os
+import re
+import sys
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MODES = ("sample", "cprofile")
+ADMIN_PREFIX = "/api/admin/"
+
+
+class ProfileError(Exception):
+    """Raised when a profiling session cannot be started; status is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _thread_label(name: str) -> str:
+    # Threads of one pool share a label: job-worker-3, ThreadPoolExecutor-0_7 and "Thread-5 (process_request_thread)"
+    # become job-worker, ThreadPoolExecutor and process_request_thread
+    name = re.sub(r"^Thread-\d+ \((.+)\)$", r"\1", name)
+    return "thread:" + (re.sub(r"[-_\d]+$", "", name) or name)
+
+
+def _function_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _copy_recording(recording: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(recording, stacks=dict(recording["stacks"]),
+                functions={root: dict(functions) for root, functions in recording["functions"].items()})
+
+
+class ProfileService:
+    """Profiles the running server on demand, for the next N requests or for a time window.
+
+    Two modes:
+
+    - "sample" wakes every PROFILE_SAMPLE_INTERVAL seconds and records the
+      stack of every thread of the process: request threads, job workers,
+      terminal readers, watchers. It costs a few percent while it runs and
+      nothing otherwise, and gives collapsed stacks (one "root;caller;callee
+      count" line per distinct stack, the input of flame graph tools) as well
+      as the functions most often seen running (self) or on the stack (total).
+      A request thread's stacks are rooted at "route:<rule>", any other
+      thread's at "thread:<name>".
+    - "cprofile" runs cProfile on each profiled request, one request at a time
+      (requests that arrive while another is profiled are not counted), and
+      gives exact call counts and times per function and route.
+
+    A session may be limited to one route. It ends after its N requests, after
+    its window (at most PROFILE_MAX_SECONDS), or when stopped, and its result
+    is kept for PROFILE_RESULT_TTL seconds. With several worker processes
+    (use_shared_store) the session is kept in the shared store, every worker
+    and the execution supervisor take part in it, the N requests are counted
+    across workers, and the result adds up every process's recording.
+    """
+
+    def __init__(self):
+        """Initialize the profile service."""
+        try:
+            from config import (PROFILE_MAX_SECONDS, PROFILE_MAX_REQUESTS, PROFILE_SAMPLE_INTERVAL, PROFILE_MAX_DEPTH,
+                                PROFILE_RESULT_TTL)
+        except ImportError:
+            PROFILE_MAX_SECONDS, PROFILE_MAX_REQUESTS, PROFILE_SAMPLE_INTERVAL, PROFILE_MAX_DEPTH = 300, 1000, 0.01, 64
+            PROFILE_RESULT_TTL = 3600
+
+        self.max_seconds = PROFILE_MAX_SECONDS
+        self.max_requests = PROFILE_MAX_REQUESTS
+        self.sample_interval = PROFILE_SAMPLE_INTERVAL
+        self.max_depth = PROFILE_MAX_DEPTH
+        self.result_ttl = PROFILE_RESULT_TTL
+        self.lock = threading.Lock()
+        self.session: Optional[Dict[str, Any]] = None  # The session this process is taking part in
+        self.recording: Optional[Dict[str, Any]] = None  # What this process recorded for it
+        self.last_session: Optional[Dict[str, Any]] = None  # The session as it was when this process's part ended
+        self.results = OrderedDict()  # session id -> (session, recording) once finished, without a shared store
+        self.in_progress = 0  # Profiled requests not yet finished
+        self.request_threads: Dict[int, str] = {}  # thread id -> "route:<rule>" of the profiled request it runs
+        self.profiling = threading.Lock()  # cProfile profiles one request at a time
+        self.store = None
+        self.watcher = None
+
+    def use_shared_store(self, store):
+        """Keep sessions and results in store, so every process takes part and any worker can report."""
+        self.store = store
+        with self.lock:
+            self._start_watcher()
+
+    # Sessions
+
+    @staticmethod
+    def _running(session: Optional[Dict[str, Any]], now: float) -> bool:
+        return session is not None and session["state"] == "running" and now < session["ends"]
+
+    def start(self, mode: str = "sample", requests: Optional[int] = None, seconds: Optional[float] = None,
+              route: Optional[str] = None, interval: Optional[float] = None) -> Dict[str, Any]:
+        """Start a profiling session.
+
+        Args:
+            mode: "sample" or "cprofile".
+            requests: Profile the next this many requests (matching route).
+            seconds: Profile for this long. Without requests or seconds, 10 seconds.
+            route: Only profile requests to this route pattern, e.g. "/api/ai-assistant".
+            interval: Seconds between samples in sample mode.
+
+        Raises:
+            ProfileError: If the arguments are invalid or a session is already running.
+        """
+        if mode not in MODES:
+            raise ProfileError(f"mode must be one of {', '.join(MODES)}")
+        if requests is not None and not (isinstance(requests, int) and 0 < requests <= self.max_requests):
+            raise ProfileError(f"requests must be between 1 and {self.max_requests}")
+        if seconds is not None and not (isinstance(seconds, (int, float)) and 0 < seconds <= self.max_seconds):
+            raise ProfileError(f"seconds must be between 0 and {self.max_seconds}")
+        if requests is None and seconds is None:
+            seconds = 10
+        interval = min(max(float(interval or self.sample_interval), 0.001), 1.0)
+
+        now = time.time()
+        session = {
+            "id": uuid.uuid4().hex,
+            "mode": mode,
+            "route": route or None,
+            "interval": interval,
+            "requests": requests,
+            "remaining": requests,
+            "seconds": seconds,
+            "started": now,
+            "ends": now + (seconds or self.max_seconds),
+            "state": "running",
+            "finished": None,
+        }
+        if self.store is not None:
+            current = self.store.update("profile", "session",
+                                        lambda current: current if self._running(current, now) else session,
+                                        ttl=self.result_ttl)
+            if current["id"] != session["id"]:
+                raise ProfileError("A profiling session is already running", status=409)
+        with self.lock:
+            if self.store is None and self._running(self.session, now):
+                raise ProfileError("A profiling session is already running", status=409)
+            self._join(session)
+        logger.info("Profiling started", extra={"session": session["id"], "mode": mode, "requests": requests,
+                                                "seconds": seconds, "route": route})
+        return dict(session)
+
+    def stop(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """End a session early. Returns it, or None if there is no such session."""
+        def finish(session):
+            if session is not None and session["id"] == session_id and session["state"] == "running":
+                session = dict(session, state="finished", finished=time.time())
+            return session
+
+        if self.store is not None:
+            session = self.store.update("profile", "session", finish, ttl=self.result_ttl)
+        with self.lock:
+            if self.session is not None and self.session["id"] == session_id:
+                self.session = finish(self.session)
+                session = self.session
+            elif self.store is None:
+                return dict(self.results[session_id][0]) if session_id in self.results else None
+        if session is None or session["id"] != session_id:
+            return None
+        self.refresh()
+        return dict(session)
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        """The running session, if any."""
+        session = self.store.get("profile", "session") if self.store is not None else self.session
+        return dict(session) if self._running(session, time.time()) else None
+
+    def _join(self, session: Dict[str, Any]):
+        """Start recording for a session. Call with the lock held."""
+        self.session = session
+        self.recording = {"session": session["id"], "pid": os.getpid(), "samples": 0, "requests": 0,
+                          "stacks": {}, "functions": {}}
+        if session["mode"] == "sample":
+            threading.Thread(target=self._sample_loop, args=(session,), name="profile-sampler", daemon=True).start()
+        self._start_watcher()
+
+    def _start_watcher(self):
+        """Follow the session from a background thread. Call with the lock held."""
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=self._watch_loop, name="profile-watcher", daemon=True)
+            self.watcher.start()
+
+    def _watch_loop(self):
+        # With a shared store this follows sessions for as long as the process runs; without one, until the session ends
+        while True:
+            time.sleep(0.5)
+            try:
+                if not self.refresh() and self.store is None:
+                    with self.lock:
+                        if self.session is None:
+                            self.watcher = None
+                            return
+            except Exception:
+                logger.exception("Error following profiling session")
+
+    def refresh(self) -> bool:
+        """Join a session started through another process, and end this process's part of a finished one.
+
+        Returns:
+            Whether this process is still recording.
+        """
+        now = time.time()
+        shared = self.store.get("profile", "session") if self.store is not None else None
+        with self.lock:
+            if shared is not None:
+                if self.session is not None and self.session["id"] == shared["id"]:
+                    self.session = shared  # Picks up a stop, or the last of its requests taken elsewhere
+                elif self.session is None and self._running(shared, now) and (
+                        self.recording is None or self.recording["session"] != shared["id"]):
+                    self._join(shared)
+            session = self.session
+            if session is None:
+                return False
+            if self._running(session, now) or self.in_progress:
+                return True
+            self.session = None
+            if session["state"] == "running":
+                session = dict(session, state="finished", finished=now)
+            self.last_session = session
+            if self.store is None:
+                self.results[session["id"]] = (session, self.recording)
+                while len(self.results) > 10:
+                    self.results.popitem(last=False)
+        self.publish()
+        logger.info("Profiling finished", extra={"session": session["id"]})
+        return False
+
+    def publish(self):
+        """Write this process's recording to the shared store, if there is one."""
+        if self.store is None:
+            return
+        with self.lock:
+            if self.recording is None:
+                return
+            recording = _copy_recording(self.recording)
+            recording["session_state"] = self.session if self.session is not None else self.last_session
+        self.store.set("profile-results", f"{recording['session']}:{recording['pid']}", recording, ttl=self.result_ttl)
+
+    # Requests
+
+    def _take_request(self, session: Dict[str, Any]) -> bool:
+        """Count one of a session's N requests; False once all have been taken."""
+        taken = []
+
+        def take(current):
+            if current is None or current["id"] != session["id"] or not self._running(current, time.time()):
+                return current
+            current = dict(current, remaining=current["remaining"] - 1)
+            if current["remaining"] <= 0:
+                current.update(state="finished", finished=time.time())
+            taken.append(True)
+            return current
+
+        if self.store is not None:
+            current = self.store.update("profile", "session", take, ttl=self.result_ttl)
+            with self.lock:
+                if self.session is not None and current is not None and self.session["id"] == current["id"]:
+                    self.session = current
+        else:
+            with self.lock:
+                self.session = take(self.session)
+        return bool(taken)
+
+    def request_started(self, route: str) -> Optional[Tuple]:
+        """Called as a request starts. Returns a token for request_finished if the request is profiled."""
+        session = self.session
+        if session is None or session["state"] != "running" or route.startswith(ADMIN_PREFIX):
+            return None
+        if session["route"] and route != session["route"]:
+            return None
+        if session["mode"] == "cprofile" and not self.profiling.acquire(blocking=False):
+            return None
+        if session["requests"] is not None and not self._take_request(session):
+            if session["mode"] == "cprofile":
+                self.profiling.release()
+            return None
+        with self.lock:
+            self.in_progress += 1
+            self.request_threads[threading.get_ident()] = f"route:{route}"
+        profile = None
+        if session["mode"] == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+        return session["id"], route, profile
+
+    def request_finished(self, token: Tuple):
+        """Called as a profiled request ends, with the token request_started returned."""
+        session_id, route, profile = token
+        functions = None
+        if profile is not None:
+            profile.disable()
+            self.profiling.release()
+            functions = pstats.Stats(profile).stats
+        with self.lock:
+            self.in_progress -= 1
+            self.request_threads.pop(threading.get_ident(), None)
+            recording = self.recording
+            if recording is not None and recording["session"] == session_id:
+                recording["requests"] += 1
+                if functions:
+                    totals = recording["functions"].setdefault(f"route:{route}", {})
+                    for (filename, line, name), (primitive, calls, own, cumulative, _) in functions.items():
+                        label = f"{name} ({os.path.basename(filename)}:{line})"
+                        current = totals.get(label, [0, 0, 0.0, 0.0])
+                        totals[label] = [current[0] + calls, current[1] + primitive, current[2] + own,
+                                         current[3] + cumulative]
+        if profile is not None:
+            self.publish()
+        self.refresh()
+
+    # Sampling
+
+    def _sample_loop(self, session: Dict[str, Any]):
+        me = threading.get_ident()
+        labels = {}  # code object -> "function (file:line)"
+        names: Dict[int, str] = {}
+        names_at = 0.0
+        published_at = time.time()
+        while True:
+            with self.lock:
+                if self.session is None or self.session["id"] != session["id"]:
+                    return
+                routes = dict(self.request_threads)
+                recording = self.recording
+            now = time.time()
+            frames = sys._current_frames()
+            if now - names_at > 1 or not names.keys() >= frames.keys():
+                # Threads started since the names were last read
+                names = {thread.ident: _thread_label(thread.name) for thread in threading.enumerate()}
+                names_at = now
+
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _function_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(routes.get(ident) or names.get(ident) or "thread:unknown")
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                counts = recording["stacks"]
+                for stack in stacks:
+                    counts[stack] = counts.get(stack, 0) + 1
+                recording["samples"] += 1
+
+            frames = frame = None  # Don't keep the sampled frames, and their locals, alive while sleeping
+            if self.store is not None and now - published_at > 1:
+                self.publish()
+                published_at = now
+            time.sleep(session["interval"])
+
+    # Results
+
+    def _recordings(self, session_id: str) -> List[Dict[str, Any]]:
+        if self.store is not None:
+            self.publish()
+            return [recording for key, recording in self.store.items("profile-results")
+                    if key.startswith(session_id + ":")]
+        with self.lock:
+            if session_id in self.results:
+                return [self.results[session_id][1]]
+            if self.recording is not None and self.recording["session"] == session_id:
+                return [_copy_recording(self.recording)]
+        return []
+
+    def _session(self, session_id: str, recordings: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if self.store is not None:
+            session = self.store.get("profile", "session")
+            if session is not None and session["id"] == session_id:
+                return session
+            # Replaced by a later session; each recording keeps the session as it was when it was published
+            return next((recording["session_state"] for recording in recordings), None)
+        with self.lock:
+            if session_id in self.results:
+                return dict(self.results[session_id][0])
+            if self.session is not None and self.session["id"] == session_id:
+                return dict(self.session)
+        return None
+
+    def result(self, session_id: str, route: Optional[str] = None, limit: int = 30,
+               sort: str = "self") -> Optional[Dict[str, Any]]:
+        """A session's result, across processes, so far if it is still running.
+
+        Args:
+            session_id: The session.
+            route: Only count requests to this route pattern (and, when sampling, no other threads).
+            limit: How many functions to list.
+            sort: Order functions by "self" time (spent in the function itself) or "total" time (including callees).
+
+        Returns:
+            {"session", "processes", "samples", "requests", "top", "stacks"}, with stacks as
+            [collapsed stack, samples] pairs, most sampled first; None if there is no such session.
+        """
+        recordings = self._recordings(session_id)
+        session = self._session(session_id, recordings)
+        if session is None:
+            return None
+        if session["state"] == "running" and time.time() >= session["ends"]:
+            session = dict(session, state="finished", finished=session["ends"])
+        root = f"route:{route}" if route else None
+
+        stacks: Dict[str, int] = {}
+        functions: Dict[str, List[float]] = {}
+        for recording in recordings:
+            for stack, count in recording["stacks"].items():
+                if root is None or stack.split(";", 1)[0] == root:
+                    stacks[stack] = stacks.get(stack, 0) + count
+            for stack_root, totals in recording["functions"].items():
+                if root is None or stack_root == root:
+                    for label, values in totals.items():
+                        current = functions.get(label, [0, 0, 0.0, 0.0])
+                        functions[label] = [a + b for a, b in zip(current, values)]
+
+        if session["mode"] == "sample":
+            top = self._sampled_functions(stacks, session["interval"])
+        else:
+            top = [{"function": label, "calls": calls, "primitive_calls": primitive,
+                    "self_seconds": round(own, 6), "total_seconds": round(cumulative, 6)}
+                   for label, (calls, primitive, own, cumulative) in functions.items()]
+        key = "total_seconds" if sort == "total" else "self_seconds"
+        top.sort(key=lambda entry: entry[key], reverse=True)
+        return {
+            "session": session,
+            "processes": len(recordings),
+            "samples": sum(recording["samples"] for recording in recordings),
+            "requests": sum(recording["requests"] for recording in recordings),
+            "top": top[:limit],
+            "stacks": sorted(stacks.items(), key=lambda item: item[1], reverse=True),
+        }
+
+    @staticmethod
+    def _sampled_functions(stacks: Dict[str, int], interval: float) -> List[Dict[str, Any]]:
+        own: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        for stack, count in stacks.items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for label in set(frames):  # A recursive function counts once per sample
+                total[label] = total.get(label, 0) + count
+        return [{"function": label, "self_samples": own.get(label, 0), "total_samples": count,
+                 "self_seconds": round(own.get(label, 0) * interval, 6), "total_seconds": round(count * interval, 6)}
+                for label, count in total.items()]
+
+
+# Create a singleton instance
+profile_service = ProfileService()
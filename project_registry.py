@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ProjectRegistry:
+    """Registry of projects, cached in process and indexed by name, persisted to SQLite.
+
+    Lookups are served from an in-memory dict. Writes go through SQLite
+    transactions, so concurrent creates and deletes from any number of threads
+    or worker processes cannot lose each other's updates. Before answering,
+    the cache checks SQLite's data_version, which changes whenever another
+    connection commits, and reloads only then.
+    """
+
+    def __init__(self, db_path: str, legacy_json_path: Optional[str] = None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS projects ("
+            "name TEXT PRIMARY KEY, path TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.cache = {}
+        self.data_version = None
+
+        if legacy_json_path:
+            self._import_legacy(legacy_json_path)
+
+    def _import_legacy(self, json_path: str):
+        """Import projects.json once, the first time the database is created."""
+        if not os.path.exists(json_path):
+            return
+        with self.lock:
+            if self.connection.execute("SELECT COUNT(*) FROM projects").fetchone()[0]:
+                return
+            try:
+                with open(json_path, "r") as f:
+                    projects = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Error reading legacy projects file", extra={"path": json_path, "error": str(e)})
+                return
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for project in projects:
+                    self.connection.execute("INSERT OR IGNORE INTO projects (name, path, created) VALUES (?, ?, ?)",
+                                            (project["name"], project["path"], time.time()))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def _refresh(self):
+        """Reload the cache if another connection has committed since we last read. Call with the lock held."""
+        version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            rows = self.connection.execute("SELECT name, path FROM projects ORDER BY created, name").fetchall()
+            self.cache = {name: {"name": name, "path": path} for name, path in rows}
+            self.data_version = version
+
+    def list(self) -> List[Dict]:
+        """Return all projects, oldest first."""
+        with self.lock:
+            self._refresh()
+            return [dict(project) for project in self.cache.values()]
+
+    def get(self, name: str) -> Optional[Dict]:
+        """Return the project with the given name, or None."""
+        with self.lock:
+            self._refresh()
+            project = self.cache.get(name)
+            return dict(project) if project else None
+
+    def add(self, name: str, path: str) -> bool:
+        """Register a project. Returns False if the name is already taken."""
+        with self.lock:
+            try:
+                self.connection.execute("INSERT INTO projects (name, path, created) VALUES (?, ?, ?)",
+                                        (name, path, time.time()))
+            except sqlite3.IntegrityError:
+                return False
+            # Our own commit doesn't change data_version on this connection
+            self._refresh()
+            self.cache[name] = {"name": name, "path": path}
+            return True
+
+    def put(self, name: str, path: str):
+        """Register a project, replacing any project registered under the same name."""
+        with self.lock:
+            self.connection.execute("INSERT INTO projects (name, path, created) VALUES (?, ?, ?) "
+                                    "ON CONFLICT(name) DO UPDATE SET path = excluded.path", (name, path, time.time()))
+            self._refresh()
+            self.cache[name] = {"name": name, "path": path}
+
+    def remove(self, name: str) -> bool:
+        """Unregister a project. Returns False if it was not registered."""
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM projects WHERE name = ?", (name,)).rowcount > 0
+            self._refresh()
+            self.cache.pop(name, None)
+            return removed
@@ -0,0 +1,295 @@
+import os
+import time
+import heapq
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Tuple
+
+from file_tree_service import file_tree_service
+from metrics_service import metrics_service
+
+# fzf-style scoring constants
+SCORE_MATCH = 16
+SCORE_GAP_START = -3
+SCORE_GAP_EXTENSION = -1
+BONUS_BOUNDARY = 8
+BONUS_BOUNDARY_DELIMITER = 9
+BONUS_BOUNDARY_WHITE = 10
+BONUS_NON_WORD = 8
+BONUS_CAMEL_CASE = 7
+BONUS_CONSECUTIVE = 4
+BONUS_FIRST_CHAR_MULTIPLIER = 2
+BONUS_BASENAME = 10
+
+# Character classes, ordered so that everything above CLASS_NON_WORD is a word character
+CLASS_WHITE, CLASS_DELIMITER, CLASS_NON_WORD, CLASS_LOWER, CLASS_UPPER, CLASS_LETTER, CLASS_DIGIT = range(7)
+
+
+def _char_class(char: str) -> int:
+    if "a" <= char <= "z":
+        return CLASS_LOWER
+    if "A" <= char <= "Z":
+        return CLASS_UPPER
+    if "0" <= char <= "9":
+        return CLASS_DIGIT
+    if char == "/" or char == os.sep:
+        return CLASS_DELIMITER
+    if char.isspace():
+        return CLASS_WHITE
+    if char.isalpha():
+        return CLASS_LETTER
+    return CLASS_NON_WORD
+
+
+def _bonus(previous: int, current: int) -> int:
+    """Bonus for matching a character of class current that follows one of class previous."""
+    if current > CLASS_NON_WORD:
+        if previous == CLASS_WHITE:
+            return BONUS_BOUNDARY_WHITE
+        if previous == CLASS_DELIMITER:
+            return BONUS_BOUNDARY_DELIMITER
+        if previous == CLASS_NON_WORD:
+            return BONUS_BOUNDARY
+    if (previous == CLASS_LOWER and current == CLASS_UPPER) or (previous != CLASS_DIGIT and current == CLASS_DIGIT):
+        return BONUS_CAMEL_CASE
+    if current in (CLASS_NON_WORD, CLASS_DELIMITER):
+        return BONUS_NON_WORD
+    if current == CLASS_WHITE:
+        return BONUS_BOUNDARY_WHITE
+    return 0
+
+
+def char_mask(text: str) -> int:
+    """64-bit set of the (lowercased) characters in text: a-z, 0-9, common punctuation, and one bit for the rest."""
+    mask = 0
+    for char in text:
+        if "a" <= char <= "z":
+            mask |= 1 << (ord(char) - 97)
+        elif "0" <= char <= "9":
+            mask |= 1 << (ord(char) - 22)
+        elif char in "._-/ ":
+            mask |= 1 << (36 + "._-/ ".index(char))
+        else:
+            mask |= 1 << 63
+    return mask
+
+
+def fold_case(text: str) -> str:
+    """Lowercase text one character at a time, so that positions in it are positions in text.
+
+    A few characters lowercase to more than one ('İ' to 'i' plus a combining
+    dot); those are kept as they are.
+    """
+    if text.isascii():
+        return text.lower()
+    return "".join(lower if len(lower) == 1 else char for char, lower in ((char, char.lower()) for char in text))
+
+
+class _Entry:
+    """A path with what scoring needs precomputed: lowercase form, character classes and mask."""
+    __slots__ = ("path", "lower", "classes", "mask", "basename_start")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lower = fold_case(path)
+        self.classes = [_char_class(char) for char in path]
+        self.mask = char_mask(self.lower)
+        self.basename_start = path.rfind("/") + 1
+
+
+def fuzzy_score(pattern: str, entry: _Entry) -> Optional[Tuple[int, List[int]]]:
+    """Score pattern (lowercase) against a path the way fzf's v1 algorithm does.
+
+    A forward scan finds where the first occurrence of the pattern as a
+    subsequence ends; a backward scan from there finds the latest start, which
+    gives the shortest window. The window is scored with bonuses for matches
+    at word boundaries, path separators and camelCase humps, and for
+    consecutive runs, minus gap penalties.
+
+    Returns:
+        (score, matched positions), or None if pattern is not a subsequence.
+    """
+    text = entry.lower
+    index = 0
+    start = -1
+    end = -1
+    for position, char in enumerate(text):
+        if char == pattern[index]:
+            if start < 0:
+                start = position
+            index += 1
+            if index == len(pattern):
+                end = position + 1
+                break
+    if end < 0:
+        return None
+
+    index = len(pattern) - 1
+    for position in range(end - 1, start - 1, -1):
+        if text[position] == pattern[index]:
+            index -= 1
+            if index < 0:
+                start = position
+                break
+
+    score = 0
+    positions = []
+    in_gap = False
+    consecutive = 0
+    first_bonus = 0
+    previous = entry.classes[start - 1] if start > 0 else CLASS_DELIMITER
+    index = 0
+    for position in range(start, end):
+        current = entry.classes[position]
+        if index < len(pattern) and text[position] == pattern[index]:
+            score += SCORE_MATCH
+            bonus = _bonus(previous, current)
+            if consecutive == 0:
+                first_bonus = bonus
+            else:
+                # A run keeps the bonus of the boundary it started on
+                if bonus >= BONUS_BOUNDARY and bonus > first_bonus:
+                    first_bonus = bonus
+                bonus = max(bonus, first_bonus, BONUS_CONSECUTIVE)
+            score += bonus * BONUS_FIRST_CHAR_MULTIPLIER if index == 0 else bonus
+            positions.append(position)
+            in_gap = False
+            consecutive += 1
+            index += 1
+        else:
+            score += SCORE_GAP_EXTENSION if in_gap else SCORE_GAP_START
+            in_gap = True
+            consecutive = 0
+            first_bonus = 0
+        previous = current
+
+    # Prefer matches in the file name over matches spread across directories
+    if start >= entry.basename_start:
+        score += BONUS_BASENAME
+    return score, positions
+
+
+class _PathIndex:
+    def __init__(self, root: str):
+        self.root = root
+        self.version = -1  # file tree change-log version the index is current with; -1 until built
+        self.entries: Dict[str, _Entry] = {}
+        self.last_query = None  # (query, version, matching entries), to narrow the next keystroke's search
+        self.lock = threading.Lock()
+
+
+class QuickOpenService:
+    """Fuzzy file finder over a precomputed index of every project path.
+
+    Each path's lowercase form, character classes and a 64-bit character mask
+    are computed once and kept current from the file tree's change log. A query
+    first rejects every path whose mask lacks one of its characters, then
+    scores the rest fzf-style and keeps the top k. While a user types, each
+    query only re-scores the paths that matched the one before it.
+    """
+
+    def __init__(self):
+        """Initialize the quick-open service."""
+        try:
+            from config import QUICK_OPEN_MAX_PROJECTS, QUICK_OPEN_MAX_RESULTS
+        except ImportError:
+            QUICK_OPEN_MAX_PROJECTS, QUICK_OPEN_MAX_RESULTS = 8, 100
+
+        self.max_projects = QUICK_OPEN_MAX_PROJECTS
+        self.max_results = QUICK_OPEN_MAX_RESULTS
+        self.indexes = OrderedDict()  # abs root -> _PathIndex
+        self.lock = threading.Lock()
+
+    def _get_index(self, root: str) -> _PathIndex:
+        """A project's path index, built on first use and brought up to date with the file tree."""
+        root = os.path.abspath(root)
+        with self.lock:
+            index = self.indexes.get(root)
+            metrics_service.cache_lookup("path_index", index is not None)
+            if index is None:
+                index = self.indexes[root] = _PathIndex(root)
+            self.indexes.move_to_end(root)
+            while len(self.indexes) > self.max_projects:
+                self.indexes.popitem(last=False)
+
+        with index.lock:
+            changes = file_tree_service.get_changes(root, index.version) if index.version >= 0 else None
+            if changes is None or changes["reset"] or any(c["type"] == "reset" for c in changes["changes"]):
+                index.version = file_tree_service.get_version(root)
+                index.entries = {}
+                for rel_path in file_tree_service.list_files(root):
+                    path = rel_path.replace(os.sep, "/")
+                    index.entries[path] = _Entry(path)
+            elif changes["changes"]:
+                for change in changes["changes"]:
+                    path = change["path"].replace(os.sep, "/")
+                    if change["type"] == "deleted":
+                        index.entries.pop(path, None)
+                        for child in [p for p in index.entries if p.startswith(path + "/")]:
+                            del index.entries[child]
+                    elif change["kind"] == "directory":
+                        for rel_path in file_tree_service.list_files(root):
+                            child = rel_path.replace(os.sep, "/")
+                            if child.startswith(path + "/") and child not in index.entries:
+                                index.entries[child] = _Entry(child)
+                    elif path not in index.entries:
+                        index.entries[path] = _Entry(path)
+                index.version = changes["version"]
+        return index
+
+    def find(self, root: str, query: str, limit: int = 20) -> Dict[str, Any]:
+        """Return the top matches for a fuzzy path query.
+
+        Args:
+            root: Project root.
+            query: Characters to match, in order; spaces are ignored, case-insensitive.
+            limit: How many results to return.
+
+        Returns:
+            A dictionary with results (path, score and matched character positions,
+            best first), the number of paths matched and searched, and elapsed_ms.
+        """
+        started = time.time()
+        limit = max(1, min(limit, self.max_results))
+        pattern = "".join(fold_case(query).split())
+        index = self._get_index(root)
+
+        with index.lock:
+            if not pattern:
+                paths = sorted(index.entries, key=lambda p: (p.count("/"), len(p), p))[:limit]
+                return {"results": [{"path": p, "score": 0, "positions": []} for p in paths],
+                        "matched": len(index.entries), "total": len(index.entries),
+                        "elapsed_ms": round((time.time() - started) * 1000, 2)}
+
+            # Typing one more character can only narrow the previous query's matches
+            last = index.last_query
+            if last and last[1] == index.version and pattern.startswith(last[0]):
+                pool = last[2]
+            else:
+                pool = list(index.entries.values())
+            total = len(index.entries)
+
+        mask = char_mask(pattern)
+        scored = []
+        for entry in pool:
+            if mask & ~entry.mask:
+                continue
+            result = fuzzy_score(pattern, entry)
+            if result is not None:
+                scored.append((result[0], entry, result[1]))
+
+        with index.lock:
+            index.last_query = (pattern, index.version, [entry for _, entry, _ in scored])
+
+        best = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], len(item[1].path), item[1].path))
+        return {
+            "results": [{"path": entry.path, "score": score, "positions": positions}
+                        for score, entry, positions in best],
+            "matched": len(scored),
+            "total": total,
+            "elapsed_ms": round((time.time() - started) * 1000, 2),
+        }
+
+
+# Create a singleton instance
+quick_open_service = QuickOpenService()
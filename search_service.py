@@ -0,0 +1,422 @@
+import os
+import re
+import time
+import difflib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Any, Set
+
+try:
+    import re._parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+from file_tree_service import file_tree_service
+from file_content_service import FileContentService
+from file_utils import atomic_write_many
+from metrics_service import metrics_service
+
+logger = logging.getLogger(__name__)
+
+
+def _trigrams(data: bytes) -> Set[bytes]:
+    return {data[i:i + 3] for i in range(len(data) - 2)}
+
+
+def _query_trigrams(literals: List[str], ignore_case: bool) -> Set[bytes]:
+    """Trigrams every matching file must contain. The index is ASCII-lowercased, so queries are too."""
+    trigrams = set()
+    for literal in literals:
+        grams = _trigrams(literal.encode("utf-8").lower())
+        if ignore_case:
+            # Non-ASCII letters have case variants the ASCII-lowercased index can't account for
+            grams = {g for g in grams if max(g) < 0x80}
+        trigrams |= grams
+    return trigrams
+
+
+def _required_literals(items) -> List[str]:
+    """Literal runs a regex match must contain, from its parsed form. Conservative: may return too few."""
+    runs = []
+    current = ""
+    for op, av in items:
+        name = str(op)
+        if name == "LITERAL":
+            current += chr(av)
+            continue
+        if current:
+            runs.append(current)
+            current = ""
+        if name == "SUBPATTERN":
+            runs.extend(_required_literals(av[-1]))
+        elif name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT") and av[0] >= 1:
+            runs.extend(_required_literals(av[2]))
+    if current:
+        runs.append(current)
+    return runs
+
+
+class TrigramIndex:
+    """Inverted index from (ASCII-lowercased) byte trigrams to the files containing them.
+
+    Posting lists are compact arrays of file ids. A changed file is given a new
+    id and its old one is marked dead rather than removed from every list; the
+    index is compacted once dead ids outnumber live ones.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.version = 0  # file tree change-log version the index is current with
+        self.paths: Dict[int, str] = {}  # live file id -> relative path
+        self.ids: Dict[str, int] = {}  # relative path -> live file id
+        self.postings: Dict[bytes, array] = {}
+        self.next_id = 0
+        self.dead = 0
+        self.lock = threading.RLock()
+
+    def add(self, rel_path: str, data: bytes):
+        self.remove(rel_path)
+        file_id = self.next_id
+        self.next_id += 1
+        self.ids[rel_path] = file_id
+        self.paths[file_id] = rel_path
+        for gram in _trigrams(data.lower()):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("I")
+            posting.append(file_id)
+
+    def remove(self, rel_path: str):
+        file_id = self.ids.pop(rel_path, None)
+        if file_id is not None:
+            del self.paths[file_id]
+            self.dead += 1
+
+    def remove_prefix(self, rel_dir: str):
+        prefix = rel_dir + "/"
+        for rel_path in [p for p in self.ids if p.startswith(prefix)]:
+            self.remove(rel_path)
+
+    def compact(self):
+        if self.dead <= len(self.paths):
+            return
+        live = self.paths
+        postings = {}
+        for gram, posting in self.postings.items():
+            kept = array("I", (file_id for file_id in posting if file_id in live))
+            if kept:
+                postings[gram] = kept
+        self.postings = postings
+        self.dead = 0
+
+    def candidates(self, trigrams: Set[bytes]) -> List[str]:
+        """Paths of the live files containing every trigram, sorted."""
+        if not trigrams:
+            return sorted(self.ids)
+        lists = []
+        for gram in trigrams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                return []
+            lists.append(posting)
+        lists.sort(key=len)
+        ids = set(lists[0])
+        for posting in lists[1:]:
+            ids.intersection_update(posting)
+            if not ids:
+                return []
+        return sorted(self.paths[file_id] for file_id in ids if file_id in self.paths)
+
+
+class SearchService:
+    """Full-text search and replace over projects, backed by a trigram index per project.
+
+    An index is built once per project (in the background after an upload, or
+    on first search) and then kept current from the file tree's change log, so
+    saves, creates and deletes re-index only the files involved. A query's
+    trigrams narrow the project down to the few files that can match, and only
+    those are read and scanned. Regex queries are narrowed by the literal runs
+    any match must contain; regexes without any are scanned in full.
+    """
+
+    def __init__(self):
+        """Initialize the search service."""
+        try:
+            from config import SEARCH_MAX_FILE_BYTES, SEARCH_MAX_PROJECTS, SEARCH_MAX_RESULTS
+        except ImportError:
+            SEARCH_MAX_FILE_BYTES, SEARCH_MAX_PROJECTS, SEARCH_MAX_RESULTS = 1024 * 1024, 8, 2000
+
+        self.max_file_bytes = SEARCH_MAX_FILE_BYTES
+        self.max_projects = SEARCH_MAX_PROJECTS
+        self.max_results = SEARCH_MAX_RESULTS
+        self.indexes = OrderedDict()  # abs root -> TrigramIndex
+        self.lock = threading.Lock()
+        self.building = {}  # abs root -> Event set when its build finishes
+
+    # Index maintenance
+
+    def _read_indexable(self, abs_path: str) -> Optional[bytes]:
+        """File content if it is text and small enough to index, else None."""
+        try:
+            if os.path.getsize(abs_path) > self.max_file_bytes:
+                return None
+            with open(abs_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if b"\x00" in data[:8192]:
+            return None
+        return data
+
+    def _build(self, root: str) -> TrigramIndex:
+        index = TrigramIndex(root)
+        index.version = file_tree_service.get_version(root)
+        for rel_path in file_tree_service.list_files(root):
+            data = self._read_indexable(os.path.join(root, rel_path))
+            if data is not None:
+                index.add(rel_path.replace(os.sep, "/"), data)
+        return index
+
+    def build(self, root: str) -> TrigramIndex:
+        """(Re)build a project's index, sharing the work with a build already in progress."""
+        root = os.path.abspath(root)
+        with self.lock:
+            event = self.building.get(root)
+            owner = event is None
+            if owner:
+                event = self.building[root] = threading.Event()
+        if not owner:
+            event.wait()
+            with self.lock:
+                index = self.indexes.get(root)
+            return index if index is not None else self.build(root)
+
+        try:
+            started = time.time()
+            index = self._build(root)
+            logger.info("Search index built", extra={"root": root, "files": len(index.paths),
+                                                     "trigrams": len(index.postings),
+                                                     "duration": round(time.time() - started, 3)})
+            with self.lock:
+                self.indexes[root] = index
+                self.indexes.move_to_end(root)
+                while len(self.indexes) > self.max_projects:
+                    self.indexes.popitem(last=False)
+            return index
+        finally:
+            with self.lock:
+                del self.building[root]
+            event.set()
+
+    def build_async(self, root: str):
+        """Build a project's index in the background, e.g. right after it was uploaded."""
+        threading.Thread(target=self.build, args=(root,), name="search-index", daemon=True).start()
+
+    def forget(self, root: str):
+        """Drop the index of a project, or of every project under a directory."""
+        prefix = os.path.abspath(root)
+        with self.lock:
+            for path in [p for p in self.indexes if p == prefix or p.startswith(prefix + os.sep)]:
+                del self.indexes[path]
+
+    def get_index(self, root: str) -> TrigramIndex:
+        """A project's index, brought up to date with the file tree's changes since it was last used."""
+        root = os.path.abspath(root)
+        with self.lock:
+            index = self.indexes.get(root)
+            if index is not None:
+                self.indexes.move_to_end(root)
+        metrics_service.cache_lookup("search_index", index is not None)
+        if index is None:
+            return self.build(root)
+
+        with index.lock:
+            changes = file_tree_service.get_changes(root, index.version)
+            if changes["reset"]:
+                return self.build(root)
+            for change in changes["changes"]:
+                rel_path = change["path"].replace(os.sep, "/")
+                abs_path = os.path.join(root, change["path"])
+                if change["type"] == "deleted":
+                    index.remove(rel_path)
+                    index.remove_prefix(rel_path)
+                elif change["type"] == "reset":
+                    return self.build(root)
+                elif change["kind"] == "directory":
+                    for child in file_tree_service.list_files(root):
+                        child_rel = child.replace(os.sep, "/")
+                        if child_rel.startswith(rel_path + "/"):
+                            data = self._read_indexable(os.path.join(root, child))
+                            if data is not None:
+                                index.add(child_rel, data)
+                else:
+                    data = self._read_indexable(abs_path)
+                    if data is not None:
+                        index.add(rel_path, data)
+                    else:
+                        index.remove(rel_path)
+            index.version = changes["version"]
+            index.compact()
+        return index
+
+    # Queries
+
+    def compile(self, query: str, regex: bool = False, case_sensitive: bool = True):
+        """Compile a query and work out the trigrams a matching file must contain.
+
+        Raises:
+            re.error: If a regex query is invalid.
+        """
+        flags = re.MULTILINE | (0 if case_sensitive else re.IGNORECASE)
+        pattern = re.compile(query if regex else re.escape(query), flags)
+        if not regex:
+            return pattern, _query_trigrams([query], not case_sensitive)
+        try:
+            parsed = sre_parse.parse(query, flags)
+            state = getattr(parsed, "state", None) or getattr(parsed, "pattern", None)
+            ignore_case = bool(getattr(state, "flags", flags) & re.IGNORECASE)
+            return pattern, _query_trigrams(_required_literals(parsed), ignore_case)
+        except Exception:
+            return pattern, set()
+
+    def search(self, root: str, query: str, regex: bool = False, case_sensitive: bool = True,
+               max_results: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Search a project, yielding each hit as soon as it is found and a summary last.
+
+        Yields:
+            {"type": "match", "path", "line", "column", "length", "text"} per hit (line and
+            column are 1-based, column in characters), then {"type": "done", ...} with counts.
+
+        Raises:
+            re.error: If a regex query is invalid.
+        """
+        started = time.time()
+        pattern, trigrams = self.compile(query, regex, case_sensitive)
+        max_results = min(max_results or self.max_results, self.max_results)
+        index = self.get_index(root)
+        with index.lock:
+            candidates = index.candidates(trigrams)
+            indexed = len(index.paths)
+
+        matches = 0
+        files_matched = 0
+        truncated = False
+        for rel_path in candidates:
+            hits = list(self._find(os.path.join(root, rel_path), pattern, max_results - matches))
+            if hits:
+                files_matched += 1
+            for hit in hits:
+                matches += 1
+                yield dict(hit, type="match", path=rel_path)
+            if matches >= max_results:
+                truncated = True
+                break
+
+        yield {
+            "type": "done",
+            "matches": matches,
+            "files_matched": files_matched,
+            "files_scanned": len(candidates),
+            "files_indexed": indexed,
+            "truncated": truncated,
+            "elapsed_ms": round((time.time() - started) * 1000, 2),
+        }
+
+    def _find(self, abs_path: str, pattern, limit: int) -> Iterator[Dict[str, Any]]:
+        try:
+            with open(abs_path, "rb") as f:
+                text = f.read().decode("utf-8", errors="replace")
+        except OSError:
+            return
+        line = 1
+        position = 0
+        for found, match in enumerate(pattern.finditer(text)):
+            if found >= limit:
+                return
+            start = match.start()
+            line += text.count("\n", position, start)
+            position = start
+            line_start = text.rfind("\n", 0, start) + 1
+            line_end = text.find("\n", start)
+            if line_end < 0:
+                line_end = len(text)
+            yield {
+                "line": line,
+                "column": start - line_start + 1,
+                "length": match.end() - start,
+                "text": text[line_start:line_end][:500],
+            }
+
+    # Replace
+
+    def replace(self, root: str, query: str, replacement: str, regex: bool = False, case_sensitive: bool = True,
+                paths: Optional[List[str]] = None, apply: bool = False,
+                expected: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Replace every match of a query across a project, or preview doing so.
+
+        Args:
+            root: Project root.
+            query: Literal text or regex to find.
+            replacement: Replacement text; for regex queries, group references like \\1 are expanded.
+            regex: Treat query as a regular expression.
+            case_sensitive: Match case exactly.
+            paths: Restrict the replace to these relative paths.
+            apply: Write the changes. Otherwise only a preview is returned.
+            expected: For apply, the etag of each file as previewed; files changed since abort the replace.
+
+        Returns:
+            A dictionary with status "success" and per-file counts, etags and unified
+            diffs (and written=True when applied), or status "conflict"/"error".
+        """
+        pattern, trigrams = self.compile(query, regex, case_sensitive)
+        index = self.get_index(root)
+        with index.lock:
+            candidates = index.candidates(trigrams)
+        if paths is not None:
+            wanted = {p.replace(os.sep, "/") for p in paths}
+            candidates = [p for p in candidates if p in wanted]
+
+        def substitute(match):
+            return match.expand(replacement) if regex else replacement
+
+        changes = []
+        new_contents = {}
+        for rel_path in candidates:
+            abs_path = os.path.join(root, rel_path)
+            try:
+                with open(abs_path, "rb") as f:
+                    etag = FileContentService.etag(os.fstat(f.fileno()))
+                    original = f.read().decode("utf-8")
+            except (OSError, UnicodeDecodeError):
+                continue
+            if apply and expected is not None and expected.get(rel_path, etag) != etag:
+                return {"status": "conflict", "path": rel_path,
+                        "message": f"{rel_path} changed since the preview"}
+            try:
+                updated, count = pattern.subn(substitute, original)
+            except (re.error, IndexError) as e:
+                return {"status": "error", "message": f"Invalid replacement: {str(e)}"}
+            if not count or updated == original:
+                continue
+            diff = "".join(difflib.unified_diff(original.splitlines(keepends=True), updated.splitlines(keepends=True),
+                                                fromfile=f"a/{rel_path}", tofile=f"b/{rel_path}"))
+            changes.append({"path": rel_path, "replacements": count, "etag": etag, "diff": diff})
+            new_contents[abs_path] = updated
+
+        result = {
+            "status": "success",
+            "files": changes,
+            "total_replacements": sum(change["replacements"] for change in changes),
+            "written": False,
+        }
+        if apply and new_contents:
+            atomic_write_many(new_contents)
+            result["written"] = True
+            result["contents"] = new_contents
+        return result
+
+
+# Create a singleton instance
+search_service = SearchService()
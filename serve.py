@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Serve the app in production: the execution supervisor plus N gunicorn workers.
+
+`python app.py` runs one process with Flask's debug server and reloader, which
+uses one core and is not meant for production. This script starts the
+execution supervisor, waits for its socket, then runs gunicorn with several
+worker processes (one per core by default) and a pool of threads in each,
+with MULTI_WORKER=1 so that the workers share state through the shared store
+and run programs through the supervisor:
+
+    python serve.py --workers 4 --bind 0.0.0.0:8000
+
+Workers are forked without --preload, so each opens its own database
+connections and inotify watchers. They must still sign sessions with the
+same key: without SECRET_KEY in the environment, one is generated here and
+passed to every worker, and sessions then last until the next restart. The
+supervisor is stopped when gunicorn exits.
+"""
+
+import os
+import sys
+import signal
+import secrets
+import argparse
+import subprocess
+
+from execution_supervisor import wait_for_supervisor
+
+try:
+    from config import SERVE_BIND, SERVE_WORKERS, SERVE_THREADS, SERVE_TIMEOUT, SUPERVISOR_SOCKET
+except ImportError:
+    SERVE_BIND, SERVE_WORKERS, SERVE_THREADS, SERVE_TIMEOUT = "127.0.0.1:5000", 0, 8, 120
+    SUPERVISOR_SOCKET = os.path.join(".cache", "supervisor.sock")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bind", default=SERVE_BIND, help="Address to listen on")
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS or os.cpu_count() or 1,
+                        help="Worker processes (default: one per CPU core)")
+    parser.add_argument("--threads", type=int, default=SERVE_THREADS, help="Threads per worker")
+    parser.add_argument("--timeout", type=int, default=SERVE_TIMEOUT, help="Seconds before a stuck worker is restarted")
+    parser.add_argument("--socket", default=SUPERVISOR_SOCKET, help="Execution supervisor socket")
+    args = parser.parse_args()
+
+    env = dict(os.environ, MULTI_WORKER="1", SUPERVISOR_SOCKET=args.socket)
+    if not env.get("SECRET_KEY"):
+        # Each worker would otherwise pick its own key and reject the others' session cookies
+        env["SECRET_KEY"] = secrets.token_hex(32)
+        print("SECRET_KEY is not set; sessions will not survive a restart", file=sys.stderr)
+    supervisor = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "execution_supervisor.py"), args.socket],
+                                  cwd=BASE_DIR, env=env)
+    try:
+        if not wait_for_supervisor(args.socket):
+            print(f"Execution supervisor did not start on {args.socket}", file=sys.stderr)
+            return 1
+        server = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:app",
+                                   "--bind", args.bind,
+                                   "--workers", str(args.workers),
+                                   "--worker-class", "gthread",
+                                   "--threads", str(args.threads),
+                                   "--timeout", str(args.timeout),
+                                   "--graceful-timeout", "30"],
+                                  cwd=BASE_DIR, env=env)
+        # Forward SIGTERM and SIGINT to gunicorn, which stops its workers gracefully
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda received, frame: server.send_signal(signal.SIGTERM))
+        return server.wait()
+    finally:
+        supervisor.terminate()
+        try:
+            supervisor.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            supervisor.kill()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Cross-process locks are striped over this many lock files
+LOCK_STRIPES = 64
+
+
+class SharedStore:
+    """Key-value state shared by every worker process on the machine.
+
+    Values are JSON, grouped by namespace and optionally expiring, in a SQLite
+    database in WAL mode, so readers never block the writer and any worker
+    sees what another committed. update() reads and writes one key inside a
+    write transaction, which makes read-modify-write cycles such as rate
+    limit buckets atomic across processes. locked() is a named lock held across
+    processes for longer critical sections (a file's save, a workspace's
+    eviction); names are hashed onto a fixed set of lock files.
+
+    Connections and lock files are reopened after a fork, so a store created
+    before the server forks its workers is still safe to use in each of them.
+    """
+
+    def __init__(self):
+        """Initialize the shared store."""
+        try:
+            from config import SHARED_STATE_DIR
+        except ImportError:
+            SHARED_STATE_DIR = os.path.join(".cache", "shared")
+
+        self.directory = SHARED_STATE_DIR
+        self.pid = None
+        self.connection = None
+        self.lock_files: Dict[int, Any] = {}
+        self.stripe_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self.depth = threading.local()
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        """This process's connection, opened on first use and after a fork. Call with the lock held."""
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.directory, "state.db"), timeout=30,
+                                         check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            self.connection = connection
+            self.lock_files = {}
+            self.pid = os.getpid()
+        return self.connection
+
+    def _purge_sometimes(self, db: sqlite3.Connection):
+        """Delete expired entries every few hundred writes. Call with the lock held."""
+        self.writes += 1
+        if self.writes % 500 == 0:
+            db.execute("DELETE FROM entries WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        with self.lock:
+            row = self._db().execute("SELECT value FROM entries WHERE namespace = ? AND key = ? "
+                                     "AND (expires IS NULL OR expires >= ?)", (namespace, key, time.time())).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        """Store a value, expiring after ttl seconds if given."""
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO entries (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                       (namespace, key, json.dumps(value), expires))
+            self._purge_sometimes(db)
+
+    def delete(self, namespace: str, key: str):
+        with self.lock:
+            self._db().execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def delete_prefix(self, namespace: str, prefix: str):
+        """Delete every key of a namespace starting with prefix."""
+        with self.lock:
+            self._db().execute("DELETE FROM entries WHERE namespace = ? AND substr(key, 1, ?) = ?",
+                               (namespace, len(prefix), prefix))
+
+    def items(self, namespace: str) -> List[Tuple[str, Any]]:
+        """Every live (key, value) of a namespace."""
+        with self.lock:
+            rows = self._db().execute("SELECT key, value FROM entries WHERE namespace = ? "
+                                      "AND (expires IS NULL OR expires >= ?)", (namespace, time.time())).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def update(self, namespace: str, key: str, function: Callable[[Any], Any], ttl: Optional[float] = None) -> Any:
+        """Replace a value with function(current value or None) atomically across processes.
+
+        Returns:
+            The new value. If function returns None the key is deleted.
+        """
+        with self.lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT value FROM entries WHERE namespace = ? AND key = ? "
+                                 "AND (expires IS NULL OR expires >= ?)", (namespace, key, time.time())).fetchone()
+                value = function(json.loads(row[0]) if row else None)
+                if value is None:
+                    db.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+                else:
+                    db.execute("INSERT OR REPLACE INTO entries (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                               (namespace, key, json.dumps(value), time.time() + ttl if ttl else None))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            self._purge_sometimes(db)
+        return value
+
+    # Locks
+
+    def _lock_file(self, stripe: int):
+        """This process's handle on a stripe's lock file. flock locks belong to the open file, so each process opens its own."""
+        with self.lock:
+            self._db()  # Resets the handles after a fork
+            handle = self.lock_files.get(stripe)
+            if handle is None:
+                lock_dir = os.path.join(self.directory, "locks")
+                os.makedirs(lock_dir, exist_ok=True)
+                handle = self.lock_files[stripe] = open(os.path.join(lock_dir, f"{stripe:02d}.lock"), "a+")
+            return handle
+
+    @contextmanager
+    def locked(self, name: str):
+        """Hold a named lock across every worker process. Re-entrant within a thread."""
+        stripe = int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:8], 16) % LOCK_STRIPES
+        depths = getattr(self.depth, "stripes", None)
+        if depths is None:
+            depths = self.depth.stripes = {}
+        with self.stripe_locks[stripe]:
+            # Threads of this process queue on the stripe's RLock; the file lock excludes other processes
+            handle = self._lock_file(stripe) if not depths.get(stripe) else None
+            if handle is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            depths[stripe] = depths.get(stripe, 0) + 1
+            try:
+                yield
+            finally:
+                depths[stripe] -= 1
+                if handle is not None:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+# Create a singleton instance
+shared_store = SharedStore()
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import shutil
+import threading
+from typing import Dict, List, Any
+
+# ioctl request to clone a whole file's extents, from <linux/fs.h>
+FICLONE = 0x40049409
+
+REFLINK_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+
+
+class SnapshotError(Exception):
+    """Raised when a clone, snapshot or restore cannot be made."""
+    pass
+
+
+class SnapshotService:
+    """Copy-on-write project duplicates and snapshots.
+
+    Trees are cloned file by file with the FICLONE ioctl where the filesystem
+    supports reflinks (btrfs, XFS, overlay on those), which shares data blocks
+    until either copy is written, so a clone costs one system call per file and
+    almost no disk and a snapshot can be taken before every applied AI change.
+    Elsewhere files are copied. SNAPSHOT_CLONE_METHOD = "hardlink" hard-links
+    them instead: every write route replaces files through a temp file and
+    rename, which leaves the other link untouched, but a program run from the
+    terminal that rewrites a file in place changes every snapshot of it too.
+
+    Snapshots of UPLOAD_FOLDER/<project> live under UPLOAD_FOLDER/.snapshots/<project>/,
+    on the same filesystem as the project, with a JSON file of metadata next to each.
+    """
+
+    def __init__(self):
+        """Initialize the snapshot service."""
+        try:
+            from config import SNAPSHOT_CLONE_METHOD, SNAPSHOT_MAX_AUTO
+        except ImportError:
+            SNAPSHOT_CLONE_METHOD, SNAPSHOT_MAX_AUTO = "auto", 50
+
+        self.method = SNAPSHOT_CLONE_METHOD
+        self.max_auto = SNAPSHOT_MAX_AUTO
+        self.reflink_devices = {}  # st_dev -> whether FICLONE works there
+        self.lock = threading.Lock()
+
+    # Cloning
+
+    def _reflink(self, source: str, target: str, st: os.stat_result) -> bool:
+        """Clone one file with FICLONE. Returns False if the filesystem can't, so the caller falls back."""
+        if self.reflink_devices.get(st.st_dev) is False:
+            return False
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError as e:
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            if e.errno in REFLINK_UNSUPPORTED:
+                self.reflink_devices[st.st_dev] = False
+                return False
+            raise
+        self.reflink_devices[st.st_dev] = True
+        shutil.copystat(source, target)
+        return True
+
+    def clone_tree(self, source: str, target: str) -> Dict[str, Any]:
+        """Clone a directory tree to target, which must not exist yet.
+
+        Returns:
+            A dictionary with the method used and the number of files cloned.
+        """
+        methods = {"reflink": 0, "hardlink": 0, "copy": 0}
+        os.mkdir(target)
+        stack = [(source, target)]
+        while stack:
+            current, current_target = stack.pop()
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.name.startswith((".batch-", ".staging-", ".trash-")):
+                        continue
+                    destination = os.path.join(current_target, entry.name)
+                    if entry.is_symlink():
+                        os.symlink(os.readlink(entry.path), destination)
+                    elif entry.is_dir(follow_symlinks=False):
+                        os.mkdir(destination)
+                        shutil.copystat(entry.path, destination)
+                        stack.append((entry.path, destination))
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        if self.method in ("auto", "reflink") and self._reflink(entry.path, destination, st):
+                            methods["reflink"] += 1
+                        elif self.method == "hardlink" and self._hardlink(entry.path, destination):
+                            methods["hardlink"] += 1
+                        else:
+                            shutil.copy2(entry.path, destination)
+                            methods["copy"] += 1
+        used = [name for name, count in methods.items() if count] or ["reflink" if self.method == "auto" else self.method]
+        return {"method": "+".join(used), "files": sum(methods.values())}
+
+    @staticmethod
+    def _hardlink(source: str, target: str) -> bool:
+        try:
+            os.link(source, target)
+            return True
+        except OSError:
+            return False
+
+    # Snapshots
+
+    @staticmethod
+    def snapshot_dir(project_dir: str) -> str:
+        """Where a project's snapshots are kept: a hidden folder beside it, on the same filesystem."""
+        project_dir = os.path.abspath(project_dir)
+        return os.path.join(os.path.dirname(project_dir), ".snapshots", os.path.basename(project_dir))
+
+    def _meta_path(self, project_dir: str, snapshot_id: str) -> str:
+        if not snapshot_id or not all(c.isalnum() or c == "-" for c in snapshot_id):
+            raise SnapshotError("Invalid snapshot id")
+        return os.path.join(self.snapshot_dir(project_dir), f"{snapshot_id}.json")
+
+    def create_snapshot(self, project_dir: str, label: str = "", source: str = "user") -> Dict[str, Any]:
+        """Snapshot a project. Automatic snapshots (source other than "user") are pruned to SNAPSHOT_MAX_AUTO.
+
+        Returns:
+            The snapshot's metadata: id, label, source, created, method and files.
+        """
+        if not os.path.isdir(project_dir):
+            raise SnapshotError("Project not found")
+        snapshot_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        directory = self.snapshot_dir(project_dir)
+        os.makedirs(directory, exist_ok=True)
+
+        started = time.time()
+        try:
+            clone = self.clone_tree(project_dir, os.path.join(directory, snapshot_id))
+        except OSError as e:
+            shutil.rmtree(os.path.join(directory, snapshot_id), ignore_errors=True)
+            raise SnapshotError(f"Failed to snapshot {os.path.basename(project_dir)}: {str(e)}")
+        meta = {"id": snapshot_id, "label": label, "source": source, "created": time.time(),
+                "elapsed_ms": round((time.time() - started) * 1000, 2), **clone}
+        with open(self._meta_path(project_dir, snapshot_id), "w") as f:
+            json.dump(meta, f)
+
+        if source != "user":
+            automatic = [s for s in self.list_snapshots(project_dir) if s["source"] != "user"]
+            for old in automatic[self.max_auto:]:
+                self.delete_snapshot(project_dir, old["id"])
+        return meta
+
+    def list_snapshots(self, project_dir: str) -> List[Dict[str, Any]]:
+        """A project's snapshots, newest first."""
+        directory = self.snapshot_dir(project_dir)
+        snapshots = []
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(directory, name), "r") as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        snapshots.sort(key=lambda s: s["created"], reverse=True)
+        return snapshots
+
+    def delete_snapshot(self, project_dir: str, snapshot_id: str) -> bool:
+        meta_path = self._meta_path(project_dir, snapshot_id)
+        if not os.path.exists(meta_path):
+            return False
+        os.remove(meta_path)
+        shutil.rmtree(os.path.join(self.snapshot_dir(project_dir), snapshot_id), ignore_errors=True)
+        return True
+
+    def delete_all(self, project_dir: str):
+        shutil.rmtree(self.snapshot_dir(project_dir), ignore_errors=True)
+
+    def restore(self, project_dir: str, snapshot_id: str) -> Dict[str, Any]:
+        """Replace a project's content with a snapshot's, after snapshotting the current state.
+
+        The snapshot is cloned next to the project and swapped in with renames,
+        so the project is never seen half-restored and the snapshot stays intact.
+
+        Returns:
+            The metadata of the snapshot taken of the state being replaced.
+        """
+        project_path = os.path.abspath(project_dir)
+        if not os.path.exists(self._meta_path(project_path, snapshot_id)):
+            raise SnapshotError("Snapshot not found")
+        snapshot_path = os.path.join(self.snapshot_dir(project_path), snapshot_id)
+        parent = os.path.dirname(project_path)
+
+        with self.lock:
+            backup = self.create_snapshot(project_path, label=f"Before restoring {snapshot_id}", source="restore")
+            staging = os.path.join(parent, f".staging-restore-{uuid.uuid4().hex}")
+            trash = os.path.join(parent, f".trash-restore-{uuid.uuid4().hex}")
+            try:
+                self.clone_tree(snapshot_path, staging)
+                os.rename(project_path, trash)
+                os.rename(staging, project_path)
+            except OSError as e:
+                if not os.path.exists(project_path) and os.path.exists(trash):
+                    os.rename(trash, project_path)
+                raise SnapshotError(f"Failed to restore {snapshot_id}: {str(e)}")
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(trash, ignore_errors=True)
+        return backup
+
+    def duplicate(self, project_dir: str, target: str) -> Dict[str, Any]:
+        """Clone a project to a new directory beside it. The caller registers it."""
+        source = os.path.abspath(project_dir)
+        if not os.path.isdir(source):
+            raise SnapshotError("Project not found")
+        if os.path.exists(target):
+            raise SnapshotError("A project with that name already exists")
+
+        staging = os.path.join(os.path.dirname(os.path.abspath(target)), f".staging-clone-{uuid.uuid4().hex}")
+        started = time.time()
+        try:
+            clone = self.clone_tree(source, staging)
+            os.rename(staging, target)
+        except OSError as e:
+            raise SnapshotError(f"Failed to duplicate {os.path.basename(source)}: {str(e)}")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return {"path": target, "elapsed_ms": round((time.time() - started) * 1000, 2), **clone}
+
+
+# Create a singleton instance
+snapshot_service = SnapshotService()
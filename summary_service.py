@@ -0,0 +1,273 @@
+import os
+import re
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryService:
+    """Keeps a short model-written summary of each project file, used as compact AI context.
+
+    Summaries are generated lazily by a single background worker, persisted to
+    disk per project and keyed by a hash of the file content, so they survive
+    restarts and are only regenerated when the file actually changes.
+    """
+
+    # Queue priorities: summaries a prompt is waiting for go before background warm-ups
+    PRIORITY_NEEDED = 0
+    PRIORITY_BACKGROUND = 1
+
+    def __init__(self):
+        """Initialize the summary service."""
+        try:
+            from config import SUMMARY_CACHE_DIR, SUMMARY_MAX_FILE_BYTES, SUMMARY_MAX_RELATED, SUMMARY_IDLE_DELAY
+        except ImportError:
+            SUMMARY_CACHE_DIR, SUMMARY_MAX_FILE_BYTES = os.path.join(".cache", "summaries"), 200000
+            SUMMARY_MAX_RELATED, SUMMARY_IDLE_DELAY = 8, 0.5
+
+        self.cache_dir = SUMMARY_CACHE_DIR
+        self.max_file_bytes = SUMMARY_MAX_FILE_BYTES
+        self.max_related = SUMMARY_MAX_RELATED
+        self.idle_delay = SUMMARY_IDLE_DELAY
+
+        self.summarizer = None  # Callable (content, rel_path) -> {"status", "summary"}
+        self.stores = {}  # Project dir -> {rel_path: {"hash", "summary", "updated"}}
+        self.lock = threading.Lock()
+        self.queue = queue.PriorityQueue()
+        self.pending = set()
+        self.sequence = 0
+        self.worker = None
+
+    def set_summarizer(self, summarizer: Callable[[str, str], Dict]):
+        """Set the function used to summarize a file; without one, nothing is generated."""
+        self.summarizer = summarizer
+
+    # Storage
+
+    def _store_path(self, project_dir: str) -> str:
+        key = hashlib.sha1(os.path.abspath(project_dir).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _get_store(self, project_dir: str) -> Dict:
+        """Return the in-memory store for a project, loading it from disk the first time. Call with the lock held."""
+        project_dir = os.path.abspath(project_dir)
+        store = self.stores.get(project_dir)
+        if store is None:
+            store = {}
+            path = self._store_path(project_dir)
+            if os.path.exists(path):
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        store = json.load(f).get("files", {})
+                except (OSError, ValueError) as e:
+                    logger.error("Error loading summaries", extra={"path": path, "error": str(e)})
+            self.stores[project_dir] = store
+        return store
+
+    def _persist(self, project_dir: str):
+        """Write a project's summaries to disk atomically."""
+        project_dir = os.path.abspath(project_dir)
+        with self.lock:
+            data = {"project": project_dir, "files": dict(self._get_store(project_dir))}
+        path = self._store_path(project_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _read(self, project_dir: str, rel_path: str) -> Optional[str]:
+        full_path = os.path.join(project_dir, rel_path)
+        try:
+            if os.path.getsize(full_path) > self.max_file_bytes:
+                return None
+            with open(full_path, "r", encoding="utf-8") as f:
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    # Public API
+
+    def get_summaries(self, project_dir: str, rel_paths: List[str]) -> Dict[str, str]:
+        """Return the up-to-date summaries available for the given files.
+
+        Files whose summary is missing or stale are queued for generation and
+        left out of the result; the caller never waits on the model.
+        """
+        summaries = {}
+        for rel_path in rel_paths:
+            content = self._read(project_dir, rel_path)
+            if content is None:
+                continue
+            digest = self.content_hash(content)
+            with self.lock:
+                entry = self._get_store(project_dir).get(rel_path)
+            if entry and entry.get("hash") == digest:
+                summaries[rel_path] = entry["summary"]
+            else:
+                self.request_summary(project_dir, rel_path, self.PRIORITY_NEEDED)
+        return summaries
+
+    def request_summary(self, project_dir: str, rel_path: str, priority: int = PRIORITY_BACKGROUND):
+        """Queue a file for summarization unless it is already queued."""
+        if self.summarizer is None:
+            return
+        project_dir = os.path.abspath(project_dir)
+        with self.lock:
+            key = (project_dir, rel_path)
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            self.sequence += 1
+            self.queue.put((priority, self.sequence, project_dir, rel_path))
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._work, name="summary-worker", daemon=True)
+                self.worker.start()
+
+    def invalidate(self, project_dir: str, rel_path: str, content: Optional[str] = None):
+        """Drop a file's summary if the saved content no longer matches it.
+
+        Args:
+            project_dir: The project the file belongs to.
+            rel_path: Path of the file relative to project_dir.
+            content: The content just written, if the caller has it; saves re-reading the file.
+        """
+        digest = self.content_hash(content) if content is not None else None
+        removed = False
+        with self.lock:
+            store = self._get_store(project_dir)
+            entry = store.get(rel_path)
+            if entry and (digest is None or entry.get("hash") != digest):
+                del store[rel_path]
+                removed = True
+        if removed:
+            self._persist(project_dir)
+
+    def find_related_files(self, project_dir: str, rel_path: str, content: str) -> List[str]:
+        """Pick the files most likely to matter for an edit: local imports first, then siblings.
+
+        Args:
+            project_dir: The project root.
+            rel_path: Path of the file being edited, relative to project_dir.
+            content: The file's content.
+
+        Returns:
+            Up to SUMMARY_MAX_RELATED paths relative to project_dir.
+        """
+        file_dir = os.path.dirname(rel_path)
+        related = []
+
+        def add(candidate):
+            candidate = os.path.normpath(candidate)
+            if candidate.startswith("..") or candidate == os.path.normpath(rel_path) or candidate in related:
+                return False
+            if os.path.isfile(os.path.join(project_dir, candidate)):
+                related.append(candidate)
+                return True
+            return False
+
+        # Python imports, both absolute from the project root and relative to the file
+        imports = [(dots, module, names.split(",")) for dots, module, names in
+                   re.findall(r"^\s*from\s+(\.*)([\w.]*)\s+import\s+\(?([\w \t,]+)", content, re.MULTILINE)]
+        imports += [("", module, []) for module in re.findall(r"^\s*import\s+([\w.]+)", content, re.MULTILINE)]
+        for dots, module, names in imports:
+            parts = module.split(".") if module else []
+            bases = [file_dir] if dots else [file_dir, ""]
+            if len(dots) > 1:
+                bases = [os.path.join(file_dir, *[".."] * (len(dots) - 1))]
+            for base in bases:
+                module_path = os.path.join(base, *parts) if parts else base
+                found = add(module_path + ".py") or add(os.path.join(module_path, "__init__.py"))
+                # "from package import module" names submodules
+                for name in names:
+                    name = name.strip()
+                    if name:
+                        found = add(os.path.join(module_path, name + ".py")) or found
+                if found:
+                    break
+
+        # JavaScript/TypeScript relative imports and requires
+        for spec in re.findall(r"""(?:from\s+|require\(\s*|import\s+)['"](\.{1,2}/[^'"]+)['"]""", content):
+            module_path = os.path.join(file_dir, spec)
+            for suffix in ("", ".js", ".ts", ".jsx", ".tsx", "/index.js", "/index.ts"):
+                if add(module_path + suffix):
+                    break
+
+        # Fill up with files in the same directory
+        if len(related) < self.max_related:
+            try:
+                with os.scandir(os.path.join(project_dir, file_dir) if file_dir else project_dir) as entries:
+                    for entry in sorted(entries, key=lambda e: e.name):
+                        if len(related) >= self.max_related:
+                            break
+                        if entry.is_file() and not entry.name.startswith("."):
+                            add(os.path.join(file_dir, entry.name))
+            except OSError:
+                pass
+
+        return related[:self.max_related]
+
+    # Worker
+
+    def _work(self):
+        while True:
+            try:
+                priority, _, project_dir, rel_path = self.queue.get(timeout=30)
+            except queue.Empty:
+                with self.lock:
+                    if self.queue.empty():
+                        self.worker = None
+                        return
+                continue
+
+            try:
+                self._summarize(project_dir, rel_path)
+            except Exception as e:
+                logger.warning("Error summarizing file",
+                               extra={"project": project_dir, "path": rel_path, "error": str(e)})
+            finally:
+                with self.lock:
+                    self.pending.discard((project_dir, rel_path))
+                self.queue.task_done()
+
+            # Stay out of the way of interactive requests
+            time.sleep(self.idle_delay)
+
+    def _summarize(self, project_dir: str, rel_path: str):
+        content = self._read(project_dir, rel_path)
+        if content is None or not content.strip():
+            return
+        digest = self.content_hash(content)
+        with self.lock:
+            entry = self._get_store(project_dir).get(rel_path)
+        if entry and entry.get("hash") == digest:
+            return
+
+        result = self.summarizer(content, rel_path)
+        if result.get("status") != "success":
+            return
+
+        # Only keep the summary if the file didn't change while it was generated
+        current = self._read(project_dir, rel_path)
+        if current is None or self.content_hash(current) != digest:
+            return
+        with self.lock:
+            self._get_store(project_dir)[rel_path] = {
+                "hash": digest,
+                "summary": result["summary"],
+                "updated": time.time(),
+            }
+        self._persist(project_dir)
+
+# Create a singleton instance
+summary_service = SummaryService()
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from typing import Dict, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+
+class AIRequestTrace:
+    """Collects timing and token counts for the model calls made while serving one AI request.
+
+    Every call is split into queue time (waiting for a free concurrency slot),
+    upstream time (the model call itself) and post-processing time (our own
+    work between the end of the call and the next call or the end of the request).
+    """
+
+    def __init__(self, service, project: str, mode: str, file_path: str = ""):
+        self.service = service
+        self.request_id = uuid.uuid4().hex[:12]
+        self.project = project or "unknown"
+        self.mode = mode
+        self.file_path = file_path
+        self.started = time.perf_counter()
+        self.calls = []
+        self._pending = None  # Last call, waiting for its post-processing time
+        self._last_end = None
+        self.finished = False
+
+    def _close_pending(self, now: float):
+        if self._pending is not None:
+            self._pending["post_ms"] = round((now - self._last_end) * 1000, 2)
+            self.service.record(self._pending)
+            self._pending = None
+
+    def add_call(self, model: str, queue_ms: float, upstream_ms: float, prompt_tokens: int,
+                 output_tokens: int, cache: str = "miss", status: str = "success", mode: str = None):
+        """Record a finished model call. Its post-processing time is filled in by the next call or finish()."""
+        now = time.perf_counter()
+        self._close_pending(now - (queue_ms + upstream_ms) / 1000)
+        call = {
+            "timestamp": time.time(),
+            "request_id": self.request_id,
+            "project": self.project,
+            "mode": mode or self.mode,
+            "file_path": self.file_path,
+            "model": model,
+            "cache": cache,
+            "status": status,
+            "prompt_tokens": prompt_tokens or 0,
+            "output_tokens": output_tokens or 0,
+            "queue_ms": round(queue_ms, 2),
+            "upstream_ms": round(upstream_ms, 2),
+            "post_ms": 0.0,
+        }
+        self.calls.append(call)
+        self._pending = call
+        self._last_end = now
+
+    def finish(self):
+        """Close the trace and flush the last call record."""
+        if not self.finished:
+            self.finished = True
+            self._close_pending(time.perf_counter())
+
+    @property
+    def usage(self) -> Dict[str, int]:
+        """Token totals for the request, as returned to the client."""
+        return {
+            "calls": len(self.calls),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in self.calls),
+            "output_tokens": sum(c["output_tokens"] for c in self.calls),
+        }
+
+
+class _Aggregate:
+    """Running totals for one project or mode."""
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.queue_ms = 0.0
+        self.upstream_ms = 0.0
+        self.post_ms = 0.0
+        self.models = {}
+        self.recent_upstream_ms = deque(maxlen=window)
+
+    def add(self, record: Dict[str, Any]):
+        self.calls += 1
+        if record["status"] != "success":
+            self.errors += 1
+        if record["cache"] == "hit":
+            self.cache_hits += 1
+        self.prompt_tokens += record["prompt_tokens"]
+        self.output_tokens += record["output_tokens"]
+        self.queue_ms += record["queue_ms"]
+        self.upstream_ms += record["upstream_ms"]
+        self.post_ms += record["post_ms"]
+        self.models[record["model"]] = self.models.get(record["model"], 0) + 1
+        self.recent_upstream_ms.append(record["upstream_ms"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        count = self.calls or 1
+        recent = sorted(self.recent_upstream_ms)
+
+        def pct(fraction):
+            return recent[min(len(recent) - 1, int(fraction * len(recent)))] if recent else 0.0
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cache_hit_rate": round(self.cache_hits / count, 3),
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "avg_prompt_tokens": round(self.prompt_tokens / count, 1),
+            "avg_output_tokens": round(self.output_tokens / count, 1),
+            "avg_queue_ms": round(self.queue_ms / count, 1),
+            "avg_upstream_ms": round(self.upstream_ms / count, 1),
+            "avg_post_ms": round(self.post_ms / count, 1),
+            "p50_upstream_ms": pct(0.50),
+            "p95_upstream_ms": pct(0.95),
+            "models": dict(self.models),
+        }
+
+
+class TelemetryService:
+    def __init__(self):
+        """Initialize the telemetry service and its rotating structured log."""
+        try:
+            from config import TELEMETRY_LOG_PATH, TELEMETRY_LOG_MAX_BYTES, TELEMETRY_LOG_BACKUPS, TELEMETRY_WINDOW
+        except ImportError:
+            TELEMETRY_LOG_PATH, TELEMETRY_LOG_MAX_BYTES, TELEMETRY_LOG_BACKUPS, TELEMETRY_WINDOW = (
+                os.path.join("logs", "ai_telemetry.jsonl"), 10 * 1024 * 1024, 5, 1000)
+
+        self.lock = threading.Lock()
+        self.window = TELEMETRY_WINDOW
+        self.by_project = {}
+        self.by_mode = {}
+        self.by_project_mode = {}
+        self.total = _Aggregate(self.window)
+
+        self.logger = logging.getLogger("ai_telemetry")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if TELEMETRY_LOG_PATH and not self.logger.handlers:
+            try:
+                log_dir = os.path.dirname(TELEMETRY_LOG_PATH)
+                if log_dir:
+                    os.makedirs(log_dir, exist_ok=True)
+                handler = RotatingFileHandler(TELEMETRY_LOG_PATH, maxBytes=TELEMETRY_LOG_MAX_BYTES,
+                                              backupCount=TELEMETRY_LOG_BACKUPS, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                self.logger.addHandler(handler)
+            except OSError as e:
+                logger.error("Error opening telemetry log", extra={"path": TELEMETRY_LOG_PATH, "error": str(e)})
+
+    def start_request(self, project: str, mode: str, file_path: str = "") -> AIRequestTrace:
+        """Start tracing one AI request."""
+        return AIRequestTrace(self, project, mode, file_path)
+
+    def record(self, record: Dict[str, Any]):
+        """Add one model call record to the aggregates and the structured log."""
+        with self.lock:
+            self.total.add(record)
+            for table, key in ((self.by_project, record["project"]),
+                               (self.by_mode, record["mode"]),
+                               (self.by_project_mode, (record["project"], record["mode"]))):
+                if key not in table:
+                    table[key] = _Aggregate(self.window)
+                table[key].add(record)
+        self.logger.info(json.dumps(record))
+
+    def get_aggregates(self, project: Optional[str] = None, mode: Optional[str] = None) -> Dict[str, Any]:
+        """Return aggregates, optionally restricted to one project and/or mode."""
+        with self.lock:
+            if project and mode:
+                aggregate = self.by_project_mode.get((project, mode))
+                return {"project": project, "mode": mode,
+                        "stats": aggregate.to_dict() if aggregate else _Aggregate(1).to_dict()}
+            if project:
+                return {
+                    "project": project,
+                    "by_mode": {m: a.to_dict() for (p, m), a in self.by_project_mode.items() if p == project},
+                }
+            if mode:
+                return {
+                    "mode": mode,
+                    "by_project": {p: a.to_dict() for (p, m), a in self.by_project_mode.items() if m == mode},
+                }
+            return {
+                "total": self.total.to_dict(),
+                "by_project": {p: a.to_dict() for p, a in self.by_project.items()},
+                "by_mode": {m: a.to_dict() for m, a in self.by_mode.items()},
+            }
+
+# Create a singleton instance
+telemetry_service = TelemetryService()
@@ -1,6 +1,7 @@
 import os
 import subprocess
 import sys
+import logging
 import threading
 import queue
 import time
@@ -8,6 +9,8 @@ import platform
 import tempfile
 from io import StringIO
 
+logger = logging.getLogger(__name__)
+
 class TerminalService:
     def __init__(self):
         self.buffer = ""  # Single buffer for simplicity
@@ -16,6 +19,8 @@ class TerminalService:
         self.process_lock = threading.Lock()
         self.output_queue = queue.Queue()
         self.max_buffer_size = 100000  # Maximum size of terminal buffer in characters
+        self.written = 0  # Characters ever appended, so readers can follow the output by offset
+        self.exit_code = None  # Exit code of the last process once its output is drained
     
     def execute_code(self, code, cwd=None):
         """
@@ -42,7 +47,7 @@ class TerminalService:
             try:
                 os.unlink(temp_file_path)
             except Exception as e:
-                print(f"Error removing temporary file: {str(e)}")
+                logger.warning("Error removing temporary file", extra={"path": temp_file_path, "error": str(e)})
     
     def execute_file(self, file_path, cwd=None):
         """
@@ -106,6 +111,7 @@ class TerminalService:
             
             try:
                 # Start the process
+                self.exit_code = None
                 self.running_process = subprocess.Popen(
                     command,
                     cwd=cwd,
@@ -118,11 +124,13 @@ class TerminalService:
                 # Start threads to read stdout and stderr
                 stdout_thread = threading.Thread(
                     target=self._read_stream, 
-                    args=(self.running_process.stdout, "stdout")
+                    args=(self.running_process.stdout, "stdout"),
+                    name="terminal-stdout"
                 )
                 stderr_thread = threading.Thread(
                     target=self._read_stream, 
-                    args=(self.running_process.stderr, "stderr")
+                    args=(self.running_process.stderr, "stderr"),
+                    name="terminal-stderr"
                 )
                 
                 stdout_thread.daemon = True
@@ -131,7 +139,7 @@ class TerminalService:
                 stderr_thread.start()
                 
                 # Start a thread to process the output queue
-                process_thread = threading.Thread(target=self._process_output)
+                process_thread = threading.Thread(target=self._process_output, name="terminal-output")
                 process_thread.daemon = True
                 process_thread.start()
                 
@@ -159,6 +167,7 @@ class TerminalService:
                         if self.output_queue.empty():
                             exit_code = self.running_process.poll()
                             self._append_to_buffer(f"\nProcess exited with code {exit_code}\n")
+                            self.exit_code = exit_code
                             self.running_process = None
                             break
                 
@@ -185,6 +194,7 @@ class TerminalService:
         """Append text to the terminal buffer with size limitation"""
         with self.buffer_lock:
             self.buffer += text
+            self.written += len(text)
             # Trim buffer if it exceeds max size
             if len(self.buffer) > self.max_buffer_size:
                 self.buffer = self.buffer[-self.max_buffer_size:]
@@ -194,12 +204,37 @@ class TerminalService:
         with self.buffer_lock:
             return self.buffer
     
+    def read_output(self, offset=None):
+        """
+        Read the output written after an offset
+        
+        Args:
+            offset (int, optional): Offset returned by an earlier call. If None, only the current offset is returned
+            
+        Returns:
+            dict: New output, the offset to pass next time, whether a process is still running
+                  (or its output still being read) and the exit code once it has finished
+        """
+        # Checked before the buffer is read: once the process is cleared, its last output is already there
+        running = self.running_process is not None
+        with self.buffer_lock:
+            start = self.written - len(self.buffer)
+            output = "" if offset is None else self.buffer[max(0, offset - start):]
+            return {"output": output, "offset": self.written, "running": running,
+                    "exit_code": None if running else self.exit_code,
+                    "truncated": offset is not None and offset < start}
+    
     def clear_buffer(self):
         """Clear the terminal buffer"""
         with self.buffer_lock:
             self.buffer = ""
         return {"status": "cleared"}
     
+    def is_running(self):
+        """Whether a process started from this terminal is still running"""
+        with self.process_lock:
+            return self.running_process is not None and self.running_process.poll() is None
+    
     def kill_process(self):
         """Kill the currently running process"""
         with self.process_lock:
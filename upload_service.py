@@ -0,0 +1,488 @@
+import os
+import json
+import stat
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Any
+
+from chunk_store import ChunkStore
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """Raised when an archive is rejected or cannot be extracted."""
+    pass
+
+
+class UploadJob:
+    """Progress of one upload, readable while extraction runs.
+
+    With a shared store, progress is published there (at most a few times a
+    second while extracting) so any worker process can answer status requests.
+    """
+
+    def __init__(self, upload_id: str, project_name: str, store=None, ttl: int = 3600):
+        self.id = upload_id
+        self.project_name = project_name
+        self.state = "queued"  # queued, validating, extracting, done, error
+        self.message = ""
+        self.entries_total = 0
+        self.entries_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.project_path = None
+        self.started = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.store = store
+        self.ttl = ttl
+        self.published_at = 0.0
+
+    def advance(self, entries: int = 0, size: int = 0):
+        with self.lock:
+            self.entries_done += entries
+            self.bytes_done += size
+        self.publish(force=False)
+
+    def publish(self, force: bool = True):
+        """Write the job's progress to the shared store, if there is one."""
+        if self.store is None or (not force and time.time() - self.published_at < 0.25):
+            return
+        self.published_at = time.time()
+        state = self.to_dict()
+        state.update(started=self.started, finished=self.finished)
+        self.store.set("uploads", self.id, state, ttl=self.ttl + (time.time() - self.started))
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "UploadJob":
+        """A read-only copy of a job published by another worker process."""
+        job = cls(state["upload_id"], state["project_name"])
+        for name in ("state", "message", "entries_total", "entries_done", "bytes_total", "bytes_done",
+                     "project_path", "started", "finished"):
+            setattr(job, name, state[name])
+        return job
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "upload_id": self.id,
+                "project_name": self.project_name,
+                "state": self.state,
+                "message": self.message,
+                "entries_total": self.entries_total,
+                "entries_done": self.entries_done,
+                "bytes_total": self.bytes_total,
+                "bytes_done": self.bytes_done,
+                "progress": round(self.bytes_done / self.bytes_total, 3) if self.bytes_total else
+                            (1.0 if self.state == "done" else 0.0),
+                "project_path": self.project_path,
+                "elapsed": round((self.finished or time.time()) - self.started, 2),
+            }
+
+
+class UploadService:
+    """Validates zip uploads up front and extracts them in parallel into a staging directory.
+
+    The central directory is checked before anything is written: entry count,
+    total uncompressed size, compression ratio, symlinks and path traversal.
+    Members are then extracted across a thread pool into a hidden staging
+    directory next to the target, which is renamed into place in one step, so
+    a failed upload never leaves a half-extracted project behind and other
+    projects are never touched.
+    """
+
+    def __init__(self):
+        """Initialize the upload service."""
+        try:
+            from config import (UPLOAD_MAX_ENTRIES, UPLOAD_MAX_UNCOMPRESSED_BYTES, UPLOAD_MAX_COMPRESSION_RATIO,
+                                UPLOAD_EXTRACT_WORKERS, UPLOAD_JOB_TTL, CHUNK_STORE_DIR, CHUNK_MAX_BYTES,
+                                CHUNK_RETENTION, CHUNK_SESSION_TTL)
+        except ImportError:
+            UPLOAD_MAX_ENTRIES, UPLOAD_MAX_UNCOMPRESSED_BYTES, UPLOAD_MAX_COMPRESSION_RATIO = 100000, 2 * 1024 ** 3, 200
+            UPLOAD_EXTRACT_WORKERS, UPLOAD_JOB_TTL = 8, 3600
+            CHUNK_STORE_DIR, CHUNK_MAX_BYTES = os.path.join(".cache", "chunks"), 16 * 1024 * 1024
+            CHUNK_RETENTION, CHUNK_SESSION_TTL = 7 * 86400, 86400
+
+        self.max_entries = UPLOAD_MAX_ENTRIES
+        self.max_uncompressed = UPLOAD_MAX_UNCOMPRESSED_BYTES
+        self.max_ratio = UPLOAD_MAX_COMPRESSION_RATIO
+        self.workers = UPLOAD_EXTRACT_WORKERS
+        self.job_ttl = UPLOAD_JOB_TTL
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.store = None
+
+        # Chunked uploads: content-addressed chunks shared by all sessions, one manifest file per session
+        self.chunk_store_dir = CHUNK_STORE_DIR
+        self.chunk_max_bytes = CHUNK_MAX_BYTES
+        self.chunk_retention = CHUNK_RETENTION
+        self.session_ttl = CHUNK_SESSION_TTL
+        self.chunks = None
+        self.sessions_dir = os.path.join(CHUNK_STORE_DIR, "sessions")
+        self.last_prune = 0
+
+    # Jobs
+
+    def use_shared_store(self, store):
+        """Publish job progress to store, so that every worker process can report it."""
+        self.store = store
+
+    def create_job(self, project_name: str) -> UploadJob:
+        job = UploadJob(uuid.uuid4().hex, project_name, store=self.store, ttl=self.job_ttl)
+        with self.lock:
+            now = time.time()
+            for upload_id in [i for i, j in self.jobs.items() if j.finished and now - j.finished > self.job_ttl]:
+                del self.jobs[upload_id]
+            self.jobs[job.id] = job
+        job.publish()
+        return job
+
+    def get_job(self, upload_id: str) -> Optional[UploadJob]:
+        with self.lock:
+            job = self.jobs.get(upload_id)
+        if job is None and self.store is not None:
+            state = self.store.get("uploads", upload_id)
+            if state is not None:
+                job = UploadJob.from_dict(state)
+        return job
+
+    # Validation
+
+    def validate_archive(self, archive: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+        """Check an archive's central directory and return its members.
+
+        Raises:
+            UploadError: If the archive is too large, too compressed, or has unsafe paths.
+        """
+        members = archive.infolist()
+        if len(members) > self.max_entries:
+            raise UploadError(f"Archive has {len(members)} entries, the limit is {self.max_entries}")
+
+        total = 0
+        compressed_total = 0
+        for member in members:
+            name = member.filename.replace("\\", "/")
+            parts = [p for p in name.split("/") if p]
+            if name.startswith("/") or (parts and ":" in parts[0]) or ".." in parts:
+                raise UploadError(f"Unsafe path in archive: {member.filename}")
+            if stat.S_ISLNK(member.external_attr >> 16):
+                raise UploadError(f"Symbolic links are not allowed: {member.filename}")
+            if member.flag_bits & 0x1:
+                raise UploadError(f"Encrypted entries are not supported: {member.filename}")
+
+            total += member.file_size
+            compressed_total += member.compress_size
+            if member.file_size > 1024 * 1024 and member.file_size > self.max_ratio * max(member.compress_size, 1):
+                raise UploadError(f"Suspicious compression ratio for {member.filename}")
+
+        if total > self.max_uncompressed:
+            raise UploadError(f"Archive expands to {total} bytes, the limit is {self.max_uncompressed}")
+        if total > 1024 * 1024 and total > self.max_ratio * max(compressed_total, 1):
+            raise UploadError("Suspicious overall compression ratio")
+        return members
+
+    # Extraction
+
+    def extract(self, zip_path: str, upload_root: str, project_name: str, job: Optional[UploadJob] = None,
+                on_complete: Optional[Callable[[str], None]] = None,
+                on_replace: Optional[Callable[[str], None]] = None) -> str:
+        """Validate and extract an archive into upload_root/project_name, replacing only that project.
+
+        Args:
+            zip_path: Path of the uploaded zip file.
+            upload_root: Directory that holds all projects.
+            project_name: Directory name of the project to create or replace.
+            job: Optional job updated with progress as members are written.
+            on_complete: Optional callback receiving the project path once it is in place.
+            on_replace: Optional callback receiving the project path just before an existing project there
+                is replaced, to drop state about its old files.
+
+        Returns:
+            The path of the extracted project.
+
+        Raises:
+            UploadError: If the archive is invalid or extraction fails.
+        """
+        job = job or self.create_job(project_name)
+        staging = os.path.join(upload_root, f".staging-{job.id}")
+        target = os.path.join(upload_root, project_name)
+
+        try:
+            job.state = "validating"
+            job.publish()
+            try:
+                archive = zipfile.ZipFile(zip_path, "r")
+            except zipfile.BadZipFile:
+                raise UploadError("Invalid zip file")
+            with archive:
+                members = self.validate_archive(archive)
+
+            files = [m for m in members if not m.is_dir()]
+            with job.lock:
+                job.entries_total = len(files)
+                job.bytes_total = sum(m.file_size for m in files)
+            job.state = "extracting"
+            job.publish()
+
+            # Directories first, then files largest first so the pool stays busy to the end
+            os.makedirs(staging)
+            for member in members:
+                directory = member.filename if member.is_dir() else os.path.dirname(member.filename)
+                if directory:
+                    os.makedirs(os.path.join(staging, directory), exist_ok=True)
+            files.sort(key=lambda m: m.file_size, reverse=True)
+
+            local = threading.local()
+            handles = []
+            handles_lock = threading.Lock()
+
+            def extract_member(member):
+                archive = getattr(local, "archive", None)
+                if archive is None:
+                    archive = local.archive = zipfile.ZipFile(zip_path, "r")
+                    with handles_lock:
+                        handles.append(archive)
+                self._extract_member(archive, member, staging, job)
+
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extract") as executor:
+                    for _ in executor.map(extract_member, files):
+                        pass
+            finally:
+                for handle in handles:
+                    handle.close()
+
+            # Swap the staging directory into place; only this project is replaced
+            previous = None
+            if os.path.exists(target):
+                if on_replace:
+                    on_replace(target)
+                previous = os.path.join(upload_root, f".trash-{job.id}")
+                os.rename(target, previous)
+            os.rename(staging, target)
+            if previous:
+                shutil.rmtree(previous, ignore_errors=True)
+
+            job.project_path = target
+            job.state = "done"
+            job.message = "Project uploaded and extracted successfully"
+            if on_complete:
+                on_complete(target)
+            return target
+        except UploadError as e:
+            job.state = "error"
+            job.message = str(e)
+            raise
+        except Exception as e:
+            job.state = "error"
+            job.message = str(e)
+            raise UploadError(str(e))
+        finally:
+            job.finished = time.time()
+            job.publish()
+            if os.path.exists(staging):
+                shutil.rmtree(staging, ignore_errors=True)
+
+    def _extract_member(self, archive: zipfile.ZipFile, member: zipfile.ZipInfo, staging: str, job: UploadJob):
+        """Stream one member to disk, refusing to write more than its declared size."""
+        destination = os.path.join(staging, member.filename)
+        written = 0
+        with archive.open(member) as source, open(destination, "wb") as target:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > member.file_size:
+                    raise UploadError(f"Entry is larger than declared: {member.filename}")
+                target.write(chunk)
+                job.advance(size=len(chunk))
+        job.advance(entries=1)
+
+    # Chunked, resumable uploads
+
+    def _chunk_store(self) -> ChunkStore:
+        if self.chunks is None:
+            self.chunks = ChunkStore(os.path.join(self.chunk_store_dir, "objects"))
+            os.makedirs(self.sessions_dir, exist_ok=True)
+        return self.chunks
+
+    def _session_path(self, session_id: str) -> str:
+        if not session_id or not all(c in "0123456789abcdef" for c in session_id):
+            raise UploadError("Invalid upload session")
+        return os.path.join(self.sessions_dir, f"{session_id}.json")
+
+    def _load_session(self, session_id: str) -> Dict[str, Any]:
+        self._chunk_store()
+        try:
+            with open(self._session_path(session_id), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError("Upload session not found")
+
+    def _received_path(self, session_id: str) -> str:
+        return self._session_path(session_id)[:-len(".json")] + ".received"
+
+    def _missing_chunks(self, session: Dict[str, Any]) -> List[int]:
+        # Only chunks this session sent count: answering from the shared store
+        # would tell a client what other uploads contain
+        received = set()
+        try:
+            with open(self._received_path(session["session_id"]), "r") as f:
+                received = {int(line) for line in f if line.strip()}
+        except FileNotFoundError:
+            pass
+        store = self._chunk_store()
+        return [i for i, chunk in enumerate(session["chunks"]) if i not in received or not store.has(chunk["hash"])]
+
+    def init_chunked(self, project_name: str, chunks: List[Dict[str, Any]], file_hash: Optional[str] = None) -> Dict:
+        """Start a resumable upload from a manifest of the archive's chunks.
+
+        The client splits the archive into chunks (ideally content-defined, so
+        an edit only changes nearby chunks) and sends their SHA-256 hashes and
+        sizes in order. Every chunk is requested, even if an earlier upload
+        stored the same content, so the reply reveals nothing about other
+        uploads; identical chunks are still stored only once.
+
+        Args:
+            project_name: Directory name of the project to create or replace.
+            chunks: Ordered list of {"hash", "size"} for each chunk.
+            file_hash: Optional SHA-256 of the whole archive, checked at finalize.
+
+        Returns:
+            A dictionary with session_id, the offset of every chunk and the indices still missing.
+        """
+        if not chunks:
+            raise UploadError("A chunk manifest is required")
+
+        offset = 0
+        manifest = []
+        for chunk in chunks:
+            digest = str(chunk.get("hash", "")).lower()
+            size = int(chunk.get("size", -1))
+            if len(digest) != 64 or size < 0 or size > self.chunk_max_bytes:
+                raise UploadError(f"Invalid chunk in manifest at offset {offset}")
+            manifest.append({"hash": digest, "size": size, "offset": offset})
+            offset += size
+        if offset > self.max_uncompressed:
+            raise UploadError(f"Upload of {offset} bytes exceeds the limit of {self.max_uncompressed}")
+
+        session = {
+            "session_id": uuid.uuid4().hex,
+            "project_name": project_name,
+            "file_hash": file_hash.lower() if file_hash else None,
+            "size": offset,
+            "chunks": manifest,
+            "created": time.time(),
+        }
+        self._chunk_store()
+        with open(self._session_path(session["session_id"]), "w") as f:
+            json.dump(session, f)
+
+        self._maybe_prune()
+        missing = self._missing_chunks(session)
+        return {
+            "session_id": session["session_id"],
+            "size": offset,
+            "chunks": len(manifest),
+            "missing": missing,
+            "missing_bytes": sum(manifest[i]["size"] for i in missing),
+        }
+
+    def put_chunk(self, session_id: str, index: int, offset: int, data: bytes, digest: str) -> Dict:
+        """Store one chunk of a session after checking its position, size and hash."""
+        session = self._load_session(session_id)
+        if index < 0 or index >= len(session["chunks"]):
+            raise UploadError("Chunk index out of range")
+        expected = session["chunks"][index]
+        if offset != expected["offset"] or len(data) != expected["size"]:
+            raise UploadError("Chunk offset or size does not match the manifest")
+        if (digest or "").lower() != expected["hash"]:
+            raise UploadError("Chunk hash does not match the manifest")
+        try:
+            self._chunk_store().put(data, expected["hash"])
+        except ValueError as e:
+            raise UploadError(str(e))
+        # One short append per chunk, so parallel chunk requests don't overwrite each other
+        with open(self._received_path(session_id), "a") as f:
+            f.write(f"{index}\n")
+        return {"received": index, "missing": len(self._missing_chunks(session))}
+
+    def chunked_status(self, session_id: str) -> Dict:
+        """Which chunks of a session are still missing, for resuming after a dropped connection."""
+        session = self._load_session(session_id)
+        missing = self._missing_chunks(session)
+        return {
+            "session_id": session_id,
+            "project_name": session["project_name"],
+            "size": session["size"],
+            "chunks": len(session["chunks"]),
+            "missing": missing,
+            "missing_bytes": sum(session["chunks"][i]["size"] for i in missing),
+        }
+
+    def assemble_chunked(self, session_id: str, destination: str) -> str:
+        """Concatenate a complete session's chunks into destination and close the session.
+
+        Returns:
+            The project name the session was started for.
+        """
+        session = self._load_session(session_id)
+        missing = self._missing_chunks(session)
+        if missing:
+            raise UploadError(f"{len(missing)} chunks are still missing")
+
+        hasher = hashlib.sha256() if session.get("file_hash") else None
+
+        class _Writer:
+            def __init__(self, f):
+                self.f = f
+
+            def write(self, block):
+                if hasher:
+                    hasher.update(block)
+                self.f.write(block)
+
+        with open(destination, "wb") as f:
+            written = self._chunk_store().write_concatenated((c["hash"] for c in session["chunks"]), _Writer(f))
+        if written != session["size"]:
+            raise UploadError("Assembled upload has the wrong size")
+        if hasher and hasher.hexdigest() != session["file_hash"]:
+            raise UploadError("Assembled upload does not match its hash")
+
+        os.remove(self._session_path(session_id))
+        try:
+            os.remove(self._received_path(session_id))
+        except FileNotFoundError:
+            pass
+        return session["project_name"]
+
+    def _maybe_prune(self):
+        """Occasionally drop expired sessions and chunks unused for CHUNK_RETENTION, in the background."""
+        now = time.time()
+        with self.lock:
+            if now - self.last_prune < 3600:
+                return
+            self.last_prune = now
+
+        def prune():
+            try:
+                for name in os.listdir(self.sessions_dir):
+                    path = os.path.join(self.sessions_dir, name)
+                    if now - os.stat(path).st_mtime > self.session_ttl:
+                        os.remove(path)
+                self._chunk_store().prune(self.chunk_retention)
+            except OSError as e:
+                logger.error("Error pruning upload chunks", extra={"error": str(e)})
+
+        threading.Thread(target=prune, name="chunk-prune", daemon=True).start()
+
+# Create a singleton instance
+upload_service = UploadService()
@@ -0,0 +1,511 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import logging
+import sqlite3
+import tarfile
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Optional, Any, Tuple, Union
+
+from project_registry import ProjectRegistry
+from terminal_service import TerminalService
+from execution_supervisor import SupervisorClient, RemoteTerminal
+
+WORKSPACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+MAX_TERMINALS = 16
+
+# The workspace's project registry is bookkeeping, not the tenant's data
+REGISTRY_FILES = ("projects.db", "projects.db-wal", "projects.db-shm")
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaError(Exception):
+    """Raised when a workspace would exceed one of its quotas; status is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 507, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _RateLimit:
+    """Token bucket refilled continuously at per_minute tokens a minute, holding at most per_minute."""
+
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def take(self) -> float:
+        """Take a token. Returns 0 on success, else the seconds until one is available."""
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate else float("inf")
+
+
+class Workspace:
+    """One tenant's files, project registry and terminals.
+
+    root is where the client's relative paths resolve; projects live in
+    root/uploaded_projects, mirroring the single-user layout so that paths
+    like "uploaded_projects/<project>/<file>" mean the same thing in every
+    workspace. The shared workspace (mode "off") is the application directory
+    itself and is not isolated or subject to quotas.
+
+    With several worker processes (see WorkspaceService.use_shared_state),
+    terminals are proxies to the execution supervisor and rate limits are kept
+    in the shared store, so every worker sees and enforces the same ones.
+    """
+
+    def __init__(self, workspace_id: Optional[str], root: str, projects_root: str, registry: ProjectRegistry,
+                 isolated: bool, limits: Dict[str, Any], default_terminal: Optional[TerminalService] = None,
+                 store=None, supervisor: Optional[SupervisorClient] = None):
+        self.id = workspace_id
+        self.root = root
+        self.projects_root = projects_root
+        self.registry = registry
+        self.isolated = isolated
+        self.limits = limits
+        self.store = store
+        self.supervisor = supervisor
+        self.terminals: Dict[str, Union[TerminalService, RemoteTerminal]] = {}
+        if default_terminal is not None:
+            self.terminals["default"] = default_terminal
+        self.rate_limits = {kind: _RateLimit(per_minute) for kind, per_minute in limits["rates"].items()}
+        self.usage: Optional[Tuple[int, int]] = None  # (bytes, files)
+        self.usage_at = 0.0
+        self.last_active = time.time()
+        self.persisted_at = 0.0  # when last_active was last written to the workspace table
+        self.lock = threading.Lock()
+
+    def resolve(self, path: str) -> Optional[str]:
+        """The absolute path a client path refers to, or None if it escapes an isolated workspace."""
+        abs_path = os.path.abspath(os.path.join(self.root, path))
+        if self.isolated and abs_path != self.root and not abs_path.startswith(self.root + os.sep):
+            return None
+        return abs_path
+
+    # Quotas
+
+    @staticmethod
+    def measure(directory: str, skip: Tuple[str, ...] = ()) -> Tuple[int, int]:
+        """Bytes and files under a directory, counting hard-linked files (e.g. in snapshots) once.
+
+        Files named in skip are left out at the top level.
+        """
+        seen = set()
+        total_bytes = total_files = 0
+        for current, dirs, files in os.walk(directory):
+            for name in files:
+                if name in skip and current == directory:
+                    continue
+                try:
+                    st = os.lstat(os.path.join(current, name))
+                except OSError:
+                    continue
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                total_bytes += st.st_size
+                total_files += 1
+        return total_bytes, total_files
+
+    def current_usage(self) -> Tuple[int, int]:
+        """Disk use, re-measured every WORKSPACE_USAGE_TTL seconds and adjusted by record_usage in between."""
+        with self.lock:
+            if self.usage is None or time.time() - self.usage_at > self.limits["usage_ttl"]:
+                self.usage = self.measure(self.root, skip=REGISTRY_FILES)
+                self.usage_at = time.time()
+            return self.usage
+
+    def record_usage(self, delta_bytes: int = 0, delta_files: int = 0):
+        with self.lock:
+            if self.usage is not None:
+                self.usage = (max(0, self.usage[0] + delta_bytes), max(0, self.usage[1] + delta_files))
+
+    def invalidate_usage(self):
+        """Re-measure on the next quota check, after changes too broad to account for one by one."""
+        with self.lock:
+            self.usage = None
+
+    def check_quota(self, extra_bytes: int = 0, extra_files: int = 0):
+        """Raise QuotaError if adding this much would take the workspace over its disk or file quota.
+
+        Writes that do not grow the workspace are always allowed, so a workspace
+        over quota can still shrink.
+        """
+        if not self.isolated:
+            return
+        used_bytes, used_files = self.current_usage()
+        if extra_bytes > 0 and used_bytes + extra_bytes > self.limits["max_bytes"]:
+            raise QuotaError(f"Workspace disk quota exceeded ({used_bytes} of {self.limits['max_bytes']} bytes used)")
+        if extra_files > 0 and used_files + extra_files > self.limits["max_files"]:
+            raise QuotaError(f"Workspace file quota exceeded ({used_files} of {self.limits['max_files']} files)")
+
+    def take_rate(self, kind: str):
+        """Count one AI request of kind ("ai" or "completion") against the per-minute limit."""
+        if not self.isolated or kind not in self.rate_limits:
+            return
+        if self.store is not None:
+            waits = []
+
+            def take(state):
+                bucket = _RateLimit(self.limits["rates"][kind])
+                if state:
+                    bucket.tokens, bucket.updated = state
+                waits.append(bucket.take())
+                return [bucket.tokens, bucket.updated]
+
+            self.store.update("rate-limits", f"{self.id}:{kind}", take, ttl=120)
+            wait = waits[0]
+        else:
+            with self.lock:
+                wait = self.rate_limits[kind].take()
+        if wait:
+            raise QuotaError(f"Too many AI requests; try again in {int(wait) + 1} s", status=429,
+                             retry_after=int(wait) + 1)
+
+    # Terminals
+
+    def running_executions(self, exclude: Optional[str] = None) -> int:
+        """Programs running in this workspace's terminals, leaving out the terminal named by exclude."""
+        if self.supervisor is not None:
+            return self.supervisor.running(self.id, exclude=exclude)
+        return sum(1 for key, terminal in list(self.terminals.items()) if key != exclude and terminal.is_running())
+
+    def terminal(self, terminal_id: str = "default", starting: bool = False) -> Union[TerminalService, RemoteTerminal]:
+        """A terminal of this workspace, created on first use.
+
+        Args:
+            terminal_id: Which of the workspace's terminals.
+            starting: The caller is about to run something in it; raises QuotaError if the
+                workspace already has WORKSPACE_MAX_EXECUTIONS processes running elsewhere.
+        """
+        with self.lock:
+            terminal = self.terminals.get(terminal_id)
+            if terminal is None:
+                if len(self.terminals) >= MAX_TERMINALS:
+                    raise QuotaError(f"A workspace may have at most {MAX_TERMINALS} terminals", status=429)
+                terminal = self.terminals[terminal_id] = (RemoteTerminal(self.supervisor, self.id, terminal_id)
+                                                          if self.supervisor is not None else TerminalService())
+            if starting and self.isolated:
+                # Starting in a terminal replaces what runs there, so only the others count
+                if self.running_executions(exclude=terminal_id) >= self.limits["max_executions"]:
+                    raise QuotaError(f"At most {self.limits['max_executions']} programs may run at once", status=429,
+                                     retry_after=5)
+            return terminal
+
+
+class WorkspaceService:
+    """Per-tenant workspaces with quotas and eviction of idle ones to cold storage.
+
+    In WORKSPACE_MODE "off" every request gets the shared workspace. In
+    "session" mode each browser session is given its own workspace id, kept in
+    the signed session cookie; in "header" mode the id comes from
+    WORKSPACE_HEADER, which an authenticating proxy in front of the app must
+    set. Each workspace has its own directory, project registry and terminals,
+    and its own disk, file, execution and AI request quotas.
+
+    Workspaces unused for WORKSPACE_IDLE_SECONDS are packed into a tar.gz in
+    WORKSPACE_COLD_DIR and removed from disk by a background sweep; the next
+    request for one unpacks it again. Activity is tracked in memory and
+    written to SQLite at most once a minute per workspace. The workspace table
+    is shared by every worker process. Opening, thawing and evicting a
+    workspace hold only that workspace's lock (and its cross-process lock when
+    a shared store is set), so packing or unpacking one never holds up
+    requests for the others.
+    """
+
+    def __init__(self):
+        """Initialize the workspace service."""
+        try:
+            from config import (WORKSPACE_MODE, WORKSPACE_HEADER, WORKSPACES_DIR, WORKSPACE_COLD_DIR,
+                                WORKSPACE_MAX_BYTES, WORKSPACE_MAX_FILES, WORKSPACE_MAX_EXECUTIONS,
+                                WORKSPACE_AI_REQUESTS_PER_MINUTE, WORKSPACE_COMPLETIONS_PER_MINUTE,
+                                WORKSPACE_USAGE_TTL, WORKSPACE_IDLE_SECONDS, WORKSPACE_SWEEP_SECONDS)
+        except ImportError:
+            WORKSPACE_MODE, WORKSPACE_HEADER = "off", "X-Workspace-Id"
+            WORKSPACES_DIR, WORKSPACE_COLD_DIR = "workspaces", "workspaces_cold"
+            WORKSPACE_MAX_BYTES, WORKSPACE_MAX_FILES, WORKSPACE_MAX_EXECUTIONS = 1024 ** 3, 100000, 2
+            WORKSPACE_AI_REQUESTS_PER_MINUTE, WORKSPACE_COMPLETIONS_PER_MINUTE = 20, 120
+            WORKSPACE_USAGE_TTL, WORKSPACE_IDLE_SECONDS, WORKSPACE_SWEEP_SECONDS = 60, 7 * 24 * 3600, 3600
+
+        self.mode = WORKSPACE_MODE
+        self.header = WORKSPACE_HEADER
+        self.directory = os.path.abspath(WORKSPACES_DIR)
+        self.cold_directory = os.path.abspath(WORKSPACE_COLD_DIR)
+        self.idle_seconds = WORKSPACE_IDLE_SECONDS
+        self.sweep_seconds = WORKSPACE_SWEEP_SECONDS
+        self.limits = {
+            "max_bytes": WORKSPACE_MAX_BYTES,
+            "max_files": WORKSPACE_MAX_FILES,
+            "max_executions": WORKSPACE_MAX_EXECUTIONS,
+            "usage_ttl": WORKSPACE_USAGE_TTL,
+            "rates": {"ai": WORKSPACE_AI_REQUESTS_PER_MINUTE, "completion": WORKSPACE_COMPLETIONS_PER_MINUTE},
+        }
+        self.shared = None
+        self.workspaces: Dict[str, Workspace] = {}
+        self.connection = None
+        self.lock = threading.Lock()
+        # workspace id -> [lock, holders and waiters], dropped once nobody needs it
+        self.workspace_locks: Dict[str, list] = {}
+        self.evicting = set()
+        self.sweeper = None
+        self.prepare_hook: Optional[Callable[[str], None]] = None
+        self.release_hook: Optional[Callable[[str], None]] = None
+        self.store = None
+        self.supervisor: Optional[SupervisorClient] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("session", "header")
+
+    def use_shared_state(self, store, supervisor: SupervisorClient):
+        """Run as one of several worker processes: terminals live in the execution supervisor, limits in the store.
+
+        Call before set_shared.
+        """
+        self.store = store
+        self.supervisor = supervisor
+
+    def set_shared(self, root: str, projects_root: str, registry: ProjectRegistry, terminal: TerminalService):
+        """Set up the workspace used when workspaces are off: the application's own directories."""
+        if self.supervisor is not None:
+            terminal = RemoteTerminal(self.supervisor, None)
+        self.shared = Workspace(None, root, projects_root, registry, isolated=False, limits=self.limits,
+                                default_terminal=terminal, store=self.store, supervisor=self.supervisor)
+
+    @contextmanager
+    def _locked(self, workspace_id: str):
+        """Hold one workspace's lock, and its cross-process lock when running with other worker processes."""
+        with self.lock:
+            entry = self.workspace_locks.setdefault(workspace_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0], (self.store.locked(f"workspace:{workspace_id}") if self.store is not None else nullcontext()):
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.workspace_locks[workspace_id]
+
+    def set_evict_hooks(self, prepare: Callable[[str], None], release: Callable[[str], None]):
+        """Register callbacks run with a workspace's root when it is evicted.
+
+        prepare runs before its files are packed, to write anything pending;
+        release runs once they are removed, to drop what was cached about them.
+        """
+        self.prepare_hook = prepare
+        self.release_hook = release
+
+    def _db(self) -> sqlite3.Connection:
+        """The workspace table, opened on first use. Call with the lock held."""
+        if self.connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.directory, "workspaces.db"), timeout=30,
+                                         check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS workspaces ("
+                "id TEXT PRIMARY KEY, created REAL NOT NULL, last_active REAL NOT NULL, state TEXT NOT NULL)"
+            )
+            self.connection = connection
+        return self.connection
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def valid_id(workspace_id: Any) -> bool:
+        return isinstance(workspace_id, str) and bool(WORKSPACE_ID_PATTERN.match(workspace_id))
+
+    def get(self, workspace_id: Optional[str]) -> Workspace:
+        """The workspace with this id, created or brought back from cold storage as needed.
+
+        With workspaces off, or without an id, this is the shared workspace.
+        """
+        if not self.enabled or workspace_id is None:
+            return self.shared
+        if not self.valid_id(workspace_id):
+            raise ValueError("Invalid workspace id")
+
+        now = time.time()
+        with self.lock:
+            workspace = self._loaded(workspace_id)
+            if workspace is not None:
+                if now - workspace.persisted_at > 60:
+                    self._db().execute("UPDATE workspaces SET last_active = ? WHERE id = ?", (now, workspace_id))
+                    workspace.persisted_at = now
+                workspace.last_active = now
+                return workspace
+
+        # Opening may unpack it from cold storage, or wait for an eviction of it to finish
+        with self._locked(workspace_id):
+            with self.lock:
+                workspace = self._loaded(workspace_id)
+            if workspace is None:
+                workspace = self._open(workspace_id, now)
+            with self.lock:
+                self.workspaces[workspace_id] = workspace
+                workspace.last_active = now
+                if self.sweeper is None and self.idle_seconds > 0:
+                    self.sweeper = threading.Thread(target=self._sweep_loop, name="workspace-sweeper", daemon=True)
+                    self.sweeper.start()
+        return workspace
+
+    def _loaded(self, workspace_id: str) -> Optional[Workspace]:
+        """The workspace if it is in memory and not being evicted. Call with the lock held."""
+        if workspace_id in self.evicting:
+            return None
+        workspace = self.workspaces.get(workspace_id)
+        if workspace is not None and not os.path.isdir(workspace.root):
+            # Another worker process moved it to cold storage
+            self.workspaces.pop(workspace_id)
+            if self.release_hook:
+                self.release_hook(workspace.root)
+            workspace = None
+        return workspace
+
+    def _open(self, workspace_id: str, now: float) -> Workspace:
+        """Load a workspace, unpacking it from cold storage first if it was evicted. Call with its lock held."""
+        root = os.path.join(self.directory, workspace_id)
+        with self.lock:
+            db = self._db()
+            row = db.execute("SELECT state FROM workspaces WHERE id = ?", (workspace_id,)).fetchone()
+            if row is None:
+                db.execute("INSERT INTO workspaces (id, created, last_active, state) VALUES (?, ?, ?, 'active')",
+                           (workspace_id, now, now))
+            elif row[0] != "cold":
+                db.execute("UPDATE workspaces SET last_active = ? WHERE id = ?", (now, workspace_id))
+        if row is not None and row[0] == "cold":
+            self._thaw(workspace_id, root)
+            with self.lock:
+                self._db().execute("UPDATE workspaces SET state = 'active', last_active = ? WHERE id = ?",
+                                   (now, workspace_id))
+
+        projects_root = os.path.join(root, "uploaded_projects")
+        os.makedirs(projects_root, exist_ok=True)
+        registry = ProjectRegistry(os.path.join(root, REGISTRY_FILES[0]))
+        workspace = Workspace(workspace_id, root, projects_root, registry, isolated=True, limits=self.limits,
+                              store=self.store, supervisor=self.supervisor)
+        workspace.persisted_at = now
+        return workspace
+
+    # Cold storage
+
+    def _archive_path(self, workspace_id: str) -> str:
+        return os.path.join(self.cold_directory, f"{workspace_id}.tar.gz")
+
+    def _thaw(self, workspace_id: str, root: str):
+        archive_path = self._archive_path(workspace_id)
+        staging = f"{root}.thawing"
+        shutil.rmtree(staging, ignore_errors=True)
+        with tarfile.open(archive_path, "r:gz") as archive:
+            # The archive is one we wrote; still, keep every member inside the workspace
+            members = [m for m in archive.getmembers()
+                       if not (m.name.startswith("/") or ".." in m.name.split("/")) and not m.isdev()]
+            archive.extractall(staging, members=members)
+        shutil.rmtree(root, ignore_errors=True)
+        os.rename(staging, root)
+        os.remove(archive_path)
+        logger.info("Workspace restored from cold storage", extra={"workspace": workspace_id})
+
+    def evict(self, workspace_id: str) -> bool:
+        """Pack an idle workspace into cold storage and free its disk and memory.
+
+        Returns:
+            False if it has programs running, or is not active on disk.
+        """
+        with self._locked(workspace_id):
+            if self.supervisor is not None:
+                # It may be running programs started through other worker processes
+                if self.supervisor.running(workspace_id):
+                    return False
+            with self.lock:
+                workspace = self.workspaces.get(workspace_id)
+                if self.supervisor is None and workspace is not None and workspace.running_executions():
+                    return False
+                row = self._db().execute("SELECT state FROM workspaces WHERE id = ?", (workspace_id,)).fetchone()
+                if row is None or row[0] != "active":
+                    return False
+                # Requests for it now wait on its lock instead of using it while it is packed
+                self.evicting.add(workspace_id)
+            try:
+                return self._pack(workspace_id)
+            finally:
+                with self.lock:
+                    self.evicting.discard(workspace_id)
+
+    def _pack(self, workspace_id: str) -> bool:
+        """Write a workspace to cold storage and remove it from disk. Call with its lock held."""
+        root = os.path.join(self.directory, workspace_id)
+        if self.prepare_hook:
+            self.prepare_hook(root)
+
+        os.makedirs(self.cold_directory, exist_ok=True)
+        archive_path = self._archive_path(workspace_id)
+        temp_path = f"{archive_path}.{os.getpid()}.tmp"
+        try:
+            with tarfile.open(temp_path, "w:gz", compresslevel=6) as archive:
+                if os.path.isdir(root):
+                    archive.add(root, arcname=".")
+            os.replace(temp_path, archive_path)
+        except OSError as e:
+            logger.error("Error evicting workspace", extra={"workspace": workspace_id, "error": str(e)})
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+
+        with self.lock:
+            self._db().execute("UPDATE workspaces SET state = 'cold' WHERE id = ?", (workspace_id,))
+            self.workspaces.pop(workspace_id, None)
+        shutil.rmtree(root, ignore_errors=True)
+        if self.release_hook:
+            self.release_hook(root)
+        return True
+
+    def running_programs(self) -> int:
+        """Programs running in every workspace's terminals, those started through other worker processes included."""
+        if self.supervisor is not None:
+            return self.supervisor.running_total()
+        with self.lock:
+            workspaces = list(self.workspaces.values()) + ([self.shared] if self.shared is not None else [])
+        return sum(workspace.running_executions() for workspace in workspaces)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_seconds)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Error sweeping workspaces")
+
+    def sweep(self) -> int:
+        """Evict every workspace idle for WORKSPACE_IDLE_SECONDS. Returns how many were evicted."""
+        cutoff = time.time() - self.idle_seconds
+        with self.lock:
+            # Activity seen in this process may not have been written yet
+            for workspace_id, workspace in self.workspaces.items():
+                self._db().execute("UPDATE workspaces SET last_active = MAX(last_active, ?) WHERE id = ?",
+                                   (workspace.last_active, workspace_id))
+            idle = [row[0] for row in self._db().execute(
+                "SELECT id FROM workspaces WHERE state = 'active' AND last_active < ?", (cutoff,))]
+        return sum(1 for workspace_id in idle if self.evict(workspace_id))
+
+
+# Create a singleton instance
+workspace_service = WorkspaceService()